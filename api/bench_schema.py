@@ -0,0 +1,128 @@
+import random
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from schema import (
+    ALLOWED_EVENT_TYPES,
+    BASE_REQUIRED_FIELDS,
+    REQUIRED_FIELDS_BY_TYPE,
+    validate_event,
+    validate_events,
+)
+
+
+def nonempty(x):
+    return isinstance(x, str) and len(x.strip()) > 0
+
+
+def is_int(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def legacy_validate_event(event):
+    for f in BASE_REQUIRED_FIELDS:
+        if f not in event:
+            return False, f"missing {f}"
+    if event.get("schema") != 1:
+        return False, "unsupported schema"
+    if not nonempty(event.get("event_id")):
+        return False, "invalid event_id"
+    if not nonempty(event.get("client_session_id")):
+        return False, "invalid client_session_id"
+    if not nonempty(event.get("tab_id")):
+        return False, "invalid tab_id"
+    if not is_int(event.get("event_ts")):
+        return False, "event_ts must be int (epoch ms)"
+    etype = event.get("event_type")
+    if etype not in ALLOWED_EVENT_TYPES:
+        return False, "invalid event_type"
+    for f in REQUIRED_FIELDS_BY_TYPE.get(etype, []):
+        if f not in event:
+            return False, f"missing {f} for {etype}"
+    if etype in ("video_start", "watch_tick", "video_stop"):
+        if not nonempty(event.get("video_id")):
+            return False, "video_id must be non-empty string"
+        if not nonempty(event.get("video_session_id")):
+            return False, "video_session_id must be non-empty string"
+    if etype == "watch_tick":
+        delta = event.get("watch_ms_delta")
+        if not is_int(delta) or delta < 0 or delta > 60_000:
+            return False, "watch_ms_delta must be int 0..60000"
+        wm = event.get("watch_mode")
+        if wm is not None and wm not in ("foreground", "background"):
+            return False, "watch_mode must be foreground|background (or omitted)"
+    if etype == "visibility_change":
+        if not isinstance(event.get("is_visible"), bool):
+            return False, "is_visible must be boolean"
+    return True, None
+
+
+def make_events(n: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    events = []
+    for i in range(n):
+        ev = {
+            "schema": 1,
+            "event_id": f"evt-{i:08d}-3f9c2a",
+            "event_ts": 1768800000000 + i * 250,
+            "client_session_id": "cs-6b1f0c9e-4d2a-4e55-9a51-0c1d2e3f4a5b",
+            "tab_id": f"tab-{rng.randint(1, 8)}",
+            "page_url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        }
+        r = rng.random()
+        video = {
+            "video_id": f"vid{rng.randint(1, 500):05d}",
+            "video_session_id": f"vs-{rng.randint(1, 2000)}",
+            "channel_name": f"Channel {rng.randint(1, 80)}",
+        }
+        if r < 0.75:
+            ev.update(video, event_type="watch_tick", watch_ms_delta=rng.randint(0, 5000),
+                      watch_mode=rng.choice(["foreground", "background"]))
+        elif r < 0.82:
+            ev.update(video, event_type="video_start")
+        elif r < 0.88:
+            ev.update(video, event_type="video_stop")
+        elif r < 0.93:
+            ev.update(event_type="visibility_change", is_visible=rng.random() < 0.5)
+        elif r < 0.97:
+            ev.update(event_type="player_state_change", new_state=rng.randint(-1, 5))
+        else:
+            ev.update(video, event_type="watch_tick", watch_ms_delta=90_000)
+        events.append(ev)
+    return events
+
+
+def bench(label: str, fn, events: list, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn(events)
+        best = min(best, time.perf_counter() - t0)
+    rate = len(events) / best
+    print(f"{label:<32} {rate:>12,.0f} events/s  ({best * 1000:.1f} ms per {len(events)})")
+    return rate
+
+
+def legacy_loop(events):
+    return [legacy_validate_event(ev) for ev in events]
+
+
+def per_event_loop(events):
+    return [validate_event(ev) for ev in events]
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    events = make_events(n)
+
+    accepted, errors = validate_events(events)
+    legacy_errors = [r[1] for r in legacy_loop(events) if not r[0]]
+    assert [e["error"] for e in errors] == legacy_errors
+
+    base = bench("legacy validate_event loop", legacy_loop, events, 10)
+    bench("validate_event loop", per_event_loop, events, 10)
+    batch = bench("validate_events", validate_events, events, 10)
+    print(f"speedup (batch vs legacy): {batch / base:.2f}x  accepted={len(accepted)} rejected={len(errors)}")
@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from codec import dumps_line
+from firehose_client import add_event
+from logs import get_logger
+import metrics
+from config import COALESCE_TICKS, COALESCE_WINDOW_MS, COALESCE_MAX_GROUPS
+
+log = get_logger("coalesce")
+
+GROUP_FIELDS = ("video_session_id", "video_id", "channel_name", "watch_mode")
+
+ticks_in = metrics.counter("coalesce_ticks_in_total", "watch_tick events offered to the coalescer")
+ticks_out = metrics.counter("coalesce_ticks_out_total", "Summarized watch_tick events emitted by the coalescer")
+
+
+# Merges watch_tick events that share GROUP_FIELDS into one summarized tick
+# per window: the first tick's fields and event_ts, the summed
+# watch_ms_delta, plus last_event_ts and coalesced_count. The processor only
+# sums watch_ms_delta per video/channel/mode, so its totals are unchanged;
+# only event counts shrink. A summarized tick the sink refuses (queue full)
+# stays pending and is retried on the next flush. A tick that would open a
+# group beyond max_groups first flushes the oldest group; if the sink refuses
+# that too, add() returns False and the caller treats the queue as full.
+class TickCoalescer:
+    def __init__(
+        self,
+        sink: Callable[[bytes], bool],
+        window_ms: int = COALESCE_WINDOW_MS,
+        max_groups: int = COALESCE_MAX_GROUPS,
+    ):
+        self.sink = sink
+        self.window_ms = window_ms
+        self.max_groups = max_groups
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._ticker = None
+
+    def start(self) -> None:
+        self._closed.clear()
+        if self._ticker is None or not self._ticker.is_alive():
+            self._ticker = threading.Thread(target=self._tick_loop, name="tick-coalescer", daemon=True)
+            self._ticker.start()
+
+    def add(self, event: Dict[str, Any]) -> bool:
+        key = tuple(event.get(f) for f in GROUP_FIELDS)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                self._merge(group[0], event)
+                ticks_in.inc()
+                return True
+            full = len(self._groups) >= self.max_groups
+        if full:
+            self.flush(max_groups=self.max_groups - 1)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                self._merge(group[0], event)
+            elif len(self._groups) >= self.max_groups:
+                return False
+            else:
+                self._groups[key] = [dict(event, last_event_ts=event["event_ts"], coalesced_count=1), time.monotonic()]
+        ticks_in.inc()
+        return True
+
+    @staticmethod
+    def _merge(merged: Dict[str, Any], event: Dict[str, Any]) -> None:
+        merged["watch_ms_delta"] += event["watch_ms_delta"]
+        merged["last_event_ts"] = max(merged["last_event_ts"], event["event_ts"])
+        merged["coalesced_count"] += 1
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._groups)
+
+    # Emits groups older than the window (all of them with force=True), or the
+    # oldest ones beyond max_groups. Groups are kept in insertion order, so
+    # the oldest come first; emission stops at the first one the sink refuses.
+    def flush(self, force: bool = False, max_groups: Optional[int] = None) -> int:
+        cutoff = time.monotonic() - self.window_ms / 1000
+        emitted = 0
+        with self._lock:
+            excess = len(self._groups) - max_groups if max_groups is not None else 0
+            for key, (merged, opened) in list(self._groups.items()):
+                if not force and opened > cutoff and emitted >= excess:
+                    break
+                if not self.sink(dumps_line(merged)):
+                    break
+                del self._groups[key]
+                emitted += 1
+        ticks_out.inc(emitted)
+        return emitted
+
+    def close(self, timeout: float = 5.0) -> None:
+        self._closed.set()
+        if self._ticker is not None:
+            self._ticker.join()
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            if not self.flush(force=True):
+                time.sleep(0.05)
+        if self.pending():
+            log.error("Tick coalescer closed with %d summarized ticks unsent", self.pending())
+
+    def _tick_loop(self) -> None:
+        while not self._closed.wait(self.window_ms / 2000):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Tick coalescer flush failed: %r", e)
+
+
+ticks = TickCoalescer(add_event)
+
+
+def start_coalescer() -> None:
+    if COALESCE_TICKS:
+        ticks.start()
+
+
+def stop_coalescer() -> None:
+    if COALESCE_TICKS:
+        ticks.close()
@@ -14,14 +14,65 @@ def validate_config():
     if not AWS_REGION:
         raise ValueError("AWS_REGION environment variable is required")
 
-DATA_DIR = "data"
+DATA_DIR = os.getenv("DATA_DIR", "data")
 EVENTS_FILE = os.path.join(DATA_DIR, "events.ndjson")
 os.makedirs(DATA_DIR, exist_ok=True)
 
+LOCAL_LOG_FLUSH_LINES = int(os.getenv("LOCAL_LOG_FLUSH_LINES", "256"))
+LOCAL_LOG_FLUSH_MS = int(os.getenv("LOCAL_LOG_FLUSH_MS", "200"))
+LOCAL_LOG_FSYNC = os.getenv("LOCAL_LOG_FSYNC", "none").lower()
+LOCAL_LOG_FSYNC_INTERVAL_MS = int(os.getenv("LOCAL_LOG_FSYNC_INTERVAL_MS", "1000"))
+LOCAL_LOG_ROTATE_BYTES = int(os.getenv("LOCAL_LOG_ROTATE_BYTES", "0"))
+LOCAL_LOG_ROTATE_SECS = int(os.getenv("LOCAL_LOG_ROTATE_SECS", "0"))
+LOCAL_LOG_COMPRESSION = os.getenv("LOCAL_LOG_COMPRESSION", "none").lower()
+
+SPOOL_DIR = os.path.join(DATA_DIR, "spool")
+SPOOL_HIGH_WATER_RECORDS = int(os.getenv("SPOOL_HIGH_WATER_RECORDS", "5000"))
+SPOOL_SEGMENT_MAX_BYTES = int(os.getenv("SPOOL_SEGMENT_MAX_BYTES", str(4 * 1024 * 1024)))
+SPOOL_REPLAY_RECORDS_PER_SEC = int(os.getenv("SPOOL_REPLAY_RECORDS_PER_SEC", "2000"))
+
+INGEST_MAX_EVENTS = int(os.getenv("INGEST_MAX_EVENTS", "500"))
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(1024 * 1024)))
+INGEST_MAX_DECODED_BYTES = int(os.getenv("INGEST_MAX_DECODED_BYTES", str(8 * 1024 * 1024)))
+INGEST_MAX_LINE_BYTES = int(os.getenv("INGEST_MAX_LINE_BYTES", str(64 * 1024)))
+INGEST_BUFFER_WATERMARK = int(os.getenv("INGEST_BUFFER_WATERMARK", "8000"))
+INGEST_RETRY_AFTER_SECS = int(os.getenv("INGEST_RETRY_AFTER_SECS", "2"))
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "True").lower() == "true"
+DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "1000000"))
+DEDUP_FP_RATE = float(os.getenv("DEDUP_FP_RATE", "0.001"))
+DEDUP_WINDOW_SECS = int(os.getenv("DEDUP_WINDOW_SECS", "3600"))
+DEDUP_FILE = os.path.join(DATA_DIR, "dedup.bloom")
+
 BATCH_MAX_RECORDS = int(os.getenv("BATCH_MAX_RECORDS", "50"))
 BATCH_FLUSH_MS = int(os.getenv("BATCH_FLUSH_MS", "500"))
+BATCH_QUEUE_MAX_RECORDS = int(os.getenv("BATCH_QUEUE_MAX_RECORDS", "10000"))
+BATCH_RETRY_BACKOFF_MS = int(os.getenv("BATCH_RETRY_BACKOFF_MS", "1000"))
+
+FIREHOSE_MAX_RETRIES = int(os.getenv("FIREHOSE_MAX_RETRIES", "3"))
+FIREHOSE_RETRY_BASE_MS = int(os.getenv("FIREHOSE_RETRY_BASE_MS", "100"))
+FIREHOSE_RETRY_MAX_MS = int(os.getenv("FIREHOSE_RETRY_MAX_MS", "2000"))
+FIREHOSE_AGGREGATE_RECORDS = os.getenv("FIREHOSE_AGGREGATE_RECORDS", "False").lower() == "true"
+FIREHOSE_AGGREGATE_MAX_BYTES = int(os.getenv("FIREHOSE_AGGREGATE_MAX_BYTES", str(1000 * 1024)))
+
+COALESCE_TICKS = os.getenv("COALESCE_TICKS", "False").lower() == "true"
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "5000"))
+COALESCE_MAX_GROUPS = int(os.getenv("COALESCE_MAX_GROUPS", "10000"))
+
+STATS_ENABLED = os.getenv("STATS_ENABLED", "True").lower() == "true"
+STATS_BUCKET_SECS = int(os.getenv("STATS_BUCKET_SECS", "60"))
+STATS_RETENTION_SECS = int(os.getenv("STATS_RETENTION_SECS", str(24 * 3600)))
+STATS_MAX_TOP_N = int(os.getenv("STATS_MAX_TOP_N", "1000"))
+STATS_TAIL_MS = int(os.getenv("STATS_TAIL_MS", "1000"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
 FLASK_HOST = os.getenv("FLASK_HOST", "127.0.0.1")
 FLASK_PORT = int(os.getenv("FLASK_PORT", "4000"))
 FLASK_DEBUG = os.getenv("FLASK_DEBUG", "False").lower() == "true"
 
+GUNICORN_WORKERS = int(os.getenv("GUNICORN_WORKERS", "2"))
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "8"))
+
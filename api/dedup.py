@@ -0,0 +1,181 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from config import DEDUP_CAPACITY, DEDUP_FP_RATE, DEDUP_WINDOW_SECS, DEDUP_FILE
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float, bits=None):
+        self.num_bits = BloomFilter.size_bits(capacity, fp_rate)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8) if bits is None else bits
+        self.count = 0
+
+    @staticmethod
+    def size_bits(capacity: int, fp_rate: float) -> int:
+        return max(64, math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+
+    def positions(self, key: str) -> list[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        n = self.num_bits
+        return [(h1 + i * h2) % n for i in range(self.num_hashes)]
+
+    def contains(self, positions: list[int]) -> bool:
+        bits = self.bits
+        for p in positions:
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, positions: list[int]) -> None:
+        bits = self.bits
+        for p in positions:
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def clear(self) -> None:
+        self.bits[:] = bytes(len(self.bits))
+        self.count = 0
+
+
+# current generation, inserts into it, rotated_at, rotations
+_HEADER = struct.Struct("<QQdQ")
+
+
+# Two generations of equal size: ids are remembered for at least one window
+# (or `capacity` inserts) and at most two. Memory is fixed at two bitsets and
+# the effective false-positive rate is at most about 2 * fp_rate.
+# reserve() checks and claims an id under one lock, so two requests carrying
+# the same id cannot both pass; the claim is kept in an exact set until the
+# event is queued (remember) or refused (release), since a Bloom filter
+# cannot forget a single id.
+#
+# With a path, the bitsets and rotation state live in a file that every
+# gunicorn worker maps, and each check or insert holds an flock on
+# path + ".lock" like the local log writer, so an id accepted by one worker
+# is a duplicate on all of them and survives restarts. Claims stay per
+# process: the same id posted to two workers at the same instant can still
+# pass twice.
+class EventIdDeduper:
+    def __init__(self, capacity: int, fp_rate: float, window_secs: float, path: Optional[str] = None):
+        self.capacity = capacity
+        self.window_secs = window_secs
+        nbytes = (BloomFilter.size_bits(capacity, fp_rate) + 7) // 8
+        size = _HEADER.size + 2 * nbytes
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        if path is None:
+            self._buf = bytearray(size)
+            _HEADER.pack_into(self._buf, 0, 0, 0, time.time(), 0)
+        else:
+            self._buf = self._map(path, size)
+        view = memoryview(self._buf)
+        self._filters = (
+            BloomFilter(capacity, fp_rate, view[_HEADER.size:_HEADER.size + nbytes]),
+            BloomFilter(capacity, fp_rate, view[_HEADER.size + nbytes:]),
+        )
+        self._reserved = set()
+        self.checked = 0
+        self.duplicates = 0
+
+    def _map(self, path: str, size: int) -> mmap.mmap:
+        self._lock_fd = os.open(path + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            with self._locked():
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, _HEADER.pack(0, 0, time.time(), 0), 0)
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._lock_fd is None or fcntl is None:
+                yield
+                return
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # Expects self._locked() to be held; returns the current generation.
+    def _locked_rotate_if_due(self) -> int:
+        current, count, rotated_at, rotations = _HEADER.unpack_from(self._buf, 0)
+        now = time.time()
+        if count < self.capacity and now - rotated_at < self.window_secs:
+            return current
+        current ^= 1
+        self._filters[current].clear()
+        if now - rotated_at >= 2 * self.window_secs:
+            self._filters[current ^ 1].clear()
+        _HEADER.pack_into(self._buf, 0, current, 0, now, rotations + 1)
+        return current
+
+    def reserve(self, event_id: str) -> bool:
+        positions = self._filters[0].positions(event_id)
+        with self._locked():
+            self.checked += 1
+            if (
+                event_id in self._reserved
+                or self._filters[0].contains(positions)
+                or self._filters[1].contains(positions)
+            ):
+                self.duplicates += 1
+                return False
+            self._reserved.add(event_id)
+        return True
+
+    def release(self, event_id: str) -> None:
+        with self._lock:
+            self._reserved.discard(event_id)
+
+    def remember(self, event_id: str) -> None:
+        positions = self._filters[0].positions(event_id)
+        with self._locked():
+            current = self._locked_rotate_if_due()
+            self._filters[current].add(positions)
+            current, count, rotated_at, rotations = _HEADER.unpack_from(self._buf, 0)
+            _HEADER.pack_into(self._buf, 0, current, count + 1, rotated_at, rotations)
+            self._reserved.discard(event_id)
+
+    def reset(self) -> None:
+        with self._locked():
+            for bloom in self._filters:
+                bloom.clear()
+            _HEADER.pack_into(self._buf, 0, 0, 0, time.time(), 0)
+            self._reserved.clear()
+            self.checked = 0
+            self.duplicates = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            rotations = _HEADER.unpack_from(self._buf, 0)[3]
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "hit_rate": self.duplicates / self.checked if self.checked else 0.0,
+                "rotations": rotations,
+                "memory_bytes": sum(len(bloom.bits) for bloom in self._filters),
+                "shared": self._lock_fd is not None,
+            }
+
+
+event_ids = EventIdDeduper(DEDUP_CAPACITY, DEDUP_FP_RATE, DEDUP_WINDOW_SECS, DEDUP_FILE)
@@ -1,15 +1,32 @@
-import json
+import random
+import threading
 import time
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from config import (
     AWS_REGION,
     AWS_ACCESS_KEY_ID,
     AWS_SECRET_ACCESS_KEY,
     FIREHOSE_STREAM_NAME,
     BATCH_MAX_RECORDS,
-    BATCH_FLUSH_MS
+    BATCH_FLUSH_MS,
+    BATCH_QUEUE_MAX_RECORDS,
+    BATCH_RETRY_BACKOFF_MS,
+    FIREHOSE_MAX_RETRIES,
+    FIREHOSE_RETRY_BASE_MS,
+    FIREHOSE_RETRY_MAX_MS,
+    FIREHOSE_AGGREGATE_RECORDS,
+    FIREHOSE_AGGREGATE_MAX_BYTES,
+    SPOOL_DIR,
+    SPOOL_HIGH_WATER_RECORDS,
+    SPOOL_SEGMENT_MAX_BYTES,
+    SPOOL_REPLAY_RECORDS_PER_SEC,
 )
+from spool import DiskSpool
+from logs import get_logger
+import metrics
+
+log = get_logger("firehose")
 
 firehose_kwargs = {"region_name": AWS_REGION}
 if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
@@ -19,41 +36,412 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
     })
 firehose = boto3.client("firehose", **firehose_kwargs)
 
-_batch = []
-_last_flush = 0.0
+PUT_BATCH_MAX_RECORDS = 500
+PUT_BATCH_MAX_BYTES = 4 * 1024 * 1024
+PUT_RECORD_MAX_BYTES = 1000 * 1024
+
+RETRYABLE_ERROR_CODES = {
+    "ServiceUnavailableException",
+    "ThrottlingException",
+    "InternalFailure",
+    "InternalFailureException",
+}
+
+_stats = {
+    "put_calls": 0,
+    "records_sent": 0,
+    "events_sent": 0,
+    "bytes_sent": 0,
+    "retry_attempts": 0,
+    "records_retried": 0,
+    "records_failed": 0,
+    "records_oversized": 0,
+    "events_spilled": 0,
+    "events_replayed": 0,
+}
+_stats_lock = threading.Lock()
+
+put_latency = metrics.histogram("firehose_put_record_batch_seconds", "put_record_batch call latency")
+put_batch_records = metrics.histogram("firehose_put_batch_records", "Records per put_record_batch call", metrics.COUNT_BUCKETS)
+put_errors = metrics.counter("firehose_put_errors_total", "put_record_batch calls that raised")
+put_retries = metrics.counter("firehose_retry_attempts_total", "put_record_batch retry attempts")
+records_failed = metrics.counter("firehose_records_failed_total", "Records left unsent after all retries")
+
+
+class FirehoseSendError(RuntimeError):
+    def __init__(self, message: str, unsent: list[bytes]):
+        super().__init__(message)
+        self.unsent = unsent
+
+
+def _count(**deltas: int) -> None:
+    with _stats_lock:
+        for name, delta in deltas.items():
+            _stats[name] += delta
+
+
+def get_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _aggregate_records(records: list[tuple[bytes, list[bytes]]]) -> list[tuple[bytes, list[bytes]]]:
+    max_bytes = min(FIREHOSE_AGGREGATE_MAX_BYTES, PUT_RECORD_MAX_BYTES)
+    packed = []
+    parts = []
+    events = []
+    size = 0
+    for data, evs in records:
+        if parts and size + len(data) > max_bytes:
+            packed.append((b"".join(parts), events))
+            parts = []
+            events = []
+            size = 0
+        parts.append(data)
+        events.extend(evs)
+        size += len(data)
+    if parts:
+        packed.append((b"".join(parts), events))
+    return packed
+
+
+def _split_batches(records: list[tuple[bytes, list[bytes]]]):
+    chunk = []
+    chunk_bytes = 0
+    for data, evs in records:
+        if chunk and (len(chunk) >= PUT_BATCH_MAX_RECORDS or chunk_bytes + len(data) > PUT_BATCH_MAX_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append((data, evs))
+        chunk_bytes += len(data)
+    if chunk:
+        yield chunk
+
+
+def _backoff(attempt: int) -> None:
+    cap_ms = min(FIREHOSE_RETRY_MAX_MS, FIREHOSE_RETRY_BASE_MS * (2 ** attempt))
+    time.sleep(random.uniform(0, cap_ms) / 1000)
+
+
+def _put_with_retry(pending: list[tuple[bytes, list[bytes]]]) -> tuple[list[tuple[bytes, list[bytes]]], str]:
+    error = ""
+    for attempt in range(FIREHOSE_MAX_RETRIES + 1):
+        if attempt:
+            _backoff(attempt - 1)
+            _count(retry_attempts=1, records_retried=len(pending))
+            put_retries.inc()
+        put_batch_records.observe(len(pending))
+        started = time.perf_counter()
+        try:
+            resp = firehose.put_record_batch(
+                DeliveryStreamName=FIREHOSE_STREAM_NAME,
+                Records=[{"Data": data} for data, _ in pending]
+            )
+        except ClientError as e:
+            put_latency.observe(time.perf_counter() - started)
+            put_errors.inc()
+            _count(put_calls=1)
+            error = repr(e)
+            if e.response.get("Error", {}).get("Code") not in RETRYABLE_ERROR_CODES:
+                return pending, error
+            continue
+        except BotoCoreError as e:
+            # Connection errors and timeouts: the whole batch is unsent.
+            put_latency.observe(time.perf_counter() - started)
+            put_errors.inc()
+            _count(put_calls=1)
+            error = repr(e)
+            continue
+        put_latency.observe(time.perf_counter() - started)
+        _count(put_calls=1)
+
+        failed = []
+        if resp.get("FailedPutCount", 0):
+            responses = resp.get("RequestResponses", [])
+            failed = [rec for rec, r in zip(pending, responses) if r.get("ErrorCode")]
+            codes = sorted({r["ErrorCode"] for r in responses if r.get("ErrorCode")})
+            error = f"{len(failed)} records failed: {codes}"
+        sent_bytes = sum(len(data) for data, _ in pending) - sum(len(data) for data, _ in failed)
+        sent_events = sum(len(evs) for _, evs in pending) - sum(len(evs) for _, evs in failed)
+        _count(records_sent=len(pending) - len(failed), events_sent=sent_events, bytes_sent=sent_bytes)
+        if not failed:
+            return [], ""
+        pending = failed
+    return pending, error
+
+
+def send_batch(events: list[bytes]) -> None:
+    records = []
+    for line in events:
+        if len(line) > PUT_RECORD_MAX_BYTES:
+            _count(records_oversized=1)
+            log.warning("Firehose record dropped: %d bytes exceeds %d", len(line), PUT_RECORD_MAX_BYTES)
+            continue
+        records.append((line, [line]))
+    if FIREHOSE_AGGREGATE_RECORDS:
+        records = _aggregate_records(records)
+
+    unsent = []
+    error = ""
+    for chunk in _split_batches(records):
+        failed, err = _put_with_retry(chunk)
+        if failed:
+            unsent.extend(ev for _, evs in failed for ev in evs)
+            error = err
+    if unsent:
+        _count(records_failed=len(unsent))
+        records_failed.inc(len(unsent))
+        raise FirehoseSendError(f"Firehose batch failed: {len(unsent)} records unsent. last_error={error}", unsent)
+
+
+# One batcher per process. Request threads only append under the lock; the
+# flusher and spool replayer threads do all Firehose and disk I/O. Under a
+# pre-fork server each worker must build its own batcher after forking
+# (threads do not survive fork), which is what gunicorn.conf.py arranges.
+class FirehoseBatcher:
+    def __init__(
+        self,
+        spool: DiskSpool,
+        max_records: int = BATCH_MAX_RECORDS,
+        flush_ms: int = BATCH_FLUSH_MS,
+        queue_max_records: int = BATCH_QUEUE_MAX_RECORDS,
+        retry_backoff_ms: int = BATCH_RETRY_BACKOFF_MS,
+        spool_high_water_records: int = SPOOL_HIGH_WATER_RECORDS,
+        replay_records_per_sec: int = SPOOL_REPLAY_RECORDS_PER_SEC,
+    ):
+        self.spool = spool
+        self.max_records = max_records
+        self.flush_ms = flush_ms
+        self.queue_max_records = queue_max_records
+        self.retry_backoff_ms = retry_backoff_ms
+        self.spool_high_water_records = spool_high_water_records
+        self.replay_records_per_sec = replay_records_per_sec
+        self._batch = []
+        self._batch_started = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._outage = False
+        self._spilling = 0
+        self._flusher = None
+        self._replayer = None
+        self._replay_stop = threading.Event()
+
+    def add(self, line: bytes) -> bool:
+        with self._wakeup:
+            if len(self._batch) >= self.queue_max_records:
+                return False
+            if not self._batch:
+                self._batch_started = time.time()
+            self._batch.append(line)
+            if len(self._batch) == 1 or len(self._batch) >= self.max_records:
+                self._wakeup.notify()
+        return True
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._batch)
 
+    def stats(self) -> dict:
+        with self._lock:
+            depth = len(self._batch)
+            outage = self._outage
+        spooled = self.spool.stats()
+        return {
+            "queue_depth": depth,
+            "queue_capacity": self.queue_max_records,
+            "outage": outage,
+            "spool_segments": spooled["segments"],
+            "spool_bytes": spooled["bytes"],
+        }
 
-def send_batch(events: list[dict]) -> None:
-    records = [{"Data": (json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8")} for ev in events]
-    resp = firehose.put_record_batch(
-        DeliveryStreamName=FIREHOSE_STREAM_NAME,
-        Records=records
-    )
-    failed = resp.get("FailedPutCount", 0)
-    if failed:
-        raise RuntimeError(f"Firehose batch failed: {failed} records failed. resp={resp}")
+    def flush(self, force: bool = False) -> None:
+        while True:
+            with self._lock:
+                if not self._batch:
+                    return
+                if not force and not self._locked_due(time.time()):
+                    return
+                events = self._locked_take()
+                spill_only = self._outage
+                if spill_only:
+                    self._spilling += 1
+            if spill_only:
+                self._spill(events)
+                continue
+            try:
+                send_batch(events)
+            except FirehoseSendError as e:
+                self._handle_unsent(e.unsent)
+                raise
+            except Exception:
+                self._handle_unsent(events)
+                raise
+            log.debug("Firehose batch OK", extra={"fields": {"sent": len(events)}})
+
+    def start(self) -> None:
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._stopping = False
+            self._replay_stop.clear()
+            self._flusher = threading.Thread(target=self._flusher_loop, name="firehose-flusher", daemon=True)
+            self._flusher.start()
+            self._replayer = threading.Thread(target=self._replay_loop, name="firehose-spool-replayer", daemon=True)
+            self._replayer.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._replay_stop.set()
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+            flusher = self._flusher
+            replayer = self._replayer
+        if replayer is not None:
+            replayer.join(timeout)
+        if flusher is not None:
+            flusher.join(timeout)
+
+    # All helpers prefixed with _locked_ expect the caller to hold self._lock.
+    def _locked_due(self, now: float) -> bool:
+        if not self._batch:
+            return False
+        return len(self._batch) >= self.max_records or (now - self._batch_started) * 1000 >= self.flush_ms
+
+    def _locked_take(self) -> list[bytes]:
+        events = self._batch[:self.max_records]
+        del self._batch[:self.max_records]
+        self._batch_started = time.time()
+        return events
+
+    def _locked_requeue(self, events: list[bytes]) -> None:
+        if not self._batch:
+            self._batch_started = time.time()
+        self._batch[:0] = events
+
+    # Callers count the spill in self._spilling under the lock before
+    # releasing it, so the replayer never ends an outage while a batch is on
+    # its way to the spool.
+    def _spill(self, events: list[bytes]) -> None:
+        try:
+            self.spool.spill(events)
+        finally:
+            with self._lock:
+                self._spilling -= 1
+        _count(events_spilled=len(events))
+
+    def _handle_unsent(self, events: list[bytes]) -> None:
+        with self._lock:
+            if not self._outage and len(self._batch) + len(events) <= self.spool_high_water_records:
+                self._locked_requeue(events)
+                return
+            if not self._outage:
+                log.warning(
+                    "Firehose outage: spooling to %s above %d queued records",
+                    self.spool.directory, self.spool_high_water_records,
+                )
+            self._outage = True
+            self._spilling += 1
+        self._spill(events)
+
+    def _flusher_loop(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._stopping and not self._locked_due(time.time()):
+                    timeout = None
+                    if self._batch:
+                        timeout = max(0.0, self.flush_ms / 1000 - (time.time() - self._batch_started))
+                    self._wakeup.wait(timeout)
+                if self._stopping:
+                    break
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Firehose send failed: %r", e)
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(self.retry_backoff_ms / 1000)
+
+        try:
+            self.flush(force=True)
+        except Exception as e:
+            log.error("Firehose drain failed, spooling unsent events: %r", e)
+            with self._lock:
+                events = self._batch[:]
+                self._batch.clear()
+                self._spilling += 1
+            self._spill(events)
+        self.spool.seal()
+
+    def _replay_once(self) -> bool:
+        claimed = self.spool.claim_oldest()
+        if claimed is None:
+            self._end_outage_if_drained()
+            return False
+        events = self.spool.read(claimed)
+        try:
+            send_batch(events)
+        except FirehoseSendError as e:
+            self.spool.release(claimed, e.unsent)
+            raise
+        except Exception:
+            self.spool.release(claimed)
+            raise
+        self.spool.ack(claimed)
+        _count(events_replayed=len(events))
+        log.info("Firehose spool replay OK", extra={"fields": {"sent": len(events)}})
+        self._end_outage_if_drained()
+        if self.replay_records_per_sec > 0:
+            self._replay_stop.wait(len(events) / self.replay_records_per_sec)
+        return True
+
+    # Live batches keep going to the spool until it is empty, so events reach
+    # Firehose in the order they were accepted.
+    def _end_outage_if_drained(self) -> None:
+        with self._lock:
+            if self._outage and not self._spilling and not self.spool.has_pending():
+                self._outage = False
+                log.info("Firehose outage over: spool drained")
+
+    def _replay_loop(self) -> None:
+        while not self._replay_stop.is_set():
+            try:
+                replayed = self._replay_once()
+            except Exception as e:
+                log.error("Firehose spool replay failed: %r", e)
+                self._replay_stop.wait(self.retry_backoff_ms / 1000)
+                continue
+            if not replayed:
+                self._replay_stop.wait(self.flush_ms / 1000)
+
+
+batcher = FirehoseBatcher(DiskSpool(SPOOL_DIR, SPOOL_SEGMENT_MAX_BYTES))
+
+
+def add_event(line: bytes) -> bool:
+    return batcher.add(line)
 
 
 def flush(force: bool = False) -> None:
-    global _batch, _last_flush
-    if not _batch:
-        return
-    now = time.time()
-    if not force:
-        if len(_batch) < BATCH_MAX_RECORDS and (now - _last_flush) * 1000 < BATCH_FLUSH_MS:
-            return
-    events = _batch
-    _batch = []
-    _last_flush = now
-    try:
-        send_batch(events)
-    except (ClientError, RuntimeError) as e:
-        _batch = events + _batch
-        raise
-    print(f"Firehose batch OK: sent={len(events)}")
-
-
-def add_event(event: dict) -> None:
-    global _batch
-    _batch.append(event)
+    batcher.flush(force)
+
+
+def queue_depth() -> int:
+    return batcher.depth()
+
+
+def buffer_stats() -> dict:
+    return batcher.stats()
+
+
+def start_flusher() -> None:
+    batcher.start()
+
+
+def stop_flusher(timeout: float = 10.0) -> None:
+    batcher.stop(timeout)
+
 
+metrics.gauge("firehose_queue_depth", "Events buffered for the Firehose flusher", queue_depth)
+metrics.gauge("firehose_queue_capacity", "Maximum events the Firehose buffer holds", lambda: batcher.queue_max_records)
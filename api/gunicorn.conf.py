@@ -0,0 +1,34 @@
+from config import FLASK_HOST, FLASK_PORT, GUNICORN_WORKERS, GUNICORN_THREADS
+
+bind = f"{FLASK_HOST}:{FLASK_PORT}"
+workers = GUNICORN_WORKERS
+threads = GUNICORN_THREADS
+worker_class = "gthread"
+graceful_timeout = 15
+
+# Every worker imports the app itself so its batcher, spool replayer, local
+# log writer and logging listener are created after the fork, not inherited
+# half-initialised from the master.
+preload_app = False
+
+
+def post_worker_init(worker):
+    from logs import setup_logging
+    from firehose_client import start_flusher
+    from coalesce import start_coalescer
+    from stats import rebuild_live_stats
+
+    setup_logging()
+    rebuild_live_stats()
+    start_flusher()
+    start_coalescer()
+
+
+def worker_exit(server, worker):
+    from firehose_client import stop_flusher
+    from storage import close_local_log
+    from coalesce import stop_coalescer
+
+    stop_coalescer()
+    stop_flusher()
+    close_local_log()
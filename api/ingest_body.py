@@ -0,0 +1,100 @@
+import zlib
+from typing import BinaryIO, Iterator
+
+READ_CHUNK_BYTES = 64 * 1024
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class LineTooLong(BodyTooLarge):
+    pass
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+def is_ndjson(content_type: str) -> bool:
+    return (content_type or "").split(";", 1)[0].strip().lower() in NDJSON_CONTENT_TYPES
+
+
+def _new_inflater():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# Yields the request body decoded, one bounded chunk at a time. max_bytes caps
+# the decoded size, so a small gzip body cannot inflate past it.
+def iter_body(stream: BinaryIO, encoding: str, max_bytes: int) -> Iterator[bytes]:
+    encoding = (encoding or "identity").strip().lower()
+    if encoding not in ("identity", "gzip", "x-gzip"):
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+    inflater = _new_inflater() if encoding != "identity" else None
+    total = 0
+    while True:
+        data = stream.read(READ_CHUNK_BYTES)
+        if not data:
+            break
+        while data:
+            if inflater is None:
+                chunk, data = data, b""
+            else:
+                try:
+                    chunk = inflater.decompress(data, READ_CHUNK_BYTES)
+                except zlib.error as e:
+                    raise ValueError(f"Invalid gzip body: {e}") from e
+                if inflater.eof:
+                    # Concatenated gzip members continue in unused_data.
+                    data = inflater.unused_data
+                    if data:
+                        inflater = _new_inflater()
+                else:
+                    data = inflater.unconsumed_tail
+            total += len(chunk)
+            if total > max_bytes:
+                raise BodyTooLarge(f"Decoded request body exceeds {max_bytes} bytes")
+            if chunk:
+                yield chunk
+    if inflater is not None and not inflater.eof:
+        raise ValueError("Invalid gzip body: truncated stream")
+
+
+def read_body(stream: BinaryIO, encoding: str, max_bytes: int) -> bytes:
+    return b"".join(iter_body(stream, encoding, max_bytes))
+
+
+# Splits decoded chunks into non-blank lines without the "\n". A line that
+# spans chunks is collected as a list of parts and joined once, and any line
+# longer than max_line_bytes raises LineTooLong as soon as it gets there.
+def iter_lines(chunks: Iterator[bytes], max_line_bytes: int) -> Iterator[bytes]:
+    parts = []
+    pending = 0
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            if pending + end - start > max_line_bytes:
+                raise LineTooLong(f"NDJSON line exceeds {max_line_bytes} bytes")
+            if parts:
+                parts.append(chunk[start:end])
+                line = b"".join(parts)
+                parts = []
+                pending = 0
+            else:
+                line = chunk[start:end]
+            if line.strip():
+                yield line
+            start = end + 1
+        if start < len(chunk):
+            pending += len(chunk) - start
+            if pending > max_line_bytes:
+                raise LineTooLong(f"NDJSON line exceeds {max_line_bytes} bytes")
+            parts.append(chunk[start:])
+    line = b"".join(parts)
+    if line.strip():
+        yield line
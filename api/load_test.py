@@ -0,0 +1,119 @@
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_schema import make_events
+from codec import dumps, loads
+
+
+def client_loop(args) -> dict:
+    url, batch_size, duration = args
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    template = make_events(batch_size, seed=os.getpid())
+    prefix = uuid.uuid4().hex[:12]
+    totals = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "events": 0}
+    seq = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for ev in template:
+            ev["event_id"] = f"{prefix}-{seq}"
+            seq += 1
+        body = dumps({"events": template})
+        try:
+            conn.request("POST", parts.path or "/ingest", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException):
+            totals["errors"] += 1
+            conn.close()
+            continue
+        totals["requests"] += 1
+        if resp.status == 200:
+            totals["ok"] += 1
+            totals["events"] += loads(data)["accepted"]
+        elif resp.status == 429:
+            totals["throttled"] += 1
+            time.sleep(float(resp.getheader("Retry-After", "1")))
+        else:
+            totals["errors"] += 1
+    conn.close()
+    return totals
+
+
+def run_load(url: str, clients: int, batch_size: int, duration: float) -> dict:
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client_loop, [(url, batch_size, duration)] * clients)
+    totals = {k: sum(r[k] for r in results) for k in results[0]}
+    totals["req_per_sec"] = totals["requests"] / duration
+    totals["events_per_sec"] = totals["events"] / duration
+    return totals
+
+
+def wait_ready(url: str, timeout: float = 15.0) -> None:
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not become ready")
+
+
+def report(label: str, totals: dict) -> None:
+    print(
+        f"{label:<12} {totals['req_per_sec']:>9,.0f} req/s {totals['events_per_sec']:>11,.0f} events/s"
+        f"  ok={totals['ok']} 429={totals['throttled']} errors={totals['errors']}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load-test POST /ingest")
+    parser.add_argument("--url", default="http://127.0.0.1:4100/ingest")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client processes")
+    parser.add_argument("--batch", type=int, default=25, help="events per request")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--workers", default="", help="comma-separated gunicorn worker counts to launch and compare, e.g. 1,2,4")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker when --workers is given")
+    args = parser.parse_args()
+
+    if not args.workers:
+        report("target", run_load(args.url, args.clients, args.batch, args.duration))
+        return
+
+    parts = urlsplit(args.url)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for count in [int(w) for w in args.workers.split(",")]:
+        env = dict(
+            os.environ,
+            FLASK_HOST=parts.hostname,
+            FLASK_PORT=str(parts.port),
+            GUNICORN_WORKERS=str(count),
+            GUNICORN_THREADS=str(args.threads),
+            LOG_LEVEL="WARNING",
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"], cwd=here, env=env,
+        )
+        try:
+            wait_ready(args.url)
+            report(f"workers={count}", run_load(args.url, args.clients, args.batch, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import threading
+from bisect import bisect_left
+from typing import Callable
+
+# Each metric keeps one shard per thread ident, so updates from request and
+# flusher threads never contend on a lock; shards are summed on scrape.
+# Thread idents are reused once a thread exits, which keeps the number of
+# shards bounded by the peak number of concurrent threads. Reads during a
+# scrape may miss an in-flight increment, never corrupt a value.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class _Sharded:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+
+    def _new_shard(self) -> list:
+        raise NotImplementedError
+
+    def _shard(self) -> list:
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.setdefault(ident, self._new_shard())
+        return shard
+
+    def _snapshot(self) -> list[list]:
+        with self._shards_lock:
+            shards = list(self._shards.values())
+        return [list(s) for s in shards]
+
+    def reset(self) -> None:
+        with self._shards_lock:
+            for shard in self._shards.values():
+                shard[:] = self._new_shard()
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def _new_shard(self) -> list:
+        return [0]
+
+    def inc(self, amount: float = 1) -> None:
+        self._shard()[0] += amount
+
+    def value(self) -> float:
+        return sum(s[0] for s in self._snapshot())
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {_fmt(self.value())}"]
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    # Layout: one slot per bucket, one for +Inf, then the running sum.
+    def _new_shard(self) -> list:
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        shard = self._shard()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> dict:
+        merged = [0] * (len(self.buckets) + 2)
+        for shard in self._snapshot():
+            for i, v in enumerate(shard):
+                merged[i] += v
+        return {"counts": merged[:-1], "sum": merged[-1], "count": sum(merged[:-1])}
+
+    def render(self) -> list[str]:
+        snap = self.snapshot()
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets + ("+Inf",), snap["counts"]):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_fmt(snap['sum'])}")
+        lines.append(f"{self.name}_count {snap['count']}")
+        return lines
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {_fmt(self.fn())}"]
+
+
+def _fmt(value: float) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return _register(Counter(name, help_text))
+
+
+def histogram(name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, buckets))
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]) -> Gauge:
+    with _registry_lock:
+        metric = Gauge(name, help_text, fn)
+        _registry[name] = metric
+        return metric
+
+
+def render_prometheus() -> str:
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        if isinstance(metric, _Sharded):
+            metric.reset()
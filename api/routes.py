@@ -1,16 +1,145 @@
-from flask import request, jsonify
-from schema import parse_event_dict
-from firehose_client import add_event, flush
-from storage import append_local_ndjson
-from config import FIREHOSE_STREAM_NAME, AWS_REGION
+import logging
+import time
+from collections import Counter
+from flask import request, jsonify, g, Response
+from werkzeug.exceptions import RequestEntityTooLarge
+from schema import validate_event, validate_events
+from firehose_client import add_event, get_stats, buffer_stats, queue_depth
+from storage import append_local_line
+from codec import dumps_line, loads
+from ingest_body import BodyTooLarge, LineTooLong, UnsupportedEncoding, is_ndjson, iter_body, iter_lines, read_body
+from dedup import event_ids
+from coalesce import ticks
+from stats import live_stats
+from logs import get_logger
+import metrics
+from config import (
+    FIREHOSE_STREAM_NAME,
+    AWS_REGION,
+    DEDUP_ENABLED,
+    COALESCE_TICKS,
+    STATS_ENABLED,
+    STATS_MAX_TOP_N,
+    INGEST_MAX_EVENTS,
+    INGEST_MAX_BYTES,
+    INGEST_MAX_DECODED_BYTES,
+    INGEST_MAX_LINE_BYTES,
+    INGEST_BUFFER_WATERMARK,
+    INGEST_RETRY_AFTER_SECS,
+)
+
+log = get_logger("ingest")
+
+request_latency = metrics.histogram("ingest_request_seconds", "End-to-end /ingest request latency")
+request_events = metrics.histogram("ingest_request_events", "Events per /ingest request", metrics.COUNT_BUCKETS)
+validation_latency = metrics.histogram("ingest_validation_seconds", "Batch validation time per /ingest request")
+events_accepted = metrics.counter("ingest_events_accepted_total", "Events accepted and queued")
+events_rejected = metrics.counter("ingest_events_rejected_total", "Events that failed validation")
+events_duplicate = metrics.counter("ingest_events_duplicate_total", "Events dropped as duplicates")
+requests_overloaded = metrics.counter("ingest_requests_overloaded_total", "/ingest requests answered with 429")
+
+
+def _log_ingest_summary(received: int, accepted: int, duplicates: int, errors: list, queue_full: bool) -> None:
+    level = logging.WARNING if queue_full else logging.INFO
+    if not log.isEnabledFor(level):
+        return
+    fields = {
+        "received": received,
+        "accepted": accepted,
+        "rejected": len(errors),
+        "duplicates": duplicates,
+        "queue_full": queue_full,
+    }
+    if errors:
+        fields["rejected_by_reason"] = dict(Counter(err["error"] for err in errors))
+    log.log(level, "ingest", extra={"fields": fields})
+
+
+def _overloaded(error: str, **extra):
+    requests_overloaded.inc()
+    resp = jsonify({"ok": False, "error": error, "retry_after": INGEST_RETRY_AFTER_SECS, **extra})
+    resp.headers["Retry-After"] = str(INGEST_RETRY_AFTER_SECS)
+    return resp, 429
+
+
+def _too_large(limit: int):
+    return jsonify({"ok": False, "error": f"Request body exceeds {limit} bytes"}), 413
+
+
+class _IngestBatch:
+    def __init__(self, received: int, errors: list):
+        self.received = received
+        self.errors = errors
+        self.accepted = 0
+        self.duplicates = 0
+        self.queue_full = False
+
+    def offer(self, parsed: dict) -> bool:
+        event_id = parsed["event_id"]
+        if DEDUP_ENABLED and not event_ids.reserve(event_id):
+            self.duplicates += 1
+            return True
+
+        line = dumps_line(parsed)
+        if COALESCE_TICKS and parsed["event_type"] == "watch_tick":
+            queued = ticks.add(parsed)
+        else:
+            queued = add_event(line)
+        if not queued:
+            if DEDUP_ENABLED:
+                event_ids.release(event_id)
+            self.queue_full = True
+            return False
+        if DEDUP_ENABLED:
+            event_ids.remember(event_id)
+        append_local_line(line)
+        self.accepted += 1
+        return True
+
+    def respond(self, status: int = 200, error: str = ""):
+        events_accepted.inc(self.accepted)
+        events_rejected.inc(len(self.errors))
+        events_duplicate.inc(self.duplicates)
+        _log_ingest_summary(self.received, self.accepted, self.duplicates, self.errors, self.queue_full)
+
+        counts = {
+            "accepted": self.accepted,
+            "rejected": len(self.errors),
+            "duplicates": self.duplicates,
+            "errors": self.errors[:10],
+        }
+        if self.queue_full:
+            return _overloaded(
+                "Firehose queue full",
+                firehose_stream=FIREHOSE_STREAM_NAME,
+                region=AWS_REGION,
+                **counts,
+            )
+        if error:
+            return jsonify({"ok": False, "error": error, **counts}), status
+        return jsonify({
+            "ok": True,
+            **counts,
+            "firehose_stream": FIREHOSE_STREAM_NAME,
+            "region": AWS_REGION
+        }), status
 
 
 def register_routes(app):
+    app.config["MAX_CONTENT_LENGTH"] = INGEST_MAX_BYTES
+
+    @app.before_request
+    def start_timer():
+        g.started = time.perf_counter()
+
     @app.after_request
     def add_cors_headers(resp):
+        if request.endpoint == "ingest" and "started" in g:
+            request_latency.observe(time.perf_counter() - g.started)
         resp.headers["Access-Control-Allow-Origin"] = "*"
         resp.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-        resp.headers["Access-Control-Allow-Headers"] = "content-type"
+        resp.headers["Access-Control-Allow-Headers"] = "content-type, content-encoding"
+        resp.headers["Access-Control-Expose-Headers"] = "Retry-After"
         return resp
 
     @app.route("/health", methods=["GET"])
@@ -18,17 +147,56 @@ def register_routes(app):
         return jsonify({
             "ok": True,
             "region": AWS_REGION,
-            "stream": FIREHOSE_STREAM_NAME
+            "stream": FIREHOSE_STREAM_NAME,
+            "firehose": get_stats(),
+            "buffer": {**buffer_stats(), "watermark": INGEST_BUFFER_WATERMARK},
+            "dedup": event_ids.stats() if DEDUP_ENABLED else None
         }), 200
 
+    @app.route("/stats", methods=["GET"])
+    def stats_endpoint():
+        if not STATS_ENABLED:
+            return jsonify({"ok": False, "error": "Live stats are disabled"}), 404
+        try:
+            window = int(request.args["window"]) if "window" in request.args else None
+            top_n = int(request.args.get("top", "10"))
+        except ValueError:
+            return jsonify({"ok": False, "error": "window and top must be integers"}), 400
+        if (window is not None and window <= 0) or not 0 < top_n <= STATS_MAX_TOP_N:
+            return jsonify({"ok": False, "error": f"window must be > 0 and top in 1..{STATS_MAX_TOP_N}"}), 400
+        return jsonify({"ok": True, **live_stats.query(window, top_n)}), 200
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
     @app.route("/ingest", methods=["OPTIONS"])
     def ingest_options():
         return ("", 204)
 
     @app.route("/ingest", methods=["POST"])
     def ingest():
+        depth = queue_depth()
+        if depth >= INGEST_BUFFER_WATERMARK:
+            return _overloaded("Ingest buffer over watermark", queue_depth=depth)
+
+        if request.content_length is not None and request.content_length > INGEST_MAX_BYTES:
+            return _too_large(INGEST_MAX_BYTES)
+        encoding = request.headers.get("Content-Encoding")
+        if is_ndjson(request.mimetype):
+            return _ingest_ndjson(encoding)
+
         try:
-            payload = request.get_json(force=True)
+            if encoding:
+                payload = loads(read_body(request.stream, encoding, INGEST_MAX_DECODED_BYTES))
+            else:
+                payload = request.get_json(force=True)
+        except RequestEntityTooLarge:
+            return _too_large(INGEST_MAX_BYTES)
+        except BodyTooLarge:
+            return _too_large(INGEST_MAX_DECODED_BYTES)
+        except UnsupportedEncoding as e:
+            return jsonify({"ok": False, "error": str(e)}), 415
         except Exception:
             return jsonify({"ok": False, "error": "Invalid JSON"}), 400
 
@@ -37,52 +205,59 @@ def register_routes(app):
         else:
             incoming_events = [payload]
 
-        accepted = 0
-        rejected = 0
-        errors = []
-
-        print(f"=== /ingest called: events={len(incoming_events)} ===")
+        if len(incoming_events) > INGEST_MAX_EVENTS:
+            return jsonify({"ok": False, "error": f"Too many events: max {INGEST_MAX_EVENTS} per request"}), 413
 
-        for idx, ev in enumerate(incoming_events):
-            if not isinstance(ev, dict):
-                rejected += 1
-                errors.append({"index": idx, "error": "event is not an object"})
-                print(f"Rejected idx={idx}: not an object")
-                continue
+        request_events.observe(len(incoming_events))
+        started = time.perf_counter()
+        valid_events, errors = validate_events(incoming_events)
+        validation_latency.observe(time.perf_counter() - started)
 
-            parsed, err = parse_event_dict(ev)
-            if parsed is None:
-                rejected += 1
-                errors.append({"index": idx, "error": err or "invalid event"})
-                print(f"Rejected idx={idx}: {err} type={ev.get('event_type')}")
-                continue
-
-            print(f"Accepted idx={idx}: {parsed.get('event_type')} vid={parsed.get('video_id')} ch={parsed.get('channel_name')} delta={parsed.get('watch_ms_delta')}")
-
-            append_local_ndjson(parsed)
-            add_event(parsed)
-            accepted += 1
+        batch = _IngestBatch(len(incoming_events), errors)
+        for parsed in valid_events:
+            if not batch.offer(parsed):
+                break
+        return batch.respond()
 
+    # Lines are decoded, validated and queued as they arrive, so neither the
+    # body nor the event list is ever held in memory whole. Events queued
+    # before a later error (bad gzip, too many events) stay queued and are
+    # counted in the response.
+    def _ingest_ndjson(encoding):
+        batch = _IngestBatch(0, [])
+        validation_secs = 0.0
         try:
-            flush(force=True)
-        except Exception as e:
-            print("Firehose ERROR:", repr(e))
-            return jsonify({
-                "ok": False,
-                "error": "Firehose write failed",
-                "firehose_stream": FIREHOSE_STREAM_NAME,
-                "region": AWS_REGION,
-                "accepted": accepted,
-                "rejected": rejected,
-                "errors": errors[:10]
-            }), 500
-
-        return jsonify({
-            "ok": True,
-            "accepted": accepted,
-            "rejected": rejected,
-            "errors": errors[:10],
-            "firehose_stream": FIREHOSE_STREAM_NAME,
-            "region": AWS_REGION
-        }), 200
-
+            lines = iter_lines(iter_body(request.stream, encoding, INGEST_MAX_DECODED_BYTES), INGEST_MAX_LINE_BYTES)
+            for idx, line in enumerate(lines):
+                if idx >= INGEST_MAX_EVENTS:
+                    return batch.respond(413, f"Too many events: max {INGEST_MAX_EVENTS} per request")
+                batch.received += 1
+                try:
+                    event = loads(line)
+                except ValueError:
+                    batch.errors.append({"index": idx, "error": "invalid JSON"})
+                    continue
+                if not isinstance(event, dict):
+                    batch.errors.append({"index": idx, "error": "event is not an object"})
+                    continue
+                started = time.perf_counter()
+                ok, err = validate_event(event)
+                validation_secs += time.perf_counter() - started
+                if not ok:
+                    batch.errors.append({"index": idx, "error": err})
+                elif not batch.offer(event):
+                    break
+        except RequestEntityTooLarge:
+            return batch.respond(413, f"Request body exceeds {INGEST_MAX_BYTES} bytes")
+        except LineTooLong as e:
+            return batch.respond(413, str(e))
+        except BodyTooLarge:
+            return batch.respond(413, f"Request body exceeds {INGEST_MAX_DECODED_BYTES} bytes")
+        except UnsupportedEncoding as e:
+            return batch.respond(415, str(e))
+        except ValueError as e:
+            return batch.respond(400, str(e))
+        finally:
+            request_events.observe(batch.received)
+            validation_latency.observe(validation_secs)
+        return batch.respond()
@@ -1,5 +1,5 @@
-import json
-from typing import Any, Dict, Optional, Tuple
+from codec import loads
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 ALLOWED_EVENT_TYPES = {
     "video_start",
@@ -28,60 +28,113 @@ REQUIRED_FIELDS_BY_TYPE = {
     "context_missing": ["context_type"],
 }
 
-def _is_nonempty_str(x: Any) -> bool:
-    return isinstance(x, str) and len(x.strip()) > 0
+# Checks are (field, predicate, error), run in order; the first failing
+# predicate's error is returned.
+def _nonempty_str(v: Any) -> bool:
+    return isinstance(v, str) and len(v) > 0 and not v.isspace()
 
-def _is_int(x: Any) -> bool:
-    return isinstance(x, int) and not isinstance(x, bool)
+def _int(v: Any) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
 
-def validate_event(event: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
-    for f in BASE_REQUIRED_FIELDS:
-        if f not in event:
-            return False, f"missing {f}"
-
-    if event.get("schema") != 1:
-        return False, "unsupported schema"
-
-    if not _is_nonempty_str(event.get("event_id")):
-        return False, "invalid event_id"
+Check = Tuple[str, Callable[[Any], bool], str]
 
-    if not _is_nonempty_str(event.get("client_session_id")):
-        return False, "invalid client_session_id"
-
-    if not _is_nonempty_str(event.get("tab_id")):
-        return False, "invalid tab_id"
-
-    if not _is_int(event.get("event_ts")):
-        return False, "event_ts must be int (epoch ms)"
+BASE_CHECKS: List[Check] = [
+    ("schema", lambda v: v == 1, "unsupported schema"),
+    ("event_id", _nonempty_str, "invalid event_id"),
+    ("client_session_id", _nonempty_str, "invalid client_session_id"),
+    ("tab_id", _nonempty_str, "invalid tab_id"),
+    ("event_ts", _int, "event_ts must be int (epoch ms)"),
+]
 
-    etype = event.get("event_type")
-    if etype not in ALLOWED_EVENT_TYPES:
-        return False, "invalid event_type"
+_VIDEO_CHECKS: List[Check] = [
+    ("video_id", _nonempty_str, "video_id must be non-empty string"),
+    ("video_session_id", _nonempty_str, "video_session_id must be non-empty string"),
+]
 
-    for f in REQUIRED_FIELDS_BY_TYPE.get(etype, []):
-        if f not in event:
-            return False, f"missing {f} for {etype}"
+CHECKS_BY_TYPE: Dict[str, List[Check]] = {
+    "video_start": _VIDEO_CHECKS,
+    "watch_tick": _VIDEO_CHECKS + [
+        ("watch_ms_delta", lambda v: _int(v) and 0 <= v <= 60_000, "watch_ms_delta must be int 0..60000"),
+        ("watch_mode", lambda v: v is None or v == "foreground" or v == "background",
+         "watch_mode must be foreground|background (or omitted)"),
+    ],
+    "video_stop": _VIDEO_CHECKS,
+    "visibility_change": [
+        ("is_visible", lambda v: isinstance(v, bool), "is_visible must be boolean"),
+    ],
+}
 
-    if etype in ("video_start", "watch_tick", "video_stop"):
-        if not _is_nonempty_str(event.get("video_id")):
-            return False, "video_id must be non-empty string"
-        if not _is_nonempty_str(event.get("video_session_id")):
-            return False, "video_session_id must be non-empty string"
+Validator = Callable[[Dict[str, Any]], Optional[str]]
+
+# One validator per event type, built once. When every required field is
+# present (the common case) the checks run in one pass; otherwise the first
+# missing field is named, in the same order as the checks.
+def _build_validator(etype: Optional[str]) -> Validator:
+    type_required = REQUIRED_FIELDS_BY_TYPE.get(etype, [])
+    required = frozenset(BASE_REQUIRED_FIELDS) | frozenset(type_required)
+    base_missing = [(f, f"missing {f}") for f in BASE_REQUIRED_FIELDS]
+    type_missing = [(f, f"missing {f} for {etype}") for f in type_required]
+    type_checks = CHECKS_BY_TYPE.get(etype, [])
+    checks = BASE_CHECKS + type_checks
+    result = "invalid event_type" if etype is None else None
+
+    def validate(event: Dict[str, Any]) -> Optional[str]:
+        get = event.get
+        if required <= event.keys():
+            for f, ok, err in checks:
+                if not ok(get(f)):
+                    return err
+            return result
+
+        for f, err in base_missing:
+            if f not in event:
+                return err
+        for f, ok, err in BASE_CHECKS:
+            if not ok(get(f)):
+                return err
+        if etype is None:
+            return result
+        for f, err in type_missing:
+            if f not in event:
+                return err
+        for f, ok, err in type_checks:
+            if not ok(get(f)):
+                return err
+        return None
 
-    if etype == "watch_tick":
-        delta = event.get("watch_ms_delta")
-        if not _is_int(delta) or delta < 0 or delta > 60_000:
-            return False, "watch_ms_delta must be int 0..60000"
+    return validate
 
-        wm = event.get("watch_mode")
-        if wm is not None and wm not in ("foreground", "background"):
-            return False, "watch_mode must be foreground|background (or omitted)"
+VALIDATORS: Dict[str, Validator] = {etype: _build_validator(etype) for etype in ALLOWED_EVENT_TYPES}
+_validate_invalid_type = _build_validator(None)
 
-    if etype == "visibility_change":
-        if not isinstance(event.get("is_visible"), bool):
-            return False, "is_visible must be boolean"
+def _validator_for(event: Dict[str, Any]) -> Validator:
+    try:
+        return VALIDATORS.get(event.get("event_type"), _validate_invalid_type)
+    except TypeError:
+        return _validate_invalid_type
 
-    return True, None
+def validate_event(event: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    err = _validator_for(event)(event)
+    return err is None, err
+
+def validate_events(events: List[Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    accepted = []
+    errors = []
+    validators_get = VALIDATORS.get
+    for idx, event in enumerate(events):
+        if not isinstance(event, dict):
+            errors.append({"index": idx, "error": "event is not an object"})
+            continue
+        try:
+            validate = validators_get(event.get("event_type"), _validate_invalid_type)
+        except TypeError:
+            validate = _validate_invalid_type
+        err = validate(event)
+        if err is None:
+            accepted.append(event)
+        else:
+            errors.append({"index": idx, "error": err})
+    return accepted, errors
 
 def parse_event_dict(event_dict: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
     ok, err = validate_event(event_dict)
@@ -94,8 +147,8 @@ def parse_event_line(line: str) -> Optional[Dict[str, Any]]:
     if not line:
         return None
     try:
-        event_dict = json.loads(line)
-    except json.JSONDecodeError:
+        event_dict = loads(line)
+    except ValueError:
         return None
     ok, _ = validate_event(event_dict)
     return event_dict if ok else None
@@ -1,10 +1,31 @@
+import atexit
+import signal
+import sys
 from flask import Flask
 from config import FLASK_HOST, FLASK_PORT, FLASK_DEBUG, validate_config
 from routes import register_routes
+from firehose_client import start_flusher, stop_flusher
+from storage import close_local_log
+from coalesce import start_coalescer, stop_coalescer
+from stats import rebuild_live_stats
+from logs import setup_logging
 
 validate_config()
 app = Flask(__name__)
 register_routes(app)
 
+
+def _handle_sigterm(signum, frame):
+    sys.exit(0)
+
+
 if __name__ == "__main__":
+    setup_logging()
+    rebuild_live_stats()
+    start_flusher()
+    start_coalescer()
+    atexit.register(close_local_log)
+    atexit.register(stop_flusher)
+    atexit.register(stop_coalescer)
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     app.run(host=FLASK_HOST, port=FLASK_PORT, debug=FLASK_DEBUG)
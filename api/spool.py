@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from typing import Optional
+
+SEALED_SUFFIX = ".ndjson"
+OPEN_SUFFIX = ".open"
+CLAIMED_SUFFIX = ".claimed-"
+TMP_SUFFIX = ".tmp"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DiskSpool:
+    def __init__(self, directory: str, segment_max_bytes: int = 4 * 1024 * 1024):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.Lock()
+        self._active_path = None
+        self._active_fd = None
+        self._active_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self) -> None:
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(TMP_SUFFIX):
+                os.remove(path)
+            elif name.endswith(OPEN_SUFFIX):
+                pid = int(name[:-len(OPEN_SUFFIX)].rsplit("-", 1)[1])
+                if not _pid_alive(pid) or pid == os.getpid():
+                    os.replace(path, path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+            elif CLAIMED_SUFFIX in name:
+                base, pid = name.split(CLAIMED_SUFFIX, 1)
+                if not _pid_alive(int(pid)) or int(pid) == os.getpid():
+                    os.replace(path, os.path.join(self.directory, base))
+
+    def spill(self, events: list[bytes]) -> None:
+        if not events:
+            return
+        data = b"".join(events)
+        with self._lock:
+            if self._active_fd is None:
+                name = f"{time.time_ns():020d}-{os.getpid()}{OPEN_SUFFIX}"
+                self._active_path = os.path.join(self.directory, name)
+                self._active_fd = os.open(self._active_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self._active_bytes = 0
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._active_fd, view):]
+            os.fsync(self._active_fd)
+            self._active_bytes += len(data)
+            if self._active_bytes >= self.segment_max_bytes:
+                self._locked_seal()
+
+    def seal(self) -> None:
+        with self._lock:
+            self._locked_seal()
+
+    def _locked_seal(self) -> None:
+        if self._active_fd is None:
+            return
+        os.close(self._active_fd)
+        os.replace(self._active_path, self._active_path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self._active_fd = None
+        self._active_path = None
+        self._active_bytes = 0
+
+    def sealed_segments(self) -> list[str]:
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(SEALED_SUFFIX)
+        )
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            if self._active_fd is not None:
+                return True
+        return bool(self.sealed_segments())
+
+    def claim_oldest(self) -> Optional[str]:
+        segments = self.sealed_segments()
+        if not segments:
+            self.seal()
+            segments = self.sealed_segments()
+        for path in segments:
+            claimed = f"{path}{CLAIMED_SUFFIX}{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            return claimed
+        return None
+
+    def read(self, claimed_path: str) -> list[bytes]:
+        with open(claimed_path, "rb") as f:
+            return [line for line in f if line.endswith(b"\n") and line.strip()]
+
+    def ack(self, claimed_path: str) -> None:
+        os.remove(claimed_path)
+
+    # The remainder replaces the claimed file before it is renamed back, so a
+    # crash at any point leaves either the whole segment or the remainder
+    # under one name, never both.
+    def release(self, claimed_path: str, remaining: Optional[list[bytes]] = None) -> None:
+        base = claimed_path.split(CLAIMED_SUFFIX, 1)[0]
+        if remaining is not None:
+            tmp = claimed_path + TMP_SUFFIX
+            with open(tmp, "wb") as f:
+                f.write(b"".join(remaining))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, claimed_path)
+        os.replace(claimed_path, base)
+
+    def stats(self) -> dict:
+        total = 0
+        segments = self.sealed_segments()
+        for path in segments:
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            active_bytes = self._active_bytes
+        return {
+            "segments": len(segments) + (1 if active_bytes else 0),
+            "bytes": total + active_bytes,
+        }
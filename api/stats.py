@@ -0,0 +1,275 @@
+import heapq
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+from schema import parse_event_line
+from logs import get_logger
+from storage import log_segments, open_segment
+from config import EVENTS_FILE, STATS_ENABLED, STATS_BUCKET_SECS, STATS_RETENTION_SECS, STATS_TAIL_MS
+
+log = get_logger("stats")
+
+DIMENSIONS = (
+    "total_ms_by_channel",
+    "total_ms_by_video",
+    "total_ms_by_channel_fg",
+    "total_ms_by_channel_bg",
+    "views_by_video",
+    "views_by_channel",
+)
+COUNTERS = ("events", "ignored_no_video_ticks", "ignored_no_channel_ticks")
+
+
+def _new_bucket() -> Dict[str, Any]:
+    bucket = {dim: {} for dim in DIMENSIONS}
+    bucket.update({name: 0 for name in COUNTERS})
+    return bucket
+
+
+# Same rules as processor/aggregator.aggregate_ndjson, applied to one
+# already-validated event.
+def _apply(bucket: Dict[str, Any], ev: Dict[str, Any]) -> None:
+    bucket["events"] += 1
+    etype = ev.get("event_type")
+
+    if etype == "video_start":
+        vid = ev.get("video_id")
+        ch = ev.get("channel_name")
+        if vid:
+            views = bucket["views_by_video"]
+            views[vid] = views.get(vid, 0) + 1
+        if ch:
+            views = bucket["views_by_channel"]
+            views[ch] = views.get(ch, 0) + 1
+        return
+
+    if etype != "watch_tick":
+        return
+
+    delta = ev.get("watch_ms_delta")
+    if not isinstance(delta, int) or delta <= 0:
+        return
+
+    video_id = ev.get("video_id")
+    if not video_id:
+        bucket["ignored_no_video_ticks"] += 1
+        return
+    by_video = bucket["total_ms_by_video"]
+    by_video[video_id] = by_video.get(video_id, 0) + delta
+
+    channel = ev.get("channel_name")
+    if not channel:
+        bucket["ignored_no_channel_ticks"] += 1
+        return
+    by_channel = bucket["total_ms_by_channel"]
+    by_channel[channel] = by_channel.get(channel, 0) + delta
+
+    by_mode = bucket["total_ms_by_channel_bg" if ev.get("watch_mode") == "background" else "total_ms_by_channel_fg"]
+    by_mode[channel] = by_mode.get(channel, 0) + delta
+
+
+# Aggregates live in fixed time buckets keyed by event_ts. Buckets older than
+# the retention are dropped, so memory is bounded by retention / bucket_secs
+# buckets; events older than the retention are ignored and timestamps in the
+# future are clamped to now.
+class LiveStats:
+    def __init__(self, bucket_secs: int = STATS_BUCKET_SECS, retention_secs: int = STATS_RETENTION_SECS):
+        self.bucket_secs = bucket_secs
+        self.retention_secs = retention_secs
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add_many(self, events: Iterable[Dict[str, Any]], now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        oldest = self._bucket_start(now - self.retention_secs)
+        newest = self._bucket_start(now)
+        with self._lock:
+            for ev in events:
+                start = min(self._bucket_start(ev["event_ts"] / 1000), newest)
+                if start < oldest:
+                    continue
+                bucket = self._buckets.get(start)
+                if bucket is None:
+                    bucket = self._buckets[start] = _new_bucket()
+                _apply(bucket, ev)
+            self._locked_evict(oldest)
+
+    def query(self, window_secs: Optional[int] = None, top_n: int = 10, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.time() if now is None else now
+        window_secs = self.retention_secs if window_secs is None else min(window_secs, self.retention_secs)
+        since = self._bucket_start(now - window_secs)
+        merged = _new_bucket()
+        with self._lock:
+            self._locked_evict(self._bucket_start(now - self.retention_secs))
+            buckets = [b for start, b in self._buckets.items() if start >= since]
+            for bucket in buckets:
+                for dim in DIMENSIONS:
+                    target = merged[dim]
+                    for key, value in bucket[dim].items():
+                        target[key] = target.get(key, 0) + value
+                for name in COUNTERS:
+                    merged[name] += bucket[name]
+
+        def top(dim: str) -> list:
+            items = merged[dim].items()
+            return [[k, v] for k, v in heapq.nlargest(top_n, items, key=lambda kv: kv[1])]
+
+        return {
+            "window_secs": window_secs,
+            "from_ts": since * 1000,
+            "to_ts": int(now * 1000),
+            "totals": {dim: top(dim) for dim in DIMENSIONS[:4]},
+            "views": {dim: top(dim) for dim in DIMENSIONS[4:]},
+            "metrics": {name: merged[name] for name in COUNTERS},
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+    def _bucket_start(self, ts_secs: float) -> int:
+        return int(ts_secs // self.bucket_secs * self.bucket_secs)
+
+    def _locked_evict(self, oldest: int) -> None:
+        for start in [s for s in self._buckets if s < oldest]:
+            del self._buckets[start]
+
+
+# The log is written with compact JSON, so event_ts can be read without a
+# full parse; lines older than the retention are skipped before parsing.
+_EVENT_TS = re.compile(r'"event_ts":(\d+)[,}]')
+
+
+def _cutoff_ms(stats: LiveStats, now: float) -> int:
+    return stats._bucket_start(now - stats.retention_secs) * 1000
+
+
+def _load_lines(stats: LiveStats, lines: Iterable[str], cutoff_ms: int, chunk_events: int, now: float) -> tuple:
+    loaded = skipped = 0
+    pending = []
+    for line in lines:
+        m = _EVENT_TS.search(line)
+        if m and int(m.group(1)) < cutoff_ms:
+            skipped += 1
+            continue
+        ev = parse_event_line(line)
+        if ev is None:
+            continue
+        pending.append(ev)
+        if len(pending) >= chunk_events:
+            stats.add_many(pending, now=now)
+            loaded += len(pending)
+            pending = []
+    stats.add_many(pending, now=now)
+    loaded += len(pending)
+    return loaded, skipped
+
+
+def rebuild_from_log(
+    stats: LiveStats,
+    path: str = EVENTS_FILE,
+    chunk_events: int = 10000,
+    now: Optional[float] = None,
+    include_active: bool = True,
+) -> int:
+    now = time.time() if now is None else now
+    cutoff = stats._bucket_start(now - stats.retention_secs)
+    paths = log_segments(path, since=cutoff)
+    if include_active and os.path.exists(path):
+        paths.append(path)
+    loaded = skipped = 0
+    for segment in paths:
+        try:
+            f = open_segment(segment)
+        except (OSError, ValueError) as e:
+            log.error("Skipping %s while rebuilding live stats: %r", segment, e)
+            continue
+        with f:
+            counts = _load_lines(stats, f, cutoff * 1000, chunk_events, now)
+        loaded += counts[0]
+        skipped += counts[1]
+    log.info(
+        "Live stats rebuilt from %s",
+        path,
+        extra={"fields": {"events": loaded, "skipped_old": skipped, "files": len(paths)}},
+    )
+    return loaded
+
+
+# Every worker follows the shared local log instead of counting only the
+# events it accepted itself, so /stats gives the same answer whichever
+# worker serves it, at most STATS_TAIL_MS plus the log's group-commit delay
+# behind. A rotated file is read to its end through the still-open handle
+# before the new one is opened.
+class LogTailer:
+    def __init__(self, stats: LiveStats, path: str = EVENTS_FILE, interval_ms: int = STATS_TAIL_MS):
+        self.stats = stats
+        self.path = path
+        self.interval_ms = interval_ms
+        self._file = None
+        self._partial = b""
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._tail_loop, name="stats-log-tailer", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        loaded = 0
+        with self._lock:
+            while True:
+                if self._file is None:
+                    try:
+                        self._file = open(self.path, "rb")
+                    except FileNotFoundError:
+                        return loaded
+                    self._partial = b""
+                loaded += self._locked_read(now)
+                try:
+                    rotated = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+                except FileNotFoundError:
+                    rotated = True
+                if not rotated:
+                    return loaded
+                loaded += self._locked_read(now)
+                self._file.close()
+                self._file = None
+
+    def _locked_read(self, now: float) -> int:
+        data = self._file.read()
+        if not data:
+            return 0
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        text = (line.decode("utf-8", errors="replace") for line in lines)
+        return _load_lines(self.stats, text, _cutoff_ms(self.stats, now), 10000, now)[0]
+
+    def _tail_loop(self) -> None:
+        while not self._stop.wait(self.interval_ms / 1000):
+            try:
+                self.poll()
+            except Exception as e:
+                log.error("Live stats tail of %s failed: %r", self.path, e)
+
+
+live_stats = LiveStats()
+log_tailer = LogTailer(live_stats)
+
+
+def rebuild_live_stats() -> None:
+    if STATS_ENABLED:
+        rebuild_from_log(live_stats, include_active=False)
+        log_tailer.poll()
+        log_tailer.start()
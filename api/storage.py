@@ -1,8 +1,258 @@
-import json
-from config import EVENTS_FILE
+import glob
+import gzip
+import io
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from codec import dumps_line
+from logs import get_logger
+import metrics
+from config import (
+    EVENTS_FILE,
+    LOCAL_LOG_FLUSH_LINES,
+    LOCAL_LOG_FLUSH_MS,
+    LOCAL_LOG_FSYNC,
+    LOCAL_LOG_FSYNC_INTERVAL_MS,
+    LOCAL_LOG_ROTATE_BYTES,
+    LOCAL_LOG_ROTATE_SECS,
+    LOCAL_LOG_COMPRESSION,
+)
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def append_local_ndjson(event_dict: dict) -> None:
-    with open(EVENTS_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(event_dict, ensure_ascii=False) + "\n")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = get_logger("storage")
+
+write_latency = metrics.histogram("local_log_write_seconds", "Local NDJSON log group-commit write time")
+
+FSYNC_POLICIES = ("none", "batch", "interval")
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+
+class NdjsonLogWriter:
+    def __init__(
+        self,
+        path: str,
+        flush_lines: int = 256,
+        flush_ms: int = 200,
+        fsync: str = "none",
+        fsync_interval_ms: int = 1000,
+        rotate_bytes: int = 0,
+        rotate_secs: int = 0,
+        compression: str = "none",
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {COMPRESSIONS}, got {compression!r}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("compression=zstd requires the zstandard package")
+
+        self.path = path
+        self.flush_lines = max(1, flush_lines)
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+        self.fsync_interval_ms = fsync_interval_ms
+        self.rotate_bytes = rotate_bytes
+        self.rotate_secs = rotate_secs
+        self.compression = compression
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._fd = None
+        self._inode = None
+        self._opened_at = 0.0
+        self._last_fsync = time.time()
+        self._closed = threading.Event()
+        self._ticker = None
+        self._lock_fd = os.open(path + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+
+    def start(self) -> None:
+        if self._ticker is None and self.flush_ms > 0:
+            self._ticker = threading.Thread(target=self._tick_loop, name="ndjson-log-writer", daemon=True)
+            self._ticker.start()
+
+    def append(self, line: bytes) -> None:
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.flush_lines:
+                self._locked_commit()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._locked_commit()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._ticker is not None:
+            self._ticker.join()
+        with self._lock:
+            self._locked_commit()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _tick_loop(self) -> None:
+        while not self._closed.wait(self.flush_ms / 1000):
+            try:
+                self.flush()
+            except OSError as e:
+                log.error("Local log flush failed: %r", e)
+
+    # Everything below runs with self._lock held.
+    def _locked_commit(self) -> None:
+        due_fsync = self.fsync == "interval" and (time.time() - self._last_fsync) * 1000 >= self.fsync_interval_ms
+        if not self._buffer and not due_fsync:
+            return
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+
+        started = time.perf_counter()
+        if fcntl is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            self._locked_reopen_if_rotated()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            if self.fsync == "batch" or due_fsync:
+                os.fsync(self._fd)
+                self._last_fsync = time.time()
+            self._locked_rotate_if_due()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            write_latency.observe(time.perf_counter() - started)
+
+    def _locked_open(self) -> None:
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        self._opened_at = time.time()
+
+    def _locked_reopen_if_rotated(self) -> None:
+        if self._fd is not None:
+            try:
+                if os.stat(self.path).st_ino == self._inode:
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+        self._locked_open()
+
+    def _locked_rotate_if_due(self) -> None:
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            return
+        by_size = self.rotate_bytes > 0 and size >= self.rotate_bytes
+        by_age = self.rotate_secs > 0 and time.time() - self._opened_at >= self.rotate_secs
+        if not (by_size or by_age):
+            return
+
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        base, ext = os.path.splitext(self.path)
+        segment = f"{base}-{stamp}-{os.getpid()}{ext}"
+        os.rename(self.path, segment)
+        os.close(self._fd)
+        self._locked_open()
 
+        if self.compression != "none":
+            threading.Thread(target=compress_segment, args=(segment, self.compression), daemon=True).start()
+
+
+def _open_compressed(path: str, compression: str):
+    if compression == "gzip":
+        return gzip.open(path, "wb")
+    return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+
+
+def compress_segment(path: str, compression: str) -> str:
+    out_path = path + (".gz" if compression == "gzip" else ".zst")
+    tmp_path = out_path + ".tmp"
+    try:
+        with open(path, "rb") as src, _open_compressed(tmp_path, compression) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, out_path)
+        os.remove(path)
+    except OSError as e:
+        log.error("Compressing %s failed: %r", path, e)
+        return path
+    return out_path
+
+
+# Rotated segments of `path` last written at or after `since` (epoch
+# seconds), oldest first. A segment whose compressed copy was finished but
+# not yet cleaned up is listed once, uncompressed.
+def log_segments(path: str, since: float = 0) -> list[str]:
+    base, ext = os.path.splitext(path)
+    found = []
+    for segment in glob.glob(f"{glob.escape(base)}-*{ext}*"):
+        raw, suffix = os.path.splitext(segment)
+        if suffix in (".gz", ".zst"):
+            if os.path.exists(raw):
+                continue
+        elif suffix != ext:
+            continue
+        try:
+            mtime = os.path.getmtime(segment)
+        except FileNotFoundError:
+            continue
+        if mtime >= since:
+            found.append((mtime, segment))
+    return [segment for _, segment in sorted(found)]
+
+
+def open_segment(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError(f"Reading {path} requires the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_local_log_writer() -> NdjsonLogWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = NdjsonLogWriter(
+                    EVENTS_FILE,
+                    flush_lines=LOCAL_LOG_FLUSH_LINES,
+                    flush_ms=LOCAL_LOG_FLUSH_MS,
+                    fsync=LOCAL_LOG_FSYNC,
+                    fsync_interval_ms=LOCAL_LOG_FSYNC_INTERVAL_MS,
+                    rotate_bytes=LOCAL_LOG_ROTATE_BYTES,
+                    rotate_secs=LOCAL_LOG_ROTATE_SECS,
+                    compression=LOCAL_LOG_COMPRESSION,
+                )
+                writer.start()
+                _writer = writer
+    return _writer
+
+
+def close_local_log() -> None:
+    if _writer is not None:
+        _writer.close()
+
+
+def append_local_line(line: bytes) -> None:
+    get_local_log_writer().append(line)
+
+
+def append_local_ndjson(event_dict: dict) -> None:
+    append_local_line(dumps_line(event_dict))
@@ -3,11 +3,59 @@ from unittest.mock import Mock, patch, MagicMock
 import json
 import sys
 import os
+import gzip
+import logging
+import tempfile
+import threading
+import time
 
 sys.path.insert(0, os.path.dirname(__file__))
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="api-test-data-")
 
 from routes import register_routes
 from flask import Flask
+import firehose_client
+from botocore.exceptions import EndpointConnectionError
+from storage import NdjsonLogWriter, compress_segment
+from ingest_body import LineTooLong, iter_lines
+from spool import DiskSpool
+from schema import validate_event, validate_events
+from codec import dumps_line
+from dedup import BloomFilter, EventIdDeduper, event_ids as dedup_event_ids
+import metrics
+from coalesce import TickCoalescer
+from stats import LiveStats, LogTailer, live_stats, rebuild_from_log
+import stats as stats_module
+from logs import SamplingFilter, JsonFormatter, parse_sample_rates
+
+
+def make_event(**overrides):
+    event = {
+        "schema": 1,
+        "event_id": "test-123",
+        "event_ts": 1234567890,
+        "event_type": "video_start",
+        "client_session_id": "test-session",
+        "tab_id": "test-tab",
+        "video_id": "test-video-123",
+        "video_session_id": "test-video-session"
+    }
+    event.update(overrides)
+    return event
+
+
+def make_line(**overrides):
+    return dumps_line(make_event(**overrides))
+
+
+def make_tick(event_id, event_ts, delta, **overrides):
+    tick = {"event_type": "watch_tick", "watch_ms_delta": delta, "channel_name": "chan", "watch_mode": "foreground"}
+    tick.update(overrides)
+    return make_event(event_id=event_id, event_ts=event_ts, **tick)
+
+
+def event_ids(lines):
+    return [json.loads(line)["event_id"] for line in lines]
 
 
 class TestAPIServer(unittest.TestCase):
@@ -16,9 +64,13 @@ class TestAPIServer(unittest.TestCase):
         self.app = Flask(__name__)
         register_routes(self.app)
         self.client = self.app.test_client()
+        firehose_client.batcher._batch.clear()
+        dedup_event_ids.reset()
+        metrics.reset()
+        live_stats.reset()
 
     @patch('firehose_client.send_batch')
-    @patch('storage.append_local_ndjson')
+    @patch('routes.append_local_line')
     def test_ingest_valid_event(self, mock_append, mock_send_batch):
         event = {
             "schema": 1,
@@ -40,6 +92,302 @@ class TestAPIServer(unittest.TestCase):
         self.assertEqual(data['accepted'], 1)
         self.assertEqual(data['rejected'], 0)
 
+    @patch('firehose_client.send_batch')
+    @patch('routes.append_local_line')
+    def test_ingest_does_not_flush_inline(self, mock_append, mock_send_batch):
+        response = self.client.post('/ingest', json={"events": [make_event()]})
+
+        self.assertEqual(response.status_code, 200)
+        mock_send_batch.assert_not_called()
+        self.assertEqual(firehose_client.queue_depth(), 1)
+
+    @patch('routes.append_local_line')
+    def test_ingest_serializes_each_event_once(self, mock_append):
+        response = self.client.post('/ingest', json={"events": [make_event()]})
+
+        self.assertEqual(response.status_code, 200)
+        line = mock_append.call_args.args[0]
+        self.assertIs(line, firehose_client.batcher._batch[0])
+        self.assertEqual(json.loads(line), make_event())
+
+    @patch.object(firehose_client.batcher, 'queue_max_records', 1)
+    @patch('routes.append_local_line')
+    def test_ingest_queue_full(self, mock_append):
+        events = [make_event(event_id="e1"), make_event(event_id="e2")]
+        response = self.client.post('/ingest', json={"events": events})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        data = json.loads(response.data)
+        self.assertEqual(data['accepted'], 1)
+        self.assertEqual(mock_append.call_count, 1)
+
+    @patch('routes.INGEST_BUFFER_WATERMARK', 1)
+    @patch('routes.append_local_line')
+    def test_ingest_backpressure_over_watermark(self, mock_append):
+        self.client.post('/ingest', json={"events": [make_event(event_id="e1")]})
+        response = self.client.post('/ingest', json={"events": [make_event(event_id="e2")]})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], str(json.loads(response.data)['retry_after']))
+        health = json.loads(self.client.get('/health').data)
+        self.assertEqual(health['buffer']['queue_depth'], 1)
+        self.assertEqual(health['buffer']['watermark'], 1)
+
+    @patch('routes.INGEST_MAX_EVENTS', 2)
+    def test_ingest_rejects_too_many_events(self):
+        events = [make_event(event_id=f"e{i}") for i in range(3)]
+        response = self.client.post('/ingest', json={"events": events})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(firehose_client.queue_depth(), 0)
+
+    def test_ingest_rejects_oversized_body(self):
+        self.app.config["MAX_CONTENT_LENGTH"] = 100
+        with patch('routes.INGEST_MAX_BYTES', 100):
+            response = self.client.post('/ingest', json={"events": [make_event()]})
+        self.assertEqual(response.status_code, 413)
+
+    @patch('firehose_client.send_batch')
+    def test_flusher_drains_on_stop(self, mock_send_batch):
+        firehose_client.start_flusher()
+        for i in range(3):
+            firehose_client.add_event(make_line(event_id=f"e{i}"))
+        firehose_client.stop_flusher()
+
+        sent = [line for call in mock_send_batch.call_args_list for line in call.args[0]]
+        self.assertEqual(event_ids(sent), ["e0", "e1", "e2"])
+        self.assertEqual(firehose_client.queue_depth(), 0)
+
+    @patch('firehose_client.send_batch')
+    def test_batcher_is_safe_under_concurrent_producers(self, mock_send_batch):
+        with tempfile.TemporaryDirectory() as tmp:
+            batcher = firehose_client.FirehoseBatcher(DiskSpool(tmp), max_records=7, flush_ms=1)
+            batcher.start()
+
+            def produce(worker):
+                for i in range(200):
+                    while not batcher.add(make_line(event_id=f"w{worker}-{i}")):
+                        time.sleep(0.001)
+
+            threads = [threading.Thread(target=produce, args=(w,)) for w in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            batcher.stop()
+
+        sent = [line for call in mock_send_batch.call_args_list for line in call.args[0]]
+        self.assertEqual(len(sent), 1600)
+        self.assertEqual(len(set(event_ids(sent))), 1600)
+        self.assertTrue(all(len(call.args[0]) <= 7 for call in mock_send_batch.call_args_list))
+        self.assertEqual(batcher.depth(), 0)
+
+    @patch('firehose_client.firehose')
+    def test_send_batch_splits_on_record_and_byte_limits(self, mock_firehose):
+        mock_firehose.put_record_batch.return_value = {"FailedPutCount": 0}
+        firehose_client.send_batch([make_line(event_id=f"e{i}") for i in range(501)])
+        sizes = [len(c.kwargs["Records"]) for c in mock_firehose.put_record_batch.call_args_list]
+        self.assertEqual(sizes, [500, 1])
+
+        mock_firehose.put_record_batch.reset_mock()
+        big = "x" * (900 * 1024)
+        firehose_client.send_batch([make_line(event_id=f"e{i}", pad=big) for i in range(5)])
+        sizes = [len(c.kwargs["Records"]) for c in mock_firehose.put_record_batch.call_args_list]
+        self.assertEqual(sizes, [4, 1])
+
+    @patch('firehose_client.FIREHOSE_AGGREGATE_MAX_BYTES', 1024)
+    @patch('firehose_client.FIREHOSE_AGGREGATE_RECORDS', True)
+    @patch('firehose_client.firehose')
+    def test_send_batch_aggregates_events_into_records(self, mock_firehose):
+        mock_firehose.put_record_batch.return_value = {"FailedPutCount": 0}
+        lines = [make_line(event_id=f"e{i}") for i in range(20)]
+        firehose_client.send_batch(lines)
+
+        records = mock_firehose.put_record_batch.call_args.kwargs["Records"]
+        self.assertLess(len(records), len(lines))
+        self.assertTrue(all(len(r["Data"]) <= 1024 for r in records))
+        self.assertEqual(b"".join(r["Data"] for r in records), b"".join(lines))
+
+    @patch('firehose_client._backoff')
+    @patch('firehose_client.firehose')
+    def test_send_batch_retries_only_failed_records(self, mock_firehose, mock_backoff):
+        mock_firehose.put_record_batch.side_effect = [
+            {"FailedPutCount": 1, "RequestResponses": [
+                {"RecordId": "r0"},
+                {"ErrorCode": "ServiceUnavailableException"},
+                {"RecordId": "r2"},
+            ]},
+            {"FailedPutCount": 0, "RequestResponses": [{"RecordId": "r1"}]},
+        ]
+        before = firehose_client.get_stats()
+        firehose_client.send_batch([make_line(event_id=f"e{i}") for i in range(3)])
+
+        retried = mock_firehose.put_record_batch.call_args_list[1].kwargs["Records"]
+        self.assertEqual(len(retried), 1)
+        self.assertEqual(json.loads(retried[0]["Data"])["event_id"], "e1")
+        after = firehose_client.get_stats()
+        self.assertEqual(after["retry_attempts"] - before["retry_attempts"], 1)
+        self.assertEqual(after["records_sent"] - before["records_sent"], 3)
+
+    @patch('firehose_client.FIREHOSE_MAX_RETRIES', 0)
+    @patch('firehose_client.firehose')
+    def test_flush_requeues_only_unsent_records(self, mock_firehose):
+        mock_firehose.put_record_batch.return_value = {"FailedPutCount": 1, "RequestResponses": [
+            {"RecordId": "r0"},
+            {"ErrorCode": "InternalFailure"},
+        ]}
+        firehose_client.add_event(make_line(event_id="ok"))
+        firehose_client.add_event(make_line(event_id="failed"))
+
+        with self.assertRaises(firehose_client.FirehoseSendError):
+            firehose_client.flush(force=True)
+        self.assertEqual(event_ids(firehose_client.batcher._batch), ["failed"])
+
+    @patch('routes.append_local_line')
+    def test_ingest_reports_duplicate_event_ids(self, mock_append):
+        events = [make_event(event_id="e1"), make_event(event_id="e1"), make_event(event_id="e2")]
+        data = json.loads(self.client.post('/ingest', json={"events": events}).data)
+        self.assertEqual((data['accepted'], data['duplicates']), (2, 1))
+
+        data = json.loads(self.client.post('/ingest', json={"events": events[:1]}).data)
+        self.assertEqual((data['accepted'], data['duplicates']), (0, 1))
+        self.assertEqual(firehose_client.queue_depth(), 2)
+        self.assertEqual(dedup_event_ids.stats()["duplicates"], 2)
+
+    @patch.object(firehose_client.batcher, 'queue_max_records', 0)
+    @patch('routes.append_local_line')
+    def test_ingest_does_not_remember_unqueued_events(self, mock_append):
+        self.client.post('/ingest', json={"events": [make_event(event_id="e1")]})
+        self.assertTrue(dedup_event_ids.reserve("e1"))
+
+    @patch('routes.append_local_line')
+    def test_ingest_logs_one_summary_per_request(self, mock_append):
+        events = [make_event(event_id="e1"), {"bad": 1}, {"bad": 2}, make_event(event_id="e1")]
+        with self.assertLogs('api.ingest', level='INFO') as captured:
+            self.client.post('/ingest', json={"events": events})
+
+        self.assertEqual(len(captured.records), 1)
+        fields = captured.records[0].fields
+        self.assertEqual((fields["accepted"], fields["rejected"], fields["duplicates"]), (1, 2, 1))
+        self.assertEqual(fields["rejected_by_reason"], {"missing schema": 2})
+
+    @patch('routes.append_local_line')
+    def test_ingest_accepts_gzip_json_body(self, mock_append):
+        body = gzip.compress(json.dumps({"events": [make_event(event_id="e1"), {}]}).encode())
+        response = self.client.post('/ingest', data=body, content_type='application/json',
+                                    headers={'Content-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual((data['accepted'], data['rejected']), (1, 1))
+        self.assertEqual(event_ids(firehose_client.batcher._batch), ["e1"])
+
+    @patch('routes.append_local_line')
+    def test_ingest_streams_gzip_ndjson_with_per_line_errors(self, mock_append):
+        lines = [json.dumps(make_event(event_id="e1")), "not json", "", json.dumps(make_event(event_id="e2", schema=2)),
+                 json.dumps(make_event(event_id="e3"))]
+        body = gzip.compress("\n".join(lines).encode())
+        response = self.client.post('/ingest', data=body, content_type='application/x-ndjson',
+                                    headers={'Content-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual(data['errors'], [{"index": 1, "error": "invalid JSON"},
+                                          {"index": 2, "error": "unsupported schema"}])
+        self.assertEqual(event_ids(firehose_client.batcher._batch), ["e1", "e3"])
+
+    def test_ingest_caps_decoded_gzip_size(self):
+        body = gzip.compress(b"\n" * (64 * 1024))
+        with patch('routes.INGEST_MAX_DECODED_BYTES', 1024):
+            response = self.client.post('/ingest', data=body, content_type='application/x-ndjson',
+                                        headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 413)
+
+    @patch('routes.append_local_line')
+    def test_ingest_reads_every_gzip_member(self, mock_append):
+        body = b"".join(gzip.compress(json.dumps(make_event(event_id=f"e{i}")).encode() + b"\n") for i in range(3))
+        response = self.client.post('/ingest', data=body, content_type='application/x-ndjson',
+                                    headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(json.loads(response.data)['accepted'], 3)
+        self.assertEqual(event_ids(firehose_client.batcher._batch), ["e0", "e1", "e2"])
+
+    def test_ingest_rejects_overlong_ndjson_line(self):
+        with patch('routes.INGEST_MAX_LINE_BYTES', 1024):
+            response = self.client.post('/ingest', data=b"x" * (256 * 1024), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("line exceeds 1024", json.loads(response.data)['error'])
+
+    def test_iter_lines_joins_lines_across_chunks(self):
+        chunks = [b"ab", b"c\nde", b"", b"f\n\n", b"g"]
+        self.assertEqual(list(iter_lines(iter(chunks), 3)), [b"abc", b"def", b"g"])
+        with self.assertRaises(LineTooLong):
+            list(iter_lines(iter([b"ab", b"cd\n"]), 3))
+
+    def test_ingest_rejects_bad_encodings(self):
+        response = self.client.post('/ingest', data=b"{}", content_type='application/json',
+                                    headers={'Content-Encoding': 'br'})
+        self.assertEqual(response.status_code, 415)
+        response = self.client.post('/ingest', data=gzip.compress(b'{"events": []}')[:-6],
+                                    content_type='application/x-ndjson', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 400)
+
+    @patch('routes.COALESCE_TICKS', True)
+    @patch('routes.append_local_line')
+    def test_ingest_coalesces_ticks_and_passes_other_events(self, mock_append):
+        out = []
+        with patch('routes.ticks', TickCoalescer(lambda line: out.append(line) or True)) as coalescer:
+            events = [make_tick("t1", 1000, 500), make_event(event_id="s1"), make_tick("t2", 2000, 700)]
+            data = json.loads(self.client.post('/ingest', json={"events": events}).data)
+            coalescer.flush(force=True)
+
+        self.assertEqual(data['accepted'], 3)
+        self.assertEqual(mock_append.call_count, 3)
+        self.assertEqual(event_ids(firehose_client.batcher._batch), ["s1"])
+        merged = [json.loads(line) for line in out]
+        self.assertEqual(len(merged), 1)
+        self.assertEqual((merged[0]["event_id"], merged[0]["event_ts"], merged[0]["last_event_ts"]), ("t1", 1000, 2000))
+        self.assertEqual((merged[0]["watch_ms_delta"], merged[0]["coalesced_count"]), (1200, 2))
+
+    @patch('routes.COALESCE_TICKS', True)
+    @patch('routes.append_local_line')
+    def test_ingest_reports_queue_full_when_coalescer_is_at_cap(self, mock_append):
+        coalescer = TickCoalescer(lambda line: False, max_groups=1)
+        with patch('routes.ticks', coalescer):
+            events = [make_tick("t1", 1000, 500), make_tick("t2", 1000, 500, video_session_id="other")]
+            response = self.client.post('/ingest', json={"events": events})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)['accepted'], 1)
+        self.assertEqual(coalescer.pending(), 1)
+        self.assertTrue(dedup_event_ids.reserve("t2"))
+
+    def test_stats_endpoint_serves_live_aggregates(self):
+        now_ms = int(time.time() * 1000)
+        events = [
+            make_event(event_id="s1", event_ts=now_ms, channel_name="chan"),
+            make_tick("t1", now_ms, 400, video_id="v1"),
+            make_tick("t2", now_ms, 300, video_id="v2", watch_mode="background"),
+            make_tick("t3", now_ms, 200, video_id="v1"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = NdjsonLogWriter(os.path.join(tmp, "events.ndjson"), flush_lines=1000, flush_ms=0)
+            tailer = LogTailer(live_stats, writer.path)
+            with patch('routes.append_local_line', writer.append):
+                self.client.post('/ingest', json={"events": events})
+            self.assertEqual(tailer.poll(), 0)
+            writer.flush()
+            self.assertEqual(tailer.poll(), 4)
+            writer.close()
+
+        data = json.loads(self.client.get('/stats?window=600&top=1').data)
+        self.assertEqual(data['totals']['total_ms_by_video'], [["v1", 600]])
+        self.assertEqual(data['totals']['total_ms_by_channel'], [["chan", 900]])
+        self.assertEqual(data['totals']['total_ms_by_channel_bg'], [["chan", 300]])
+        self.assertEqual(data['views']['views_by_channel'], [["chan", 1]])
+        self.assertEqual(data['metrics']['events'], 4)
+        self.assertEqual(self.client.get('/stats?top=abc').status_code, 400)
+
     def test_ingest_invalid_json(self):
         response = self.client.post('/ingest',
                                    data='invalid json',
@@ -62,11 +410,439 @@ class TestAPIServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertTrue(data['ok'])
 
+    @patch('routes.append_local_line')
+    def test_metrics_endpoint(self, mock_append):
+        self.client.post('/ingest', json={"events": [make_event(event_id="e1"), make_event(event_id="e2"), {}]})
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn("# TYPE ingest_request_seconds histogram", body)
+        self.assertIn("ingest_request_seconds_count 1", body)
+        self.assertIn('ingest_request_events_bucket{le="5"} 1', body)
+        self.assertIn("ingest_events_accepted_total 2", body)
+        self.assertIn("ingest_events_rejected_total 1", body)
+        self.assertIn("firehose_queue_depth 2", body)
+
     def test_ingest_options(self):
         response = self.client.options('/ingest')
         self.assertEqual(response.status_code, 204)
 
 
+class TestSchema(unittest.TestCase):
+    def test_validate_event_error_messages(self):
+        cases = [
+            ({}, "missing schema"),
+            (make_event(schema=2), "unsupported schema"),
+            (make_event(event_id="  "), "invalid event_id"),
+            (make_event(event_ts=True), "event_ts must be int (epoch ms)"),
+            (make_event(event_type="bogus"), "invalid event_type"),
+            (make_event(event_type=["bogus"]), "invalid event_type"),
+            (make_event(event_type="watch_tick"), "missing watch_ms_delta for watch_tick"),
+            (make_event(event_type="watch_tick", watch_ms_delta=60_001), "watch_ms_delta must be int 0..60000"),
+            (make_event(event_type="watch_tick", watch_ms_delta=5, watch_mode="pip"),
+             "watch_mode must be foreground|background (or omitted)"),
+            (make_event(video_session_id=""), "video_session_id must be non-empty string"),
+            (make_event(event_type="visibility_change", is_visible=1), "is_visible must be boolean"),
+        ]
+        for event, expected in cases:
+            self.assertEqual(validate_event(event), (False, expected))
+        self.assertEqual(validate_event(make_event(event_type="watch_tick", watch_ms_delta=0)), (True, None))
+
+    def test_validate_events_returns_accepted_and_indexed_errors(self):
+        events = [make_event(), "nope", make_event(tab_id=""), make_event(event_id="e2")]
+        accepted, errors = validate_events(events)
+
+        self.assertEqual([ev["event_id"] for ev in accepted], ["test-123", "e2"])
+        self.assertEqual(errors, [
+            {"index": 1, "error": "event is not an object"},
+            {"index": 2, "error": "invalid tab_id"},
+        ])
+
+
+class TestDedup(unittest.TestCase):
+    def test_bloom_filter_false_positive_rate(self):
+        bloom = BloomFilter(10_000, 0.01)
+        for i in range(10_000):
+            bloom.add(bloom.positions(f"in-{i}"))
+        false_positives = sum(bloom.contains(bloom.positions(f"out-{i}")) for i in range(10_000))
+        self.assertLess(false_positives / 10_000, 0.02)
+
+    def test_deduper_forgets_after_two_rotations(self):
+        deduper = EventIdDeduper(capacity=2, fp_rate=0.001, window_secs=3600)
+        deduper.remember("a")
+        deduper.remember("b")
+        deduper.remember("c")
+        self.assertFalse(deduper.reserve("a"))
+        deduper.remember("d")
+        deduper.remember("e")
+        self.assertTrue(deduper.reserve("a"))
+        self.assertFalse(deduper.reserve("e"))
+
+    def test_deduper_file_is_shared_between_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dedup.bloom")
+            first = EventIdDeduper(capacity=1000, fp_rate=0.001, window_secs=3600, path=path)
+            second = EventIdDeduper(capacity=1000, fp_rate=0.001, window_secs=3600, path=path)
+            self.assertTrue(first.reserve("a"))
+            first.remember("a")
+            self.assertFalse(second.reserve("a"))
+            self.assertTrue(second.reserve("b"))
+            second.remember("b")
+            self.assertFalse(EventIdDeduper(capacity=1000, fp_rate=0.001, window_secs=3600, path=path).reserve("b"))
+            self.assertTrue(second.stats()["shared"])
+
+    def test_reserve_admits_one_concurrent_offer_per_id(self):
+        deduper = EventIdDeduper(capacity=1000, fp_rate=0.001, window_secs=3600)
+        barrier = threading.Barrier(8)
+        admitted = []
+
+        def offer():
+            barrier.wait()
+            if deduper.reserve("same"):
+                admitted.append(1)
+
+        workers = [threading.Thread(target=offer) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(deduper.stats()["duplicates"], 7)
+
+        deduper.release("same")
+        self.assertTrue(deduper.reserve("same"))
+        deduper.remember("same")
+        self.assertFalse(deduper.reserve("same"))
+
+
+class TestLogging(unittest.TestCase):
+    def make_record(self, name, level):
+        return logging.LogRecord(name, level, __file__, 1, "msg %s", ("x",), None)
+
+    def test_sampling_filter_drops_sampled_categories_only(self):
+        rates = parse_sample_rates("ingest=0, firehose=1")
+        self.assertEqual(rates, {"ingest": 0.0, "firehose": 1.0})
+        sampler = SamplingFilter(rates)
+
+        self.assertFalse(sampler.filter(self.make_record("api.ingest", logging.INFO)))
+        self.assertTrue(sampler.filter(self.make_record("api.ingest", logging.WARNING)))
+        self.assertTrue(sampler.filter(self.make_record("api.firehose", logging.INFO)))
+        self.assertTrue(sampler.filter(self.make_record("api.storage", logging.DEBUG)))
+
+    def test_json_formatter_includes_fields(self):
+        record = self.make_record("api.ingest", logging.INFO)
+        record.fields = {"accepted": 3}
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry["msg"], entry["level"], entry["accepted"]), ("msg x", "INFO", 3))
+
+
+class TestTickCoalescer(unittest.TestCase):
+    def totals(self, events):
+        out = {}
+        for ev in events:
+            key = (ev["video_id"], ev.get("channel_name"), ev.get("watch_mode"))
+            out[key] = out.get(key, 0) + ev["watch_ms_delta"]
+        return out
+
+    def test_coalescing_preserves_totals(self):
+        out = []
+        coalescer = TickCoalescer(lambda line: out.append(line) or True, window_ms=60_000)
+        ticks = []
+        for i in range(300):
+            ticks.append(make_tick(f"t{i}", 1000 + i, i % 7 * 100, video_session_id=f"vs{i % 3}", video_id=f"v{i % 3}",
+                                   watch_mode=("foreground", "background")[i % 2]))
+        for tick in ticks:
+            coalescer.add(dict(tick))
+        self.assertEqual(coalescer.flush(), 0)
+        coalescer.flush(force=True)
+
+        merged = [json.loads(line) for line in out]
+        self.assertEqual(len(merged), 6)
+        self.assertEqual(sum(m["coalesced_count"] for m in merged), 300)
+        self.assertEqual(self.totals(merged), self.totals(ticks))
+
+    def test_overflow_and_refused_groups(self):
+        accept = [True]
+        out = []
+        coalescer = TickCoalescer(lambda line: accept[0] and (out.append(line) or True), window_ms=60_000, max_groups=2)
+        for i in range(3):
+            coalescer.add(make_tick(f"t{i}", 1000, 100, video_session_id=f"vs{i}"))
+        self.assertEqual(event_ids(out), ["t0"])
+
+        accept[0] = False
+        self.assertEqual(coalescer.flush(force=True), 0)
+        self.assertEqual(coalescer.pending(), 2)
+        self.assertFalse(coalescer.add(make_tick("t3", 1000, 100, video_session_id="vs3")))
+        self.assertTrue(coalescer.add(make_tick("t4", 1000, 100, video_session_id="vs2")))
+        self.assertEqual(coalescer.pending(), 2)
+        accept[0] = True
+        coalescer.close()
+        self.assertEqual(event_ids(out), ["t0", "t1", "t2"])
+
+
+class TestLiveStats(unittest.TestCase):
+    def test_windows_and_eviction(self):
+        stats = LiveStats(bucket_secs=60, retention_secs=3600)
+        now = 1_700_000_000
+        stats.add_many([
+            make_tick("old", (now - 7200) * 1000, 100, video_id="v1"),
+            make_tick("hour", (now - 1800) * 1000, 200, video_id="v1"),
+            make_tick("recent", (now - 30) * 1000, 300, video_id="v2"),
+            make_tick("future", (now + 600) * 1000, 400, video_id="v2"),
+        ], now=now)
+
+        full = stats.query(now=now)
+        self.assertEqual(full['totals']['total_ms_by_video'], [["v2", 700], ["v1", 200]])
+        recent = stats.query(window_secs=120, now=now)
+        self.assertEqual(recent['totals']['total_ms_by_video'], [["v2", 700]])
+
+        later = stats.query(now=now + 2000)
+        self.assertEqual(later['totals']['total_ms_by_video'], [["v2", 700]])
+
+    def test_rebuild_from_log(self):
+        now_ms = int(time.time() * 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "events.ndjson")
+            with open(path, "wb") as f:
+                f.write(dumps_line(make_tick("t1", now_ms, 250, video_id="v1")))
+                f.write(b"not json\n")
+                f.write(dumps_line(make_event(event_id="s1", event_ts=now_ms)))
+            stats = LiveStats()
+            self.assertEqual(rebuild_from_log(stats, path), 2)
+
+        data = stats.query()
+        self.assertEqual(data['totals']['total_ms_by_video'], [["v1", 250]])
+        self.assertEqual(data['views']['views_by_video'], [["test-video-123", 1]])
+
+    def test_tailer_follows_partial_lines_and_rotation(self):
+        now_ms = int(time.time() * 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "events.ndjson")
+            stats = LiveStats()
+            tailer = LogTailer(stats, path)
+            self.assertEqual(tailer.poll(), 0)
+            line = dumps_line(make_tick("t1", now_ms, 100, video_id="v1"))
+            with open(path, "wb") as f:
+                f.write(line[:20])
+            self.assertEqual(tailer.poll(), 0)
+            with open(path, "ab") as f:
+                f.write(line[20:])
+                f.write(dumps_line(make_tick("t2", now_ms, 200, video_id="v1")))
+            os.rename(path, os.path.join(tmp, "events-1.ndjson"))
+            with open(path, "wb") as f:
+                f.write(dumps_line(make_tick("t3", now_ms, 400, video_id="v1")))
+            self.assertEqual(tailer.poll(), 3)
+
+        self.assertEqual(stats.query()['totals']['total_ms_by_video'], [["v1", 700]])
+
+    def test_rebuild_reads_rotated_segments_inside_retention(self):
+        now = time.time()
+        now_ms = int(now * 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "events.ndjson")
+            with open(path, "wb") as f:
+                f.write(dumps_line(make_tick("t1", now_ms, 100, video_id="v1")))
+                f.write(dumps_line(make_tick("old", now_ms - 7_200_000, 100, video_id="v1")))
+            with gzip.open(os.path.join(tmp, "events-20260101T000000000000Z-1.ndjson.gz"), "wb") as f:
+                f.write(dumps_line(make_tick("t2", now_ms - 60_000, 200, video_id="v1")))
+            expired = os.path.join(tmp, "events-20250101T000000000000Z-1.ndjson")
+            with open(expired, "wb") as f:
+                f.write(dumps_line(make_tick("t3", now_ms, 400, video_id="v1")))
+            os.utime(expired, (now - 7200, now - 7200))
+
+            stats = LiveStats(bucket_secs=60, retention_secs=3600)
+            with patch('stats.parse_event_line', wraps=stats_module.parse_event_line) as parse:
+                self.assertEqual(rebuild_from_log(stats, path, now=now), 2)
+            self.assertEqual(parse.call_count, 2)
+
+        self.assertEqual(stats.query(now=now)['totals']['total_ms_by_video'], [["v1", 300]])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_shards_merge_across_threads(self):
+        counter = metrics.Counter("test_total", "test")
+        hist = metrics.Histogram("test_seconds", "test", buckets=(1, 10))
+
+        def work():
+            for v in (0.5, 5, 50):
+                counter.inc()
+                hist.observe(v)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        work()
+
+        self.assertEqual(counter.value(), 15)
+        snap = hist.snapshot()
+        self.assertEqual(snap["counts"], [5, 5, 5])
+        self.assertEqual(snap["count"], 15)
+        self.assertEqual(hist.render()[:3], [
+            'test_seconds_bucket{le="1"} 5',
+            'test_seconds_bucket{le="10"} 10',
+            'test_seconds_bucket{le="+Inf"} 15',
+        ])
+
+
+class TestNdjsonLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "events.ndjson")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_lines(self, path):
+        with open(path, "rb") as f:
+            return f.read().splitlines()
+
+    def test_commits_in_groups(self):
+        writer = NdjsonLogWriter(self.path, flush_lines=3, flush_ms=0, fsync="batch")
+        writer.append(b"1\n")
+        writer.append(b"2\n")
+        self.assertFalse(os.path.exists(self.path))
+        writer.append(b"3\n")
+        self.assertEqual(self.read_lines(self.path), [b"1", b"2", b"3"])
+        writer.append(b"4\n")
+        writer.close()
+        self.assertEqual(self.read_lines(self.path), [b"1", b"2", b"3", b"4"])
+
+    def test_rotates_by_size(self):
+        writer = NdjsonLogWriter(self.path, flush_lines=1, flush_ms=0, rotate_bytes=4)
+        writer.append(b"abc\n")
+        writer.append(b"def\n")
+        writer.close()
+
+        segments = sorted(f for f in os.listdir(self.tmp.name) if f.startswith("events-"))
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(self.read_lines(self.path), [])
+
+    def test_compress_segment_gzip(self):
+        segment = os.path.join(self.tmp.name, "events-1.ndjson")
+        with open(segment, "wb") as f:
+            f.write(b"abc\n")
+        out = compress_segment(segment, "gzip")
+
+        self.assertEqual(out, segment + ".gz")
+        self.assertFalse(os.path.exists(segment))
+        with gzip.open(out, "rb") as f:
+            self.assertEqual(f.read(), b"abc\n")
+
+
+class TestFirehoseSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = DiskSpool(self.tmp.name)
+        patcher = patch.object(firehose_client.batcher, 'spool', self.spool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        firehose_client.batcher._batch.clear()
+        firehose_client.batcher._outage = False
+
+    def tearDown(self):
+        firehose_client.batcher._outage = False
+        self.tmp.cleanup()
+
+    @patch.object(firehose_client.batcher, 'spool_high_water_records', 1)
+    @patch('firehose_client.send_batch')
+    def test_unsent_events_spill_to_disk_and_replay_in_order(self, mock_send_batch):
+        mock_send_batch.side_effect = RuntimeError("Firehose down")
+        firehose_client.add_event(make_line(event_id="e0"))
+        firehose_client.add_event(make_line(event_id="e1"))
+        with self.assertRaises(RuntimeError):
+            firehose_client.flush(force=True)
+
+        self.assertEqual(firehose_client.queue_depth(), 0)
+        self.assertTrue(firehose_client.buffer_stats()["outage"])
+
+        firehose_client.add_event(make_line(event_id="e2"))
+        firehose_client.flush(force=True)
+        self.assertEqual(mock_send_batch.call_count, 1)
+
+        mock_send_batch.side_effect = None
+        mock_send_batch.reset_mock()
+        with patch.object(firehose_client.batcher, 'replay_records_per_sec', 0):
+            while firehose_client.batcher._replay_once():
+                pass
+
+        sent = [line for call in mock_send_batch.call_args_list for line in call.args[0]]
+        self.assertEqual(event_ids(sent), ["e0", "e1", "e2"])
+        self.assertFalse(self.spool.has_pending())
+        self.assertFalse(firehose_client.buffer_stats()["outage"])
+
+    @patch('firehose_client.send_batch')
+    def test_outage_lasts_until_spool_is_drained(self, mock_send_batch):
+        firehose_client.batcher._outage = True
+        for i in range(3):
+            firehose_client.add_event(make_line(event_id=f"e{i}"))
+            firehose_client.flush(force=True)
+            self.spool.seal()
+        mock_send_batch.assert_not_called()
+
+        with patch.object(firehose_client.batcher, 'replay_records_per_sec', 0):
+            self.assertTrue(firehose_client.batcher._replay_once())
+            self.assertTrue(firehose_client.buffer_stats()["outage"])
+            firehose_client.add_event(make_line(event_id="e3"))
+            firehose_client.flush(force=True)
+            while firehose_client.batcher._replay_once():
+                pass
+
+        sent = [line for call in mock_send_batch.call_args_list for line in call.args[0]]
+        self.assertEqual(event_ids(sent), ["e0", "e1", "e2", "e3"])
+        self.assertFalse(firehose_client.buffer_stats()["outage"])
+
+    def test_release_replaces_claimed_segment_with_remainder(self):
+        self.spool.spill([make_line(event_id="e0"), make_line(event_id="e1")])
+        claimed = self.spool.claim_oldest()
+        self.spool.release(claimed, [make_line(event_id="e1")])
+        self.assertEqual(os.listdir(self.tmp.name), [os.path.basename(claimed.split(".claimed-")[0])])
+
+        claimed = self.spool.claim_oldest()
+        with open(claimed + ".tmp", "wb") as f:
+            f.write(b"partial")
+        DiskSpool(self.tmp.name)
+        claimed = self.spool.claim_oldest()
+        self.assertEqual(event_ids(self.spool.read(claimed)), ["e1"])
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+
+    @patch.object(firehose_client.batcher, 'spool_high_water_records', 1)
+    @patch('firehose_client._backoff')
+    @patch('firehose_client.firehose')
+    def test_connection_errors_spool_events_and_release_claims(self, mock_firehose, mock_backoff):
+        mock_firehose.put_record_batch.side_effect = EndpointConnectionError(endpoint_url="https://firehose")
+        firehose_client.add_event(make_line(event_id="e0"))
+        firehose_client.add_event(make_line(event_id="e1"))
+        with self.assertRaises(firehose_client.FirehoseSendError):
+            firehose_client.flush(force=True)
+
+        self.assertEqual(mock_firehose.put_record_batch.call_count, firehose_client.FIREHOSE_MAX_RETRIES + 1)
+        self.assertTrue(firehose_client.buffer_stats()["outage"])
+        self.spool.seal()
+        claimed = self.spool.claim_oldest()
+        self.assertEqual(event_ids(self.spool.read(claimed)), ["e0", "e1"])
+        self.spool.release(claimed)
+
+        with patch('firehose_client.send_batch', side_effect=EndpointConnectionError(endpoint_url="https://firehose")):
+            with self.assertRaises(EndpointConnectionError):
+                firehose_client.batcher._replay_once()
+        claimed = self.spool.claim_oldest()
+        self.assertIsNotNone(claimed)
+        self.assertEqual(event_ids(self.spool.read(claimed)), ["e0", "e1"])
+
+    def test_spool_recovers_open_segment_after_restart(self):
+        self.spool.spill([make_line(event_id="e0")])
+        restarted = DiskSpool(self.tmp.name)
+
+        claimed = restarted.claim_oldest()
+        self.assertEqual(event_ids(restarted.read(claimed)), ["e0"])
+        restarted.release(claimed, [])
+        claimed = restarted.claim_oldest()
+        self.assertEqual(restarted.read(claimed), [])
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -2,18 +2,39 @@ const INGEST_URL = "http://localhost:4000/ingest";
 
 let queue = [];
 let flushing = false;
+let backoffUntil = 0;
 
 const MAX_BATCH_SIZE = 50;
+const BACKLOG_BATCH_SIZE = 500;
 const FLUSH_INTERVAL_MS = 750;
 
-async function postBatch(events) {
-  try {
-    const res = await fetch(INGEST_URL, {
-      method: "POST",
+// Backlogged flushes go out as gzip-compressed NDJSON, which the API decodes
+// and validates line by line. keepalive is only allowed for small bodies, so
+// it is kept for the regular JSON batches.
+async function buildRequest(events) {
+  if (events.length <= MAX_BATCH_SIZE || typeof CompressionStream === "undefined") {
+    return {
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({ events }),
       keepalive: true
-    });
+    };
+  }
+  const ndjson = events.map((ev) => JSON.stringify(ev)).join("\n") + "\n";
+  const gzipped = new Blob([ndjson]).stream().pipeThrough(new CompressionStream("gzip"));
+  return {
+    headers: { "Content-Type": "application/x-ndjson", "Content-Encoding": "gzip" },
+    body: await new Response(gzipped).blob()
+  };
+}
+
+async function postBatch(events) {
+  try {
+    const res = await fetch(INGEST_URL, { method: "POST", ...(await buildRequest(events)) });
+
+    if (res.status === 429) {
+      const retryAfter = parseInt(res.headers.get("Retry-After") || "", 10);
+      backoffUntil = Date.now() + (Number.isFinite(retryAfter) ? retryAfter : 2) * 1000;
+    }
 
     if (!res.ok) {
       const text = await res.text().catch(() => "");
@@ -36,10 +57,11 @@ async function postBatch(events) {
 async function flushQueue() {
   if (flushing) return;
   if (queue.length === 0) return;
+  if (Date.now() < backoffUntil) return;
 
   flushing = true;
   try {
-    const batch = queue.slice(0, MAX_BATCH_SIZE);
+    const batch = queue.slice(0, queue.length > MAX_BATCH_SIZE ? BACKLOG_BATCH_SIZE : MAX_BATCH_SIZE);
     await postBatch(batch);
     queue = queue.slice(batch.length);
     console.log(`Queue after flush: ${queue.length} events remaining`);
@@ -1,3 +1,18 @@
+from typing import Optional
+from config import VIDEO_TOP_K, FETCH_CONCURRENCY
+from hll import HyperLogLog, decode_registers, encode_registers, merge_registers, to_dense
+import topk
+
+OTHER_VIDEO_ID = "__other__"
+
+SKETCH_DIMENSIONS = {
+    "sessions_by_channel": "sessions_channels",
+    "sessions_by_video": "sessions_videos",
+    "tabs_by_channel": "tabs_channels",
+    "tabs_by_video": "tabs_videos",
+}
+
+
 def merge_dict_add(dst: dict, src: dict):
     for k, v in (src or {}).items():
         if not isinstance(v, (int, float)):
@@ -5,36 +20,151 @@ def merge_dict_add(dst: dict, src: dict):
         dst[k] = dst.get(k, 0) + v
 
 
-def aggregate_partials(partial_keys: list, bucket: str):
-    from s3_operations import read_json
+# Merges one partial's HyperLogLog registers into dst by register-wise max;
+# dst keeps one sketch per key, sparse until it outgrows the dense register
+# array and fixed-size after that, however many sessions the partials saw.
+# Sketches with a precision other than the first one merged cannot be
+# combined and are skipped.
+def merge_sketches(dst: dict, src: dict, source: str = "") -> bool:
+    if not src or not src.get("precision"):
+        return False
+    precision = src["precision"]
+    if dst.setdefault("precision", precision) != precision:
+        print(f"Skipping sketches of {source}: precision {precision} != {dst['precision']}")
+        return False
+    for dim, target in SKETCH_DIMENSIONS.items():
+        merged = dst.setdefault(target, {})
+        for k, data in (src.get(dim) or {}).items():
+            registers = decode_registers(data)
+            current = merged.get(k)
+            merged[k] = registers if current is None else merge_registers(current, registers, precision)
+    return True
+
+
+def unique_count(aggregated: dict, target: str, key: str) -> int:
+    registers = aggregated.get(target, {}).get(key)
+    if registers is None:
+        return 0
+    return HyperLogLog(aggregated["precision"], to_dense(registers, aggregated["precision"])).count()
+
+
+def _numeric(counts: dict) -> dict:
+    return {k: v for k, v in (counts or {}).items() if isinstance(v, (int, float))}
+
+
+# Folds one partial's per-video counters into the running top-K summaries.
+# Partials written without VIDEO_TOP_K carry exact maps, which are summarized
+# first; partials summarized with a larger K are truncated by the merge.
+def merge_video_topk(state: dict, doc: dict, k: int) -> dict:
+    partial = doc.get("video_topk")
+    if partial:
+        watch_ms, views = partial["watch_ms"], partial["views"]
+    else:
+        watch_ms = topk.summarize(_numeric((doc.get("totals") or {}).get("total_ms_by_video")), k)
+        views = topk.summarize(_numeric((doc.get("views") or {}).get("views_by_video")), k)
+    empty = {"items": {}, "total": 0, "floor": 0}
+    return {
+        "watch_ms": topk.merge(state.get("watch_ms", empty), watch_ms, k),
+        "views": topk.merge(state.get("views", empty), views, k),
+    }
+
+
+def _prune_video_sketches(sketches: dict, video_topk: dict) -> None:
+    tracked = video_topk["watch_ms"]["items"].keys() | video_topk["views"]["items"].keys()
+    for target in ("sessions_videos", "tabs_videos"):
+        by_video = sketches.get(target)
+        if by_video:
+            sketches[target] = {k: v for k, v in by_video.items() if k in tracked}
+
 
-    total_ms_by_channel = {}
-    total_ms_by_channel_fg = {}
-    total_ms_by_channel_bg = {}
-    total_ms_by_video = {}
-    views_by_channel = {}
-    views_by_video = {}
+# With VIDEO_TOP_K set, or as soon as a partial carries "video_topk", video
+# counters are merged as bounded top-K summaries instead of exact maps, and
+# session sketches are kept only for tracked videos (a video that enters the
+# top K late only counts sessions from the partials merged after that).
+def aggregate_partials(
+    partial_keys: list,
+    bucket: str,
+    video_top_k: int = VIDEO_TOP_K,
+    concurrency: int = FETCH_CONCURRENCY,
+    state: Optional[dict] = None,
+):
+    from s3_operations import iter_json
 
-    for k in partial_keys:
-        doc = read_json(bucket, k)
+    state = state or {}
+    total_ms_by_channel = state.get("channels", {})
+    total_ms_by_channel_fg = state.get("channels_fg", {})
+    total_ms_by_channel_bg = state.get("channels_bg", {})
+    views_by_channel = state.get("views_channels", {})
+    sketches = {k: state[k] for k in ("precision", *SKETCH_DIMENSIONS.values()) if k in state}
+    video_topk = state.get("video_topk")
+    if video_topk is None:
+        total_ms_by_video = state.get("videos", {})
+        views_by_video = state.get("views_videos", {})
+    else:
+        # In top-K mode "videos" and "views_videos" only mirror video_topk.
+        video_top_k = video_top_k or state["video_top_k"]
+        total_ms_by_video = {}
+        views_by_video = {}
+
+    for k, doc in iter_json(bucket, partial_keys, concurrency):
         totals = (doc.get("totals") or {})
         views = (doc.get("views") or {})
 
         merge_dict_add(total_ms_by_channel, totals.get("total_ms_by_channel"))
         merge_dict_add(total_ms_by_channel_fg, totals.get("total_ms_by_channel_fg"))
         merge_dict_add(total_ms_by_channel_bg, totals.get("total_ms_by_channel_bg"))
-        merge_dict_add(total_ms_by_video, totals.get("total_ms_by_video"))
         merge_dict_add(views_by_channel, views.get("views_by_channel"))
-        merge_dict_add(views_by_video, views.get("views_by_video"))
+        merge_sketches(sketches, doc.get("sketches"), k)
 
-    return {
+        if not video_top_k and doc.get("video_topk"):
+            video_top_k = doc["video_topk"]["k"]
+        if video_top_k:
+            video_topk = merge_video_topk(video_topk or {}, doc, video_top_k)
+            _prune_video_sketches(sketches, video_topk)
+        else:
+            merge_dict_add(total_ms_by_video, totals.get("total_ms_by_video"))
+            merge_dict_add(views_by_video, views.get("views_by_video"))
+
+    aggregated = {
         "channels": total_ms_by_channel,
         "channels_fg": total_ms_by_channel_fg,
         "channels_bg": total_ms_by_channel_bg,
         "videos": total_ms_by_video,
         "views_channels": views_by_channel,
         "views_videos": views_by_video,
+        **sketches,
     }
+    if video_topk is not None:
+        # Exact partials merged before summary mode started.
+        if total_ms_by_video or views_by_video:
+            exact = {"totals": {"total_ms_by_video": total_ms_by_video}, "views": {"views_by_video": views_by_video}}
+            video_topk = merge_video_topk(video_topk, exact, video_top_k)
+            _prune_video_sketches(aggregated, video_topk)
+        aggregated["video_topk"] = video_topk
+        aggregated["video_top_k"] = video_top_k
+        aggregated["videos"] = {vid: lower for vid, (lower, _) in video_topk["watch_ms"]["items"].items()}
+        aggregated["views_videos"] = {vid: lower for vid, (lower, _) in video_topk["views"]["items"].items()}
+    return aggregated
+
+
+# Checkpoints store the aggregate as JSON; sketch registers are the only
+# values that need encoding.
+def to_checkpoint(aggregated: dict, watermark: Optional[str], consumed: set) -> dict:
+    state = dict(aggregated)
+    for target in SKETCH_DIMENSIONS.values():
+        if target in state:
+            state[target] = {k: encode_registers(regs) for k, regs in state[target].items()}
+    return {"watermark": watermark, "consumed": sorted(consumed), "state": state}
+
+
+def from_checkpoint(doc: Optional[dict]) -> tuple:
+    if not doc:
+        return None, set(), None
+    state = doc["state"]
+    for target in SKETCH_DIMENSIONS.values():
+        if target in state:
+            state[target] = {k: decode_registers(data) for k, data in state[target].items()}
+    return doc.get("watermark"), set(doc.get("consumed", ())), state
 
 
 def build_rows(aggregated: dict, dt: str):
@@ -48,6 +178,8 @@ def build_rows(aggregated: dict, dt: str):
             "watch_ms_fg": int(aggregated["channels_fg"].get(ch, 0)),
             "watch_ms_bg": int(aggregated["channels_bg"].get(ch, 0)),
             "views": int(aggregated["views_channels"].get(ch, 0)),
+            "unique_sessions": unique_count(aggregated, "sessions_channels", ch),
+            "unique_tabs": unique_count(aggregated, "tabs_channels", ch),
         })
 
     video_rows = []
@@ -58,6 +190,32 @@ def build_rows(aggregated: dict, dt: str):
             "video_id": vid,
             "watch_ms": int(aggregated["videos"].get(vid, 0)),
             "views": int(aggregated["views_videos"].get(vid, 0)),
+            "unique_sessions": unique_count(aggregated, "sessions_videos", vid),
+            "unique_tabs": unique_count(aggregated, "tabs_videos", vid),
+        })
+
+    # In top-K mode watch_ms and views are lower bounds and the *_error
+    # columns how much higher the true value can be. The other row carries
+    # everything not attributed to a tracked video; its *_error columns are
+    # the most any single untracked video can have.
+    video_topk = aggregated.get("video_topk")
+    if video_topk is not None:
+        watch_ms, views = video_topk["watch_ms"], video_topk["views"]
+        for row in video_rows:
+            vid = row["video_id"]
+            lower, upper = watch_ms["items"].get(vid, (0, watch_ms["floor"]))
+            row["watch_ms_error"] = int(upper - lower)
+            lower, upper = views["items"].get(vid, (0, views["floor"]))
+            row["views_error"] = int(upper - lower)
+        video_rows.append({
+            "dt": dt,
+            "video_id": OTHER_VIDEO_ID,
+            "watch_ms": int(topk.other(watch_ms)),
+            "views": int(topk.other(views)),
+            "unique_sessions": 0,
+            "unique_tabs": 0,
+            "watch_ms_error": int(watch_ms["floor"]),
+            "views_error": int(views["floor"]),
         })
 
     return channel_rows, video_rows
@@ -0,0 +1,93 @@
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import boto3
+from aggregator import aggregate_partials
+from codec import dumps
+from s3_client import s3_config
+import s3_operations
+
+
+# Local S3 stand-in: answers path-style GetObject requests from memory after
+# a fixed delay that models S3 first-byte latency, so wall time is dominated
+# by request latency the way it is against real S3.
+class StandInS3(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    objects = {}
+    latency_ms = 30
+
+    def do_GET(self):
+        time.sleep(self.latency_ms / 1000)
+        body = self.objects.get(unquote(self.path.split("?")[0]))
+        if body is None:
+            body = b"<?xml version='1.0'?><Error><Code>NoSuchKey</Code></Error>"
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_partial(rng: random.Random) -> dict:
+    videos = {f"vid{rng.randint(1, 5000):05d}": rng.randint(1, 600000) for _ in range(200)}
+    channels = {f"Channel {rng.randint(1, 300)}": rng.randint(1, 600000) for _ in range(50)}
+    return {
+        "totals": {
+            "total_ms_by_channel": channels,
+            "total_ms_by_channel_fg": channels,
+            "total_ms_by_channel_bg": {},
+            "total_ms_by_video": videos,
+        },
+        "views": {"views_by_channel": {ch: 1 for ch in channels}, "views_by_video": {v: 1 for v in videos}},
+    }
+
+
+if __name__ == "__main__":
+    partials = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrencies = [int(c) for c in (sys.argv[2] if len(sys.argv) > 2 else "1,8,32,64").split(",")]
+
+    rng = random.Random(7)
+    keys = [f"results/daily/2026/01/19/partials/p{i:06d}.json" for i in range(partials)]
+    StandInS3.objects = {f"/bench/{key}": dumps(make_partial(rng)) for key in keys}
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInS3)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"{partials} partials, {StandInS3.latency_ms} ms simulated GET latency")
+
+    expected = None
+    baseline = None
+    for concurrency in concurrencies:
+        client = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name="us-east-1",
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+            config=s3_config.merge(boto3.session.Config(
+                max_pool_connections=max(10, concurrency), s3={"addressing_style": "path"})),
+        )
+        with patch.object(s3_operations, "s3", client):
+            t0 = time.perf_counter()
+            result = aggregate_partials(keys, "bench", concurrency=concurrency)
+            secs = time.perf_counter() - t0
+        baseline = baseline or secs
+        if expected is None:
+            expected = result
+        assert result == expected, f"concurrency={concurrency} changed the result"
+        print(f"concurrency={concurrency:<4} {secs:7.2f} s  {partials / secs:8.0f} partials/s  {baseline / secs:5.1f}x")
+    server.shutdown()
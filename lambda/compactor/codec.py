@@ -0,0 +1,43 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Both backends emit compact UTF-8 JSON (no spaces after separators, no
+# ASCII escaping). Input orjson refuses (ints beyond 64 bits and non-str
+# keys when encoding, NaN/Infinity literals when decoding) is retried with
+# the stdlib, so what is accepted never depends on which backend is
+# installed. One difference remains: orjson decodes integers beyond 64 bits
+# as floats.
+
+
+def _std_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+if orjson is not None:
+    def dumps(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except (TypeError, orjson.JSONEncodeError):
+            return _std_dumps(obj)
+
+    def loads(data: Union[bytes, str]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+else:
+    dumps = _std_dumps
+    loads = json.loads
+
+
+def dumps_line(obj: Any) -> bytes:
+    return dumps(obj) + b"\n"
+
+
+def backend() -> str:
+    return "orjson" if orjson is not None else "json"
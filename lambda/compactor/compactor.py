@@ -1,29 +1,73 @@
-from config import get_bucket
-from utils import dt_today_utc, prefix_for_partials, prefix_for_out
-from s3_operations import list_keys, write_jsonl
-from aggregator import aggregate_partials, build_rows
+from config import get_bucket, get_output_format, INCREMENTAL_COMPACTION, PARTIAL_LATENESS_SECS
+from utils import dt_today_utc, prefix_for_partials, out_key, checkpoint_key, advance_watermark
+from s3_operations import list_keys, write_jsonl, write_parquet, read_json_if_exists, write_json
+from aggregator import aggregate_partials, build_rows, to_checkpoint, from_checkpoint
 
 
+# With INCREMENTAL_COMPACTION the day's running aggregate is kept in a
+# checkpoint next to the partials, together with a watermark key: partial keys
+# sort by event time, so each run lists only the keys after the watermark and
+# reads those it has not merged yet. The watermark trails the newest merged
+# partial by PARTIAL_LATENESS_SECS so that partials processed late are still
+# listed; the checkpoint keeps the merged keys past it, and only those. Partials
+# are write-once, so a merged key never needs re-reading. The checkpoint is
+# written after the outputs: a run that fails in between merges the same
+# partials again next time. Pass {"rebuild": true} to ignore the checkpoint and
+# re-read all. Events with "rollup" build weekly/monthly rollups instead (see
+# rollup.py).
 def lambda_handler(event, context):
+    event = event or {}
     bucket = get_bucket()
-    dt = (event or {}).get("dt") or dt_today_utc()
+    output_format = get_output_format()
+    if event.get("rollup"):
+        from rollup import run_rollups
+
+        return run_rollups(bucket, event, output_format)
+
+    dt = event.get("dt") or dt_today_utc()
     partials_prefix = prefix_for_partials(dt)
-    partial_keys = list_keys(bucket, partials_prefix)
+    incremental = INCREMENTAL_COMPACTION and not event.get("rebuild")
+    ckpt_key = checkpoint_key(dt)
+    watermark, consumed, state = from_checkpoint(read_json_if_exists(bucket, ckpt_key) if incremental else None)
+    partial_keys = list_keys(bucket, partials_prefix, start_after=watermark)
 
-    if not partial_keys:
+    if state is None and not partial_keys:
         print(f"No partials found for dt={dt} under {partials_prefix}")
         return {"ok": True, "dt": dt, "partials": 0, "written": False}
 
-    aggregated = aggregate_partials(partial_keys, bucket)
+    new_keys = [k for k in partial_keys if k not in consumed]
+    if state is not None and not new_keys:
+        print(f"No new partials for dt={dt} after {watermark} ({len(partial_keys)} listed)")
+        return {"ok": True, "dt": dt, "partials": len(partial_keys), "new_partials": 0, "written": False}
+
+    aggregated = aggregate_partials(new_keys, bucket, state=state)
     channel_rows, video_rows = build_rows(aggregated, dt)
 
-    out_ch_key = prefix_for_out("channel_daily", dt) + "data.jsonl"
-    out_vid_key = prefix_for_out("video_daily", dt) + "data.jsonl"
+    for table, rows in (("channel_daily", channel_rows), ("video_daily", video_rows)):
+        write_table(bucket, table, dt, rows, output_format)
+
+    if INCREMENTAL_COMPACTION:
+        watermark = advance_watermark(partials_prefix, watermark, new_keys, PARTIAL_LATENESS_SECS)
+        consumed = {k for k in consumed.union(new_keys) if watermark is None or k > watermark}
+        write_json(bucket, ckpt_key, to_checkpoint(aggregated, watermark, consumed))
+        print(f"Checkpointed watermark {watermark} and {len(consumed)} partials past it to s3://{bucket}/{ckpt_key}")
 
-    write_jsonl(bucket, out_ch_key, channel_rows)
-    write_jsonl(bucket, out_vid_key, video_rows)
+    return {
+        "ok": True,
+        "dt": dt,
+        "partials": len(partial_keys),
+        "new_partials": len(new_keys),
+        "channel_rows": len(channel_rows),
+        "video_rows": len(video_rows),
+    }
 
-    print(f"Wrote {len(channel_rows)} channel rows to s3://{bucket}/{out_ch_key}")
-    print(f"Wrote {len(video_rows)} video rows to s3://{bucket}/{out_vid_key}")
 
-    return {"ok": True, "dt": dt, "partials": len(partial_keys), "channel_rows": len(channel_rows), "video_rows": len(video_rows)}
+def write_table(bucket: str, table: str, dt: str, rows: list, output_format: str):
+    if output_format in ("jsonl", "both"):
+        key = out_key(table, dt)
+        write_jsonl(bucket, key, rows)
+        print(f"Wrote {len(rows)} {table} rows to s3://{bucket}/{key}")
+    if output_format in ("parquet", "both"):
+        key = out_key(table, dt, "parquet")
+        write_parquet(bucket, key, rows, table)
+        print(f"Wrote {len(rows)} {table} rows to s3://{bucket}/{key}")
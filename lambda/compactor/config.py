@@ -3,6 +3,26 @@ import os
 BUCKET = os.getenv("BUCKET")
 PARTIALS_PREFIX = os.getenv("PARTIALS_PREFIX", "results/daily")
 OUT_PREFIX = os.getenv("OUT_PREFIX", "analytics")
+VIDEO_TOP_K = int(os.getenv("VIDEO_TOP_K", "0"))
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "jsonl").lower()
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd").lower()
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "131072"))
+INCREMENTAL_COMPACTION = os.getenv("INCREMENTAL_COMPACTION", "True").lower() == "true"
+PARTIAL_LATENESS_SECS = int(os.getenv("PARTIAL_LATENESS_SECS", "3600"))
+ROLLUP_LOOKBACK_DAYS = int(os.getenv("ROLLUP_LOOKBACK_DAYS", "35"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "32"))
+FETCH_MAX_RETRIES = int(os.getenv("FETCH_MAX_RETRIES", "4"))
+FETCH_RETRY_BASE_MS = int(os.getenv("FETCH_RETRY_BASE_MS", "100"))
+FETCH_RETRY_MAX_MS = int(os.getenv("FETCH_RETRY_MAX_MS", "2000"))
+
+OUTPUT_FORMATS = ("jsonl", "parquet", "both")
+
+
+def get_output_format():
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError(f"OUTPUT_FORMAT must be one of {', '.join(OUTPUT_FORMATS)}, got {OUTPUT_FORMAT!r}")
+    return OUTPUT_FORMAT
+
 
 def get_bucket():
     if not BUCKET:
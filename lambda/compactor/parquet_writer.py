@@ -0,0 +1,74 @@
+from typing import List
+from config import PARQUET_COMPRESSION, PARQUET_ROW_GROUP_ROWS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# build_rows emits string key columns and integer metrics; everything that is
+# not a key is written as int64. Key columns are dictionary-encoded, and since
+# rows come sorted by key, the per-row-group min/max statistics let Athena
+# skip row groups on channel/video_id predicates. Every table is written with
+# its full column list, so an empty day still has the schema Athena expects;
+# columns a row leaves out (the top-K error bounds) are written as nulls.
+STRING_COLUMNS = ("dt", "period", "channel", "video_id")
+
+CHANNEL_COLUMNS = ("channel", "watch_ms", "watch_ms_fg", "watch_ms_bg", "views", "unique_sessions", "unique_tabs")
+VIDEO_COLUMNS = ("video_id", "watch_ms", "views", "unique_sessions", "unique_tabs", "watch_ms_error", "views_error")
+TABLE_COLUMNS = {
+    "channel_daily": ("dt",) + CHANNEL_COLUMNS,
+    "video_daily": ("dt",) + VIDEO_COLUMNS,
+    "channel_weekly": ("dt", "period") + CHANNEL_COLUMNS,
+    "channel_monthly": ("dt", "period") + CHANNEL_COLUMNS,
+    "video_weekly": ("dt", "period") + VIDEO_COLUMNS,
+    "video_monthly": ("dt", "period") + VIDEO_COLUMNS,
+}
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError("Parquet output requires pyarrow; add it to the compactor package or a layer")
+
+
+def table_schema(table: str):
+    _require_pyarrow()
+    columns = TABLE_COLUMNS.get(table)
+    if columns is None:
+        raise ValueError(f"No Parquet schema for table {table!r}")
+    return pa.schema([(name, pa.string() if name in STRING_COLUMNS else pa.int64()) for name in columns])
+
+
+def rows_to_parquet(
+    rows: List[dict],
+    table: str,
+    compression: str = PARQUET_COMPRESSION,
+    row_group_rows: int = PARQUET_ROW_GROUP_ROWS,
+) -> bytes:
+    schema = table_schema(table)
+    unknown = {name for row in rows for name in row} - set(schema.names)
+    if unknown:
+        raise ValueError(f"Columns {sorted(unknown)} are not in the {table} Parquet schema")
+    arrays = [
+        pa.array([row.get(field.name) for row in rows], type=field.type)
+        for field in schema
+    ]
+    parquet_table = pa.Table.from_arrays(arrays, schema=schema)
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(
+        parquet_table,
+        sink,
+        compression=compression,
+        use_dictionary=[name for name in schema.names if name in STRING_COLUMNS],
+        write_statistics=True,
+        row_group_size=row_group_rows,
+    )
+    return sink.getvalue().to_pybytes()
+
+
+def parquet_to_rows(data: bytes) -> List[dict]:
+    _require_pyarrow()
+    rows = pq.read_table(pa.BufferReader(data)).to_pylist()
+    return [{name: value for name, value in row.items() if value is not None} for row in rows]
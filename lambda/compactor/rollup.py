@@ -0,0 +1,206 @@
+from datetime import date, timedelta
+from typing import Dict, List, NamedTuple, Optional
+from config import ROLLUP_LOOKBACK_DAYS
+from hll import HyperLogLog, decode_registers, encode_registers, merge_registers, to_dense
+from s3_operations import head_etag, read_json_if_exists, read_rows, write_json
+from utils import checkpoint_key, dt_today_utc, out_key, rollup_state_key
+
+# Weekly and monthly rollups are built from already-compacted outputs:
+# weekly from channel_daily/video_daily, monthly from the weekly rollups of
+# the ISO weeks that lie entirely inside the month plus the daily outputs of
+# the remaining days. Counters are summed. unique_sessions/unique_tabs cannot
+# be summed across days, so they are recomputed from merged HyperLogLog
+# registers: a day's come from its compaction checkpoint, a week's from the
+# rollup state the weekly rollup writes. Days compacted without a checkpoint
+# contribute no sessions.
+#
+# The rollup state also records the ETags of every input. A period whose
+# inputs are unchanged since its last rollup is skipped, so scheduled runs
+# over a lookback window only rewrite periods that received new data.
+
+TABLES = {"channel": "channel", "video": "video_id"}
+SKETCH_TARGETS = {
+    "channel": ("sessions_channels", "tabs_channels"),
+    "video": ("sessions_videos", "tabs_videos"),
+}
+NON_ADDITIVE = ("dt", "period", "unique_sessions", "unique_tabs")
+
+
+class Period(NamedTuple):
+    kind: str
+    name: str
+    start: date
+    end: date
+
+
+def weeks_between(first: date, last: date) -> List[Period]:
+    periods = []
+    monday = first - timedelta(days=first.weekday())
+    while monday <= last:
+        year, week, _ = monday.isocalendar()
+        periods.append(Period("weekly", f"{year}-W{week:02d}", monday, monday + timedelta(days=6)))
+        monday += timedelta(days=7)
+    return periods
+
+
+def months_between(first: date, last: date) -> List[Period]:
+    periods = []
+    start = first.replace(day=1)
+    while start <= last:
+        next_start = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        periods.append(Period("monthly", start.strftime("%Y-%m"), start, next_start - timedelta(days=1)))
+        start = next_start
+    return periods
+
+
+def period_sources(period: Period) -> List[Period]:
+    sources = []
+    day = period.start
+    while day <= period.end:
+        week_end = day + timedelta(days=6)
+        if period.kind == "monthly" and day.weekday() == 0 and week_end <= period.end:
+            sources.append(weeks_between(day, day)[0])
+            day = week_end + timedelta(days=1)
+        else:
+            sources.append(Period("daily", day.isoformat(), day, day))
+            day += timedelta(days=1)
+    return sources
+
+
+def _sketch_key(source: Period) -> str:
+    if source.kind == "daily":
+        return checkpoint_key(source.name)
+    return rollup_state_key(source.kind, source.start.isoformat())
+
+
+def _sketches_of(source: Period, doc: Optional[dict]) -> Optional[dict]:
+    if not doc:
+        return None
+    return doc.get("state") if source.kind == "daily" else doc.get("sketches")
+
+
+def _merge_sketches(merged: dict, doc: Optional[dict], source: str) -> None:
+    if not doc or not doc.get("precision"):
+        return
+    precision = doc["precision"]
+    if merged.setdefault("precision", precision) != precision:
+        print(f"Skipping sketches of {source}: precision {precision} != {merged['precision']}")
+        return
+    for targets in SKETCH_TARGETS.values():
+        for target in targets:
+            into = merged.setdefault(target, {})
+            for k, data in (doc.get(target) or {}).items():
+                registers = decode_registers(data)
+                current = into.get(k)
+                into[k] = registers if current is None else merge_registers(current, registers, precision)
+
+
+def _count(sketches: dict, target: str, key: str) -> int:
+    registers = sketches.get(target, {}).get(key)
+    if registers is None:
+        return 0
+    return HyperLogLog(sketches["precision"], to_dense(registers, sketches["precision"])).count()
+
+
+def rollup_period(
+    bucket: str,
+    period: Period,
+    output_format: str,
+    force: bool = False,
+    done: Optional[Dict[str, dict]] = None,
+) -> dict:
+    from compactor import write_table
+
+    done = {} if done is None else done
+    sources = period_sources(period)
+    for source in sources:
+        if source.kind != "daily" and source.name not in done:
+            done[source.name] = rollup_period(bucket, source, output_format, force, done)
+
+    input_format = "parquet" if output_format == "parquet" else "jsonl"
+    row_keys = {
+        (source, table): out_key(f"{table}_{source.kind}", source.start.isoformat(), input_format)
+        for source in sources
+        for table in TABLES
+    }
+    keys = list(row_keys.values()) + [_sketch_key(source) for source in sources]
+    inputs = {key: etag for key in keys for etag in [head_etag(bucket, key)] if etag is not None}
+    summary = {"period": period.name, "kind": period.kind}
+    if not any(key in inputs for key in row_keys.values()):
+        return {**summary, "status": "empty"}
+
+    state_key = rollup_state_key(period.kind, period.start.isoformat())
+    previous = read_json_if_exists(bucket, state_key)
+    if not force and previous and previous.get("inputs") == inputs:
+        print(f"Rollup {period.name} unchanged since last run")
+        return {**summary, "status": "unchanged"}
+
+    sketches = {}
+    for source in sources:
+        if _sketch_key(source) in inputs:
+            _merge_sketches(sketches, _sketches_of(source, read_json_if_exists(bucket, _sketch_key(source))), source.name)
+
+    start = period.start.isoformat()
+    for table, key_column in TABLES.items():
+        totals = {}
+        for source in sources:
+            key = row_keys[(source, table)]
+            if key not in inputs:
+                continue
+            for row in read_rows(bucket, key):
+                k = row.get(key_column)
+                if k is None:
+                    continue
+                total = totals.setdefault(k, {})
+                for column, value in row.items():
+                    if column != key_column and column not in NON_ADDITIVE and isinstance(value, (int, float)):
+                        total[column] = total.get(column, 0) + value
+
+        sessions, tabs = SKETCH_TARGETS[table]
+        rows = [
+            {
+                "dt": start,
+                "period": period.name,
+                key_column: k,
+                **totals[k],
+                "unique_sessions": _count(sketches, sessions, k),
+                "unique_tabs": _count(sketches, tabs, k),
+            }
+            for k in sorted(totals)
+        ]
+        write_table(bucket, f"{table}_{period.kind}", start, rows, output_format)
+        summary[f"{table}_rows"] = len(rows)
+
+    encoded = {
+        target: {k: encode_registers(regs) for k, regs in by_key.items()}
+        for target, by_key in sketches.items()
+        if target != "precision"
+    }
+    if sketches:
+        encoded["precision"] = sketches["precision"]
+    write_json(bucket, state_key, {"period": period.name, "inputs": inputs, "sketches": encoded})
+    return {**summary, "status": "written"}
+
+
+# Rolls up every week and month overlapping [from, to] (default: the last
+# ROLLUP_LOOKBACK_DAYS days up to today). event["rollup"] is "weekly",
+# "monthly" or "all"; monthly rollups refresh the weekly rollups they are
+# built from first.
+def run_rollups(bucket: str, event: dict, output_format: str) -> dict:
+    last = date.fromisoformat(event.get("to") or dt_today_utc())
+    first = date.fromisoformat(event["from"]) if event.get("from") else last - timedelta(days=ROLLUP_LOOKBACK_DAYS)
+    level = event["rollup"]
+    if level not in ("weekly", "monthly", "all", True):
+        raise ValueError(f"rollup must be weekly, monthly or all, got {level!r}")
+    force = bool(event.get("rebuild"))
+
+    done = {}
+    if level in ("weekly", "all", True):
+        for period in weeks_between(first, last):
+            if period.name not in done:
+                done[period.name] = rollup_period(bucket, period, output_format, force, done)
+    if level in ("monthly", "all", True):
+        for period in months_between(first, last):
+            done[period.name] = rollup_period(bucket, period, output_format, force, done)
+
+    return {"ok": True, "rollup": level, "from": first.isoformat(), "to": last.isoformat(), "periods": list(done.values())}
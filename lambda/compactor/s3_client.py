@@ -1,4 +1,14 @@
 import boto3
+from botocore.config import Config
+from config import FETCH_CONCURRENCY
 
-s3 = boto3.client("s3")
-
+# One pooled connection per fetch thread, so concurrent partial reads never
+# wait on the pool (botocore's default is 10).
+s3_config = Config(
+    max_pool_connections=max(10, FETCH_CONCURRENCY),
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    connect_timeout=10,
+    read_timeout=60,
+    tcp_keepalive=True,
+)
+s3 = boto3.client("s3", config=s3_config)
@@ -1,12 +1,23 @@
-import json
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional, Tuple
+from botocore.exceptions import BotoCoreError, ClientError
 from s3_client import s3
+from codec import dumps, loads
+from config import FETCH_CONCURRENCY, FETCH_MAX_RETRIES, FETCH_RETRY_BASE_MS, FETCH_RETRY_MAX_MS
 
+PERMANENT_ERRORS = {"NoSuchKey", "NoSuchBucket", "AccessDenied", "InvalidObjectState"}
 
-def list_keys(bucket: str, prefix: str):
+
+def list_keys(bucket: str, prefix: str, start_after: Optional[str] = None):
     keys = []
     token = None
     while True:
         kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if start_after:
+            kwargs["StartAfter"] = start_after
         if token:
             kwargs["ContinuationToken"] = token
         resp = s3.list_objects_v2(**kwargs)
@@ -23,15 +34,115 @@ def list_keys(bucket: str, prefix: str):
 
 def read_json(bucket: str, key: str) -> dict:
     body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
-    return json.loads(body.decode("utf-8"))
+    return loads(body)
+
+
+def read_rows(bucket: str, key: str) -> list:
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    if key.endswith(".parquet"):
+        from parquet_writer import parquet_to_rows
+
+        return parquet_to_rows(body)
+    return [loads(line) for line in body.splitlines() if line.strip()]
+
+
+def head_etag(bucket: str, key: str) -> Optional[str]:
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+
+
+def read_json_if_exists(bucket: str, key: str) -> Optional[dict]:
+    try:
+        return read_json(bucket, key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+
+
+def write_json(bucket: str, key: str, doc: dict):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=dumps(doc),
+        ContentType="application/json",
+    )
+
+
+def _backoff(attempt: int) -> None:
+    cap_ms = min(FETCH_RETRY_MAX_MS, FETCH_RETRY_BASE_MS * (2 ** attempt))
+    time.sleep(random.uniform(0, cap_ms) / 1000)
+
+
+# Retries one key on throttling, 5xx and connection errors (on top of
+# botocore's own retries); errors that cannot succeed on retry are raised
+# immediately.
+def read_json_with_retry(bucket: str, key: str, max_retries: int = FETCH_MAX_RETRIES) -> dict:
+    for attempt in range(max_retries + 1):
+        try:
+            return read_json(bucket, key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in PERMANENT_ERRORS or attempt == max_retries:
+                raise
+            error = e
+        except BotoCoreError as e:
+            if attempt == max_retries:
+                raise
+            error = e
+        print(f"Retrying s3://{bucket}/{key} after {error!r} (attempt {attempt + 1}/{max_retries})")
+        _backoff(attempt)
+
+
+# Yields (key, doc) in the order of keys while up to `concurrency` reads run
+# ahead on a thread pool. At most 2 * concurrency documents are in flight, so
+# memory stays bounded however many keys there are, and callers merging in
+# yield order get the same result as a sequential read.
+def iter_json(bucket: str, keys: Iterable[str], concurrency: int = FETCH_CONCURRENCY) -> Iterator[Tuple[str, dict]]:
+    if concurrency <= 1:
+        for key in keys:
+            yield key, read_json_with_retry(bucket, key)
+        return
+
+    keys = iter(keys)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="partial-fetch") as pool:
+        try:
+            for key in keys:
+                window.append((key, pool.submit(read_json_with_retry, bucket, key)))
+                if len(window) >= 2 * concurrency:
+                    break
+            while window:
+                key, future = window.popleft()
+                doc = future.result()
+                next_key = next(keys, None)
+                if next_key is not None:
+                    window.append((next_key, pool.submit(read_json_with_retry, bucket, next_key)))
+                yield key, doc
+        finally:
+            for _, future in window:
+                future.cancel()
 
 
 def write_jsonl(bucket: str, key: str, rows: list):
-    data = "\n".join(json.dumps(r, ensure_ascii=False) for r in rows) + "\n"
+    data = b"\n".join(dumps(r) for r in rows) + b"\n"
     s3.put_object(
         Bucket=bucket,
         Key=key,
-        Body=data.encode("utf-8"),
+        Body=data,
         ContentType="application/x-ndjson",
     )
 
+
+def write_parquet(bucket: str, key: str, rows: list, table: str):
+    from parquet_writer import rows_to_parquet
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=rows_to_parquet(rows, table),
+        ContentType="application/vnd.apache.parquet",
+    )
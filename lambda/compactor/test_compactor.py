@@ -2,11 +2,52 @@ import unittest
 from unittest.mock import Mock, patch, MagicMock
 import sys
 import os
+import hashlib
+import io
+import random
+import time
+from datetime import date
+from botocore.exceptions import ClientError
 
 sys.path.insert(0, os.path.dirname(__file__))
 
 from aggregator import merge_dict_add, aggregate_partials, build_rows
-from utils import dt_today_utc, prefix_for_partials, prefix_for_out
+from utils import dt_today_utc, prefix_for_partials, prefix_for_out, advance_watermark
+from hll import HyperLogLog
+from topk import summarize
+from s3_operations import iter_json
+from codec import dumps, loads
+from rollup import weeks_between, months_between, period_sources
+import compactor
+import parquet_writer
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ETag": '"%s"' % hashlib.md5(self.objects[Key]).hexdigest()}
+
+    def list_objects_v2(self, Bucket, Prefix, StartAfter="", **kwargs):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix) and k > StartAfter)
+        return {"Contents": [{"Key": k} for k in keys], "IsTruncated": False}
+
+
+def serve_partials(mock_read, docs):
+    by_key = {f"key{i + 1}": doc for i, doc in enumerate(docs)}
+    mock_read.side_effect = lambda bucket, key: by_key[key]
+    return list(by_key)
 
 
 class TestCompactor(unittest.TestCase):
@@ -28,7 +69,7 @@ class TestCompactor(unittest.TestCase):
 
     @patch('s3_operations.read_json')
     def test_aggregate_partials(self, mock_read):
-        mock_read.side_effect = [
+        keys = serve_partials(mock_read, [
             {
                 "totals": {
                     "total_ms_by_channel": {"ch1": 1000, "ch2": 2000},
@@ -53,9 +94,9 @@ class TestCompactor(unittest.TestCase):
                     "views_by_video": {"v1": 2}
                 }
             }
-        ]
+        ])
         
-        result = aggregate_partials(["key1", "key2"], "test-bucket")
+        result = aggregate_partials(keys, "test-bucket")
         
         self.assertEqual(result["channels"]["ch1"], 1500)
         self.assertEqual(result["channels"]["ch2"], 2000)
@@ -81,6 +122,252 @@ class TestCompactor(unittest.TestCase):
         self.assertEqual(video_rows[0]["video_id"], "v1")
         self.assertEqual(video_rows[0]["watch_ms"], 1000)
 
+    @patch('s3_operations.read_json')
+    def test_aggregate_partials_merges_unique_sketches(self, mock_read):
+        def partial(sessions, precision=12):
+            sketch = HyperLogLog(precision)
+            for s in sessions:
+                sketch.add(s)
+            return {
+                "totals": {"total_ms_by_video": {"v1": 10}, "total_ms_by_channel": {"ch1": 10}},
+                "sketches": {"precision": precision, "sessions_by_video": {"v1": sketch.to_b64()},
+                             "sessions_by_channel": {"ch1": sketch.to_b64()}},
+            }
+
+        keys = serve_partials(mock_read, [
+            partial([f"s{i}" for i in range(0, 3000)]),
+            partial([f"s{i}" for i in range(2000, 5000)]),
+            partial([f"s{i}" for i in range(9000, 9500)], precision=10),
+        ])
+        aggregated = aggregate_partials(keys, "test-bucket")
+        channel_rows, video_rows = build_rows(aggregated, "2026-01-19")
+
+        self.assertEqual(len(aggregated["sessions_videos"]["v1"]), 4096)
+        self.assertAlmostEqual(video_rows[0]["unique_sessions"], 5000, delta=250)
+        self.assertEqual(video_rows[0]["unique_tabs"], 0)
+        self.assertAlmostEqual(channel_rows[0]["unique_sessions"], 5000, delta=250)
+
+    @patch('s3_operations.read_json')
+    def test_aggregate_partials_top_k_bounds(self, mock_read):
+        rng = random.Random(3)
+        exact = {}
+        partials = []
+        for i in range(20):
+            counts = {}
+            for _ in range(300):
+                vid = f"v{int(rng.paretovariate(1.2)) % 200}"
+                counts[vid] = counts.get(vid, 0) + 100
+                exact[vid] = exact.get(vid, 0) + 100
+            doc = {"totals": {"total_ms_by_video": counts}, "views": {"views_by_video": {}}}
+            if i % 4:
+                doc = {"totals": {}, "views": {}, "video_topk": {
+                    "k": 10, "watch_ms": summarize(counts, 10), "views": summarize({}, 10)}}
+            partials.append(doc)
+        keys = serve_partials(mock_read, partials)
+
+        aggregated = aggregate_partials(keys, "test-bucket", video_top_k=5)
+        _, video_rows = build_rows(aggregated, "2026-01-19")
+
+        self.assertEqual(len(video_rows), 6)
+        other = video_rows.pop()
+        self.assertEqual(other["video_id"], "__other__")
+        self.assertEqual(sum(r["watch_ms"] for r in video_rows) + other["watch_ms"], sum(exact.values()))
+        for row in video_rows:
+            self.assertLessEqual(row["watch_ms"], exact[row["video_id"]])
+            self.assertLessEqual(exact[row["video_id"]], row["watch_ms"] + row["watch_ms_error"])
+        tracked = {r["video_id"] for r in video_rows}
+        self.assertLessEqual(max(v for vid, v in exact.items() if vid not in tracked), other["watch_ms_error"])
+        self.assertIn(max(exact, key=exact.get), tracked)
+
+    @patch('s3_operations._backoff')
+    @patch('s3_operations.read_json')
+    def test_iter_json_is_ordered_and_retries_per_key(self, mock_read, mock_backoff):
+        attempts = {}
+
+        def read(bucket, key):
+            attempts[key] = attempts.get(key, 0) + 1
+            time.sleep(random.uniform(0, 0.005))
+            if key == "k7" and attempts[key] < 3:
+                raise ClientError({"Error": {"Code": "SlowDown"}}, "GetObject")
+            if key == "missing":
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            return {"key": key}
+
+        mock_read.side_effect = read
+        keys = [f"k{i}" for i in range(50)]
+        self.assertEqual(list(iter_json("b", keys, concurrency=8)), [(k, {"key": k}) for k in keys])
+        self.assertEqual(attempts["k7"], 3)
+        self.assertEqual(mock_backoff.call_count, 2)
+
+        with self.assertRaises(ClientError):
+            list(iter_json("b", ["k1", "missing", "k2"], concurrency=4))
+        self.assertEqual(attempts["missing"], 1)
+
+    def test_incremental_compaction_matches_full_rebuild(self):
+        def partial(i):
+            sketch = HyperLogLog(12)
+            sketch.add(f"s{i}")
+            return {
+                "totals": {"total_ms_by_channel": {"ch1": 100 * i}, "total_ms_by_video": {f"v{i % 2}": 100 * i}},
+                "views": {"views_by_channel": {"ch1": 1}, "views_by_video": {f"v{i % 2}": 1}},
+                "sketches": {"precision": 12, "sessions_by_channel": {"ch1": sketch.to_b64()}},
+            }
+
+        prefix = "results/daily/2026/01/19/partials/"
+
+        def key(i, hhmm):
+            return f"{prefix}20260119T{hhmm}00000Z-p{i}.json"
+
+        store = {key(i, f"0{i}00"): dumps(partial(i)) for i in range(1, 4)}
+        reads = []
+        listed_after = []
+
+        def list_keys(bucket, prefix, start_after=None):
+            listed_after.append(start_after)
+            return sorted(k for k in store if k.startswith(prefix) and (start_after is None or k > start_after))
+
+        def read_json(bucket, key):
+            if key not in store:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            reads.append(key)
+            return loads(store[key])
+
+        def write(bucket, key, doc):
+            store[key] = dumps(doc)
+
+        outputs = {}
+
+        def write_jsonl(bucket, key, rows):
+            outputs[key] = rows
+
+        def run(event):
+            reads.clear()
+            with patch('compactor.get_bucket', return_value="b"), \
+                    patch('compactor.list_keys', side_effect=list_keys), \
+                    patch('s3_operations.read_json', side_effect=read_json), \
+                    patch('compactor.write_json', side_effect=write), \
+                    patch('compactor.write_jsonl', side_effect=write_jsonl):
+                return compactor.lambda_handler(event, None)
+
+        self.assertEqual(run({"dt": "2026-01-19"})["new_partials"], 3)
+        checkpoint = loads(store["results/daily/2026/01/19/checkpoint.json"])
+        self.assertEqual(checkpoint["watermark"], f"{prefix}20260119T020000000Z")
+        self.assertEqual(checkpoint["consumed"], [key(2, "0200"), key(3, "0300")])
+
+        # p5 lands after p4 but for an older raw object, within the lateness.
+        store[key(4, "0400")] = dumps(partial(4))
+        store[key(5, "0330")] = dumps(partial(5))
+        result = run({"dt": "2026-01-19"})
+        self.assertEqual(result["new_partials"], 2)
+        self.assertEqual(listed_after[-1], f"{prefix}20260119T020000000Z")
+        self.assertEqual(sorted(k for k in reads if k.startswith(prefix)), [key(5, "0330"), key(4, "0400")])
+        checkpoint = loads(store["results/daily/2026/01/19/checkpoint.json"])
+        self.assertEqual(checkpoint["watermark"], f"{prefix}20260119T030000000Z")
+        self.assertEqual(checkpoint["consumed"], [key(3, "0300"), key(5, "0330"), key(4, "0400")])
+        incremental = dict(outputs)
+
+        self.assertEqual(run({"dt": "2026-01-19"})["written"], False)
+        self.assertEqual(run({"dt": "2026-01-19", "rebuild": True})["new_partials"], 5)
+        self.assertIsNone(listed_after[-1])
+        self.assertEqual(outputs, incremental)
+        self.assertEqual(incremental["analytics/channel_daily/dt=2026-01-19/data.jsonl"][0]["unique_sessions"], 5)
+        self.assertEqual(incremental["analytics/video_daily/dt=2026-01-19/data.jsonl"][1]["watch_ms"], 900)
+
+    @patch('config.OUTPUT_FORMAT', 'both')
+    def test_write_table_both_formats(self):
+        rows = [{"dt": "2026-01-19", "channel": "ch1", "watch_ms": 10}]
+        with patch('compactor.write_jsonl') as mock_jsonl, patch('compactor.write_parquet') as mock_parquet:
+            compactor.write_table("b", "channel_daily", "2026-01-19", rows, compactor.get_output_format())
+        mock_jsonl.assert_called_once_with("b", "analytics/channel_daily/dt=2026-01-19/data.jsonl", rows)
+        mock_parquet.assert_called_once_with("b", "analytics/channel_daily_parquet/dt=2026-01-19/data.parquet", rows,
+                                             "channel_daily")
+
+        with patch('config.OUTPUT_FORMAT', 'csv'), self.assertRaises(ValueError):
+            compactor.get_output_format()
+
+    @unittest.skipUnless(parquet_writer.pa is not None, "pyarrow not installed")
+    def test_rows_to_parquet(self):
+        pq = parquet_writer.pq
+        rows = [{"dt": "2026-01-19", "video_id": f"v{i:03d}", "watch_ms": i * 1000, "views": i,
+                 "unique_sessions": 1, "unique_tabs": 1} for i in range(300)]
+        data = parquet_writer.rows_to_parquet(rows, "video_daily", compression="zstd", row_group_rows=100)
+
+        parquet = pq.ParquetFile(io.BytesIO(data))
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+        column = parquet.metadata.row_group(1).column(1)
+        self.assertEqual(column.compression, "ZSTD")
+        self.assertIn("RLE_DICTIONARY", column.encodings)
+        self.assertEqual((column.statistics.min, column.statistics.max), ("v100", "v199"))
+        self.assertEqual(str(parquet.schema_arrow.field("watch_ms").type), "int64")
+        self.assertEqual(parquet.schema_arrow.names, list(parquet_writer.TABLE_COLUMNS["video_daily"]))
+        self.assertEqual(parquet_writer.parquet_to_rows(data), rows)
+
+        for table, columns in parquet_writer.TABLE_COLUMNS.items():
+            empty = pq.ParquetFile(io.BytesIO(parquet_writer.rows_to_parquet([], table)))
+            self.assertEqual((empty.metadata.num_rows, empty.schema_arrow.names), (0, list(columns)))
+        self.assertEqual(str(empty.schema_arrow.field("period").type), "string")
+        with self.assertRaises(ValueError):
+            parquet_writer.rows_to_parquet([{"dt": "2026-01-19", "extra": 1}], "channel_daily")
+
+    def test_rollup_periods(self):
+        self.assertEqual([p.name for p in weeks_between(date(2026, 1, 1), date(2026, 1, 12))],
+                         ["2026-W01", "2026-W02", "2026-W03"])
+        month = months_between(date(2026, 1, 20), date(2026, 2, 2))
+        self.assertEqual([(p.name, p.end) for p in month], [("2026-01", date(2026, 1, 31)), ("2026-02", date(2026, 2, 28))])
+        sources = [(s.kind, s.name) for s in period_sources(month[0])]
+        self.assertEqual(sources[:4], [("daily", "2026-01-01"), ("daily", "2026-01-02"), ("daily", "2026-01-03"),
+                                       ("daily", "2026-01-04")])
+        self.assertEqual(sources[4:8], [("weekly", "2026-W02"), ("weekly", "2026-W03"), ("weekly", "2026-W04"),
+                                        ("daily", "2026-01-26")])
+        self.assertEqual(len(sources), 4 + 3 + 6)
+
+    def test_rollups_from_daily_outputs(self):
+        fake = FakeS3()
+
+        def add_partial(dt, n):
+            sketch = HyperLogLog(12)
+            sketch.add(f"s{n % 10}")
+            doc = {
+                "totals": {"total_ms_by_channel": {"ch1": n}, "total_ms_by_video": {"v1": n}},
+                "views": {"views_by_channel": {"ch1": 1}, "views_by_video": {"v1": 1}},
+                "sketches": {"precision": 12, "sessions_by_channel": {"ch1": sketch.to_b64()}},
+            }
+            yyyy, mm, dd = dt.split("-")
+            fake.objects[f"results/daily/{yyyy}/{mm}/{dd}/partials/p{n}.json"] = dumps(doc)
+
+        def run(event):
+            with patch('s3_operations.s3', fake), patch('compactor.get_bucket', return_value="b"):
+                return compactor.lambda_handler(event, None)
+
+        for day in range(1, 15):
+            add_partial(f"2026-01-{day:02d}", day)
+            run({"dt": f"2026-01-{day:02d}"})
+
+        result = run({"rollup": "all", "from": "2026-01-01", "to": "2026-01-31"})
+        statuses = {p["period"]: p["status"] for p in result["periods"]}
+        self.assertEqual(statuses["2026-W02"], "written")
+        self.assertEqual(statuses["2026-W04"], "empty")
+
+        def rows(table, dt):
+            return [loads(line) for line in fake.objects[f"analytics/{table}/dt={dt}/data.jsonl"].splitlines()]
+
+        self.assertEqual(rows("channel_weekly", "2026-01-05")[0]["watch_ms"], sum(range(5, 12)))
+        monthly = rows("channel_monthly", "2026-01-01")[0]
+        self.assertEqual((monthly["period"], monthly["watch_ms"], monthly["views"]), ("2026-01", sum(range(1, 15)), 14))
+        self.assertEqual(monthly["unique_sessions"], 10)
+        self.assertEqual(rows("video_monthly", "2026-01-01")[0]["watch_ms"], sum(range(1, 15)))
+
+        statuses = {p["period"]: p["status"] for p in run({"rollup": "all", "from": "2026-01-01", "to": "2026-01-31"})["periods"]}
+        self.assertEqual(set(statuses.values()), {"unchanged", "empty"})
+
+        add_partial("2026-01-13", 100)
+        run({"dt": "2026-01-13"})
+        statuses = {p["period"]: p["status"] for p in run({"rollup": "all", "from": "2026-01-01", "to": "2026-01-31"})["periods"]}
+        self.assertEqual(statuses["2026-W03"], "written")
+        self.assertEqual(statuses["2026-01"], "written")
+        self.assertEqual(statuses["2026-W02"], "unchanged")
+        self.assertEqual(rows("channel_monthly", "2026-01-01")[0]["watch_ms"], sum(range(1, 15)) + 100)
+
     def test_prefix_for_partials(self):
         result = prefix_for_partials("2026-01-19")
         self.assertEqual(result, "results/daily/2026/01/19/partials/")
@@ -88,6 +375,15 @@ class TestCompactor(unittest.TestCase):
     def test_prefix_for_out(self):
         result = prefix_for_out("channel_daily", "2026-01-19")
         self.assertEqual(result, "analytics/channel_daily/dt=2026-01-19/")
+        result = prefix_for_out("channel_daily", "2026-01-19", "parquet")
+        self.assertEqual(result, "analytics/channel_daily_parquet/dt=2026-01-19/")
+
+    def test_advance_watermark(self):
+        prefix = "results/daily/2026/01/19/partials/"
+        keys = [f"{prefix}20260119T101500250Z-a.json", f"{prefix}20260119T090000000Z-b.json", f"{prefix}0f3a.json"]
+        self.assertEqual(advance_watermark(prefix, None, keys, 600), f"{prefix}20260119T100500250Z")
+        self.assertEqual(advance_watermark(prefix, f"{prefix}20260119T110000000Z", keys, 600), f"{prefix}20260119T110000000Z")
+        self.assertIsNone(advance_watermark(prefix, None, [f"{prefix}0f3a.json"], 600))
 
 
 if __name__ == '__main__':
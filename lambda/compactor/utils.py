@@ -1,4 +1,5 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
 from config import PARTIALS_PREFIX, OUT_PREFIX
 
 
@@ -11,6 +12,45 @@ def prefix_for_partials(dt: str) -> str:
     return f"{PARTIALS_PREFIX}/{yyyy}/{mm}/{dd}/partials/"
 
 
-def prefix_for_out(table: str, dt: str) -> str:
+# Partials are named <event time>-<hash>.json by the processor, so a day's
+# keys sort by when their raw objects landed. Keys without a stamp (written
+# before partials carried one) give None.
+def partial_time(key: str) -> Optional[datetime]:
+    stamp = key.rsplit("/", 1)[-1].split("-", 1)[0]
+    try:
+        return datetime.strptime(stamp, "%Y%m%dT%H%M%S%fZ").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+# The watermark trails the newest partial merged by lateness_secs, so a partial
+# written late for an older raw object still sorts after it; it never moves
+# back.
+def advance_watermark(prefix: str, watermark: Optional[str], keys: Iterable[str], lateness_secs: int) -> Optional[str]:
+    times = [t for t in map(partial_time, keys) if t is not None]
+    if not times:
+        return watermark
+    ts = max(times) - timedelta(seconds=lateness_secs)
+    candidate = prefix + ts.strftime("%Y%m%dT%H%M%S") + f"{ts.microsecond // 1000:03d}Z"
+    return max(watermark, candidate) if watermark else candidate
+
+
+# Parquet tables live next to, not inside, the JSONL ones, since an Athena
+# table reads every file under its location.
+def prefix_for_out(table: str, dt: str, output_format: str = "jsonl") -> str:
+    if output_format == "parquet":
+        table = f"{table}_parquet"
     return f"{OUT_PREFIX}/{table}/dt={dt}/"
 
+
+def out_key(table: str, dt: str, output_format: str = "jsonl") -> str:
+    return prefix_for_out(table, dt, output_format) + ("data.parquet" if output_format == "parquet" else "data.jsonl")
+
+
+def checkpoint_key(dt: str) -> str:
+    yyyy, mm, dd = dt.split("-")
+    return f"{PARTIALS_PREFIX}/{yyyy}/{mm}/{dd}/checkpoint.json"
+
+
+def rollup_state_key(period_kind: str, start: str) -> str:
+    return f"{OUT_PREFIX}/_rollup_state/{period_kind}/dt={start}.json"
@@ -1,8 +1,80 @@
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, Optional, Union
+from codec import loads
+from config import UNIQUE_SKETCHES, HLL_PRECISION, VIDEO_TOP_K
+from hll import add_register, encode_registers, hash64, split_hash
+from topk import summarize
 from utils import safe_json_loads
 
-
-def aggregate_ndjson(ndjson_text: str) -> Dict[str, Any]:
+SKETCH_DIMENSIONS = ("sessions_by_video", "sessions_by_channel", "tabs_by_video", "tabs_by_channel")
+HASH_MEMO_MAX = 100_000
+
+
+# HyperLogLog registers of the distinct client_session_id values (sessions)
+# and client_session_id/tab_id pairs (tabs) seen per video and per channel.
+# Adding a value twice is a no-op, and the same session, tab and video repeat
+# on almost every line, so already-observed combinations return early and
+# register positions are memoized per session and tab. Both memos are cleared
+# when they reach HASH_MEMO_MAX entries to keep memory bounded. Sketches start
+# sparse and only keys seen in many sessions grow to dense registers.
+class UniqueSketches:
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.sketches = {dim: {} for dim in SKETCH_DIMENSIONS}
+        self._positions = {}
+        self._observed = set()
+
+    def observe(self, video_id: Optional[str], channel: Optional[str], session_id: str, tab_id: Any) -> None:
+        observed = (video_id, channel, session_id, tab_id)
+        if observed in self._observed:
+            return
+        if len(self._observed) >= HASH_MEMO_MAX:
+            self._observed.clear()
+        self._observed.add(observed)
+
+        positions = self._positions.get((session_id, tab_id))
+        if positions is None:
+            if len(self._positions) >= HASH_MEMO_MAX:
+                self._positions.clear()
+            p = self.precision
+            positions = self._positions[(session_id, tab_id)] = (
+                split_hash(hash64(session_id), p),
+                split_hash(hash64(f"{session_id}\x1f{tab_id}"), p),
+            )
+        (s_idx, s_rank), (t_idx, t_rank) = positions
+        p = self.precision
+        sketches = self.sketches
+        for key, sessions, tabs in (
+            (video_id, sketches["sessions_by_video"], sketches["tabs_by_video"]),
+            (channel, sketches["sessions_by_channel"], sketches["tabs_by_channel"]),
+        ):
+            if not key:
+                continue
+            sessions[key] = add_register(sessions.get(key) or {}, s_idx, s_rank, p)
+            tabs[key] = add_register(tabs.get(key) or {}, t_idx, t_rank, p)
+
+    def to_json(self, videos: Optional[set] = None) -> Dict[str, Any]:
+        doc = {"precision": self.precision}
+        for dim, by_key in self.sketches.items():
+            if videos is not None and dim.endswith("_by_video"):
+                by_key = {key: regs for key, regs in by_key.items() if key in videos}
+            doc[dim] = {key: encode_registers(regs) for key, regs in by_key.items()}
+        return doc
+
+
+# Accepts the NDJSON document as one string or as an iterable of lines
+# (str or bytes), so callers can stream lines without holding the text.
+# Parsing dominates the cost, so each line goes straight to the codec and
+# only lines it rejects take the slower safe_json_loads path (blank lines,
+# invalid UTF-8 that is decoded with replacement characters).
+#
+# With video_top_k > 0 the partial keeps only the top-K videos by watch time
+# and by views, as topk summaries under "video_topk" instead of the
+# total_ms_by_video and views_by_video maps, and only their session sketches.
+def aggregate_ndjson(
+    ndjson: Union[str, Iterable[Union[str, bytes]]],
+    sketches: bool = UNIQUE_SKETCHES,
+    video_top_k: int = VIDEO_TOP_K,
+) -> Dict[str, Any]:
     total_ms_by_channel: Dict[str, int] = {}
     total_ms_by_video: Dict[str, int] = {}
     total_ms_by_channel_fg: Dict[str, int] = {}
@@ -14,62 +86,69 @@ def aggregate_ndjson(ndjson_text: str) -> Dict[str, Any]:
     invalid_events = 0
     ignored_no_video_ticks = 0
     ignored_no_channel_ticks = 0
+    unique = UniqueSketches() if sketches else None
 
-    for raw_line in ndjson_text.splitlines():
+    lines = ndjson.splitlines() if isinstance(ndjson, str) else ndjson
+    for raw_line in lines:
         total_events += 1
-        ev = safe_json_loads(raw_line)
-        if ev is None:
+        try:
+            ev = loads(raw_line)
+        except Exception:
+            ev = safe_json_loads(raw_line)
+        if type(ev) is not dict:
             invalid_events += 1
             continue
 
-        etype = ev.get("event_type")
-        ts = ev.get("event_ts")
-        tab_id = ev.get("tab_id")
-
-        if etype is None or ts is None or tab_id is None:
+        get = ev.get
+        etype = get("event_type")
+        if etype is None or get("event_ts") is None or get("tab_id") is None:
             invalid_events += 1
             continue
 
         valid_events += 1
 
-        if etype == "video_start":
-            vid = ev.get("video_id")
-            ch = ev.get("channel_name")
-            if vid:
-                views_by_video[vid] = views_by_video.get(vid, 0) + 1
-            if ch:
-                views_by_channel[ch] = views_by_channel.get(ch, 0) + 1
-            continue
+        if etype == "watch_tick":
+            delta = get("watch_ms_delta")
+            if not isinstance(delta, int) or delta <= 0:
+                continue
 
-        if etype != "watch_tick":
-            continue
+            video_id = get("video_id")
+            if not video_id:
+                ignored_no_video_ticks += 1
+                continue
 
-        delta = ev.get("watch_ms_delta")
-        if not isinstance(delta, int) or delta <= 0:
-            continue
+            total_ms_by_video[video_id] = total_ms_by_video.get(video_id, 0) + delta
 
-        video_id = ev.get("video_id")
-        channel = ev.get("channel_name")
-        watch_mode = ev.get("watch_mode")
+            channel = get("channel_name")
+            if unique is not None:
+                session_id = get("client_session_id")
+                if session_id and type(session_id) is str:
+                    unique.observe(video_id, channel, session_id, get("tab_id"))
 
-        if not video_id:
-            ignored_no_video_ticks += 1
-            continue
-
-        total_ms_by_video[video_id] = total_ms_by_video.get(video_id, 0) + delta
+            if not channel:
+                ignored_no_channel_ticks += 1
+                continue
 
-        if not channel:
-            ignored_no_channel_ticks += 1
-            continue
+            total_ms_by_channel[channel] = total_ms_by_channel.get(channel, 0) + delta
 
-        total_ms_by_channel[channel] = total_ms_by_channel.get(channel, 0) + delta
+            if get("watch_mode") == "background":
+                total_ms_by_channel_bg[channel] = total_ms_by_channel_bg.get(channel, 0) + delta
+            else:
+                total_ms_by_channel_fg[channel] = total_ms_by_channel_fg.get(channel, 0) + delta
 
-        if watch_mode == "background":
-            total_ms_by_channel_bg[channel] = total_ms_by_channel_bg.get(channel, 0) + delta
-        else:
-            total_ms_by_channel_fg[channel] = total_ms_by_channel_fg.get(channel, 0) + delta
+        elif etype == "video_start":
+            vid = get("video_id")
+            ch = get("channel_name")
+            if vid:
+                views_by_video[vid] = views_by_video.get(vid, 0) + 1
+            if ch:
+                views_by_channel[ch] = views_by_channel.get(ch, 0) + 1
+            if unique is not None:
+                session_id = get("client_session_id")
+                if session_id and type(session_id) is str:
+                    unique.observe(vid, ch, session_id, get("tab_id"))
 
-    return {
+    result = {
         "totals": {
             "total_ms_by_channel": total_ms_by_channel,
             "total_ms_by_video": total_ms_by_video,
@@ -88,4 +167,13 @@ def aggregate_ndjson(ndjson_text: str) -> Dict[str, Any]:
             "ignored_no_channel_ticks": ignored_no_channel_ticks,
         },
     }
-
+    videos = None
+    if video_top_k > 0:
+        del result["totals"]["total_ms_by_video"], result["views"]["views_by_video"]
+        watch_ms = summarize(total_ms_by_video, video_top_k)
+        views = summarize(views_by_video, video_top_k)
+        result["video_topk"] = {"k": video_top_k, "watch_ms": watch_ms, "views": views}
+        videos = watch_ms["items"].keys() | views["items"].keys()
+    if unique is not None:
+        result["sketches"] = unique.to_json(videos)
+    return result
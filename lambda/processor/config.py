@@ -3,4 +3,12 @@ import os
 RAW_PREFIX = os.getenv("RAW_PREFIX", "raw/")
 RESULTS_PREFIX = os.getenv("RESULTS_PREFIX", "results/")
 PROCESSED_PREFIX = os.getenv("PROCESSED_PREFIX", "raw-processed/")
+RAW_DISPOSITION = os.getenv("RAW_DISPOSITION", "move").lower()
+CONDITIONAL_PARTIAL_WRITE = os.getenv("CONDITIONAL_PARTIAL_WRITE", "True").lower() == "true"
+SKIP_IF_PARTIAL_EXISTS = os.getenv("SKIP_IF_PARTIAL_EXISTS", "False").lower() == "true"
+PROCESSOR_CONCURRENCY = int(os.getenv("PROCESSOR_CONCURRENCY", "8"))
+S3_READ_CHUNK_BYTES = int(os.getenv("S3_READ_CHUNK_BYTES", str(1024 * 1024)))
 
+UNIQUE_SKETCHES = os.getenv("UNIQUE_SKETCHES", "True").lower() == "true"
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+VIDEO_TOP_K = int(os.getenv("VIDEO_TOP_K", "0"))
@@ -0,0 +1,158 @@
+import base64
+import hashlib
+import math
+import zlib
+from typing import Dict, Optional, Union
+
+# HyperLogLog distinct-count sketch: 2**p one-byte registers, so a sketch
+# has a fixed size whatever the number of distinct values added, and two
+# sketches of the same precision merge by register-wise max into the sketch
+# of the union. Standard error is about 1.04 / sqrt(2**p) (1.6% at p=12).
+# Serialized as base64 of the zlib-compressed registers.
+#
+# Most keys (a video watched in a handful of sessions) set only a few
+# registers, so a sketch starts sparse, as a dict {index: rank} of its
+# nonzero registers, and is converted to the dense 2**p byte array once it
+# holds more than sparse_limit(p) entries, past which the dict would be the
+# larger of the two. Sparse sketches serialize as "s:" + base64 of 3-byte
+# (index, rank) entries; decode_registers reads both forms.
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+SPARSE_PREFIX = "s:"
+
+Registers = Union[Dict[int, int], bytearray, bytes]
+
+
+def hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Register-wise max of two register arrays, computed on them as big integers
+# with one byte per lane. Registers never exceed 64 - p + 1 < 128, so
+# (a | 0x80) - b stays within each lane and its high bit is set exactly
+# where a >= b.
+_LANE_MASKS: Dict[int, tuple] = {}
+
+
+def _lane_masks(m: int) -> tuple:
+    masks = _LANE_MASKS.get(m)
+    if masks is None:
+        masks = _LANE_MASKS[m] = (int.from_bytes(b"\x80" * m, "big"), int.from_bytes(b"\x01" * m, "big"))
+    return masks
+
+
+def register_max(a: bytes, b: bytes) -> bytes:
+    high, low = _lane_masks(len(a))
+    x = int.from_bytes(a, "big")
+    y = int.from_bytes(b, "big")
+    a_ge_b = ((((x | high) - y) & high) >> 7) * 0xFF
+    return (y ^ ((x ^ y) & a_ge_b)).to_bytes(len(a), "big")
+
+
+class HyperLogLog:
+    __slots__ = ("p", "registers")
+
+    def __init__(self, p: int, registers: Optional[bytes] = None):
+        if not MIN_PRECISION <= p <= MAX_PRECISION:
+            raise ValueError(f"HyperLogLog precision must be between {MIN_PRECISION} and {MAX_PRECISION}, got {p}")
+        self.p = p
+        if registers is None:
+            self.registers = bytearray(1 << p)
+        elif len(registers) != 1 << p:
+            raise ValueError(f"Expected {1 << p} registers for precision {p}, got {len(registers)}")
+        else:
+            self.registers = bytearray(registers)
+
+    def add(self, value: str) -> None:
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h: int) -> None:
+        idx, rank = split_hash(h, self.p)
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.p != self.p:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.p} and {other.p}")
+        self.registers = bytearray(register_max(self.registers, other.registers))
+
+    def count(self) -> int:
+        regs = self.registers
+        m = len(regs)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(regs.count(r) * 2.0 ** -r for r in set(regs))
+        zeros = regs.count(0)
+        if zeros and estimate <= 2.5 * m:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_b64(self) -> str:
+        return encode_registers(self.registers)
+
+    @classmethod
+    def from_b64(cls, data: str, p: int) -> "HyperLogLog":
+        return cls(p, to_dense(decode_registers(data), p))
+
+
+def split_hash(h: int, p: int) -> tuple:
+    rest_bits = 64 - p
+    return h >> rest_bits, rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+
+
+def sparse_limit(p: int) -> int:
+    return (1 << p) >> 7
+
+
+def to_dense(registers: Registers, p: int) -> Registers:
+    if not isinstance(registers, dict):
+        return registers
+    dense = bytearray(1 << p)
+    for idx, rank in registers.items():
+        dense[idx] = rank
+    return dense
+
+
+# Raises register idx to rank. A sparse sketch is updated in place and
+# returned, or replaced by its dense form once it outgrows sparse_limit(p).
+def add_register(registers: Registers, idx: int, rank: int, p: int) -> Registers:
+    if isinstance(registers, dict):
+        if rank > registers.get(idx, 0):
+            registers[idx] = rank
+            if len(registers) > sparse_limit(p):
+                return to_dense(registers, p)
+        return registers
+    if rank > registers[idx]:
+        registers[idx] = rank
+    return registers
+
+
+# Register-wise max of two sketches in either form. a may be updated in
+# place; b is never modified.
+def merge_registers(a: Registers, b: Registers, p: int) -> Registers:
+    if isinstance(b, dict):
+        for idx, rank in b.items():
+            a = add_register(a, idx, rank, p)
+        return a
+    if isinstance(a, dict):
+        return merge_registers(bytearray(b), a, p)
+    return bytearray(register_max(a, b))
+
+
+def encode_registers(registers: Registers) -> str:
+    if isinstance(registers, dict):
+        packed = b"".join(idx.to_bytes(2, "big") + bytes((rank,)) for idx, rank in sorted(registers.items()))
+        return SPARSE_PREFIX + base64.b64encode(packed).decode("ascii")
+    return base64.b64encode(zlib.compress(bytes(registers), 6)).decode("ascii")
+
+
+# Dense sketches written before the sparse form existed are read back
+# sparse when few of their registers are set.
+def decode_registers(data: str) -> Registers:
+    if data.startswith(SPARSE_PREFIX):
+        packed = base64.b64decode(data[len(SPARSE_PREFIX):])
+        return {int.from_bytes(packed[i:i + 2], "big"): packed[i + 2] for i in range(0, len(packed), 3)}
+    registers = bytearray(zlib.decompress(base64.b64decode(data)))
+    if len(registers) - registers.count(0) > len(registers) >> 7:
+        return registers
+    return {idx: rank for idx, rank in enumerate(registers) if rank}
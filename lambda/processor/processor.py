@@ -1,48 +1,76 @@
 import json
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
 from s3_client import s3
-from config import RAW_PREFIX, RESULTS_PREFIX, PROCESSED_PREFIX
-from utils import day_partition_from_key_or_fallback, hash_key, decode_body
+from config import (
+    RAW_PREFIX,
+    RESULTS_PREFIX,
+    PROCESSED_PREFIX,
+    RAW_DISPOSITION,
+    CONDITIONAL_PARTIAL_WRITE,
+    SKIP_IF_PARTIAL_EXISTS,
+    PROCESSOR_CONCURRENCY,
+)
+from utils import day_partition_from_key_or_fallback, hash_key, iter_body_lines, partial_stamp
 from aggregator import aggregate_ndjson
-from s3_operations import write_json, move_raw_to_processed
+from s3_operations import write_json, move_raw_to_processed, object_exists, tag_raw_processed
+
+
+PROCESSED = "processed"
+SKIPPED = "skipped"
+FAILED = "failed"
 
 
 def process_record(rec: dict) -> bool:
+    return _process_record(rec)["status"] == PROCESSED
+
+
+def _process_record(rec: dict) -> Dict[str, Any]:
     try:
         bucket = rec["s3"]["bucket"]["name"]
         key = unquote_plus(rec["s3"]["object"]["key"])
     except Exception:
         print("Skipping record: not an S3 put event")
-        return False
+        return {"bucket": None, "key": None, "status": SKIPPED}
 
     if not key.startswith(RAW_PREFIX):
         print(f"Skipping key (not under {RAW_PREFIX}): {key}")
-        return False
+        return {"bucket": bucket, "key": key, "status": SKIPPED}
 
+    yyyy, mm, dd = day_partition_from_key_or_fallback(key)
+    event_time = rec.get("eventTime")
+    stamp = partial_stamp(event_time)
     try:
-        head = s3.head_object(Bucket=bucket, Key=key)
-        etag = head.get("ETag", "").strip('"')
+        # A retried record whose partial was already written skips the GET and
+        # aggregation entirely; only the raw disposition is redone.
+        event_etag = (rec["s3"]["object"].get("eTag") or "").strip('"')
+        if SKIP_IF_PARTIAL_EXISTS and event_etag and event_time:
+            out_key = _partial_key(key, event_etag, stamp, yyyy, mm, dd)
+            if object_exists(bucket, out_key):
+                print(f"Partial already exists, skipping aggregation: s3://{bucket}/{out_key}")
+                _dispose_raw(bucket, key)
+                return {"bucket": bucket, "key": key, "status": PROCESSED, "partial": "exists"}
+
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "NoSuchKey":
+                print(f"Skipping s3://{bucket}/{key}: object no longer exists (already processed?)")
+                return {"bucket": bucket, "key": key, "status": SKIPPED}
+            raise
+        etag = obj.get("ETag", "").strip('"')
         print(f"Processing s3://{bucket}/{key} etag={etag}")
 
-        obj = s3.get_object(Bucket=bucket, Key=key)
         body_stream = obj["Body"]
         try:
-            body_bytes = body_stream.read()
+            agg = aggregate_ndjson(iter_body_lines(key, body_stream))
         finally:
             body_stream.close()
 
-        ndjson_text = decode_body(key, body_bytes)
-        agg = aggregate_ndjson(ndjson_text)
-
-        yyyy, mm, dd = day_partition_from_key_or_fallback(key)
-        raw_hash = hash_key(key, etag)
-
-        out_key = (
-            f"{RESULTS_PREFIX}daily/{yyyy}/{mm}/{dd}/partials/"
-            f"{raw_hash}.json"
-        )
-
+        out_key = _partial_key(key, etag, stamp, yyyy, mm, dd)
         payload = {
             "source": {
                 "bucket": bucket,
@@ -53,26 +81,100 @@ def process_record(rec: dict) -> bool:
             **agg,
         }
 
-        write_json(bucket, out_key, payload)
-        print(f"Wrote partial results to s3://{bucket}/{out_key}")
+        if write_json(bucket, out_key, payload, if_none_match=CONDITIONAL_PARTIAL_WRITE):
+            print(f"Wrote partial results to s3://{bucket}/{out_key}")
+            partial = "written"
+        else:
+            print(f"Partial already exists, not overwritten: s3://{bucket}/{out_key}")
+            partial = "exists"
+
+        _dispose_raw(bucket, key)
+        return {"bucket": bucket, "key": key, "status": PROCESSED, "partial": partial}
+    except Exception as e:
+        print(f"Error processing s3://{bucket}/{key}: {e}")
+        print(traceback.format_exc())
+        return {"bucket": bucket, "key": key, "status": FAILED}
 
+
+def _partial_key(key: str, etag: str, stamp: str, yyyy: str, mm: str, dd: str) -> str:
+    return f"{RESULTS_PREFIX}daily/{yyyy}/{mm}/{dd}/partials/{stamp}-{hash_key(key, etag)}.json"
+
+
+# move: copy to PROCESSED_PREFIX and delete (default); tag: mark the raw
+# object processed=true in place; leave: do nothing.
+def _dispose_raw(bucket: str, key: str) -> None:
+    if RAW_DISPOSITION == "move":
         processed_key = key.replace(RAW_PREFIX, PROCESSED_PREFIX, 1)
         move_raw_to_processed(bucket, key, processed_key)
         print(f"Moved raw -> processed: s3://{bucket}/{processed_key}")
+    elif RAW_DISPOSITION == "tag":
+        tag_raw_processed(bucket, key)
+        print(f"Tagged raw as processed: s3://{bucket}/{key}")
+    elif RAW_DISPOSITION != "leave":
+        raise ValueError(f"RAW_DISPOSITION must be move, tag or leave, got {RAW_DISPOSITION!r}")
 
-        return True
-    except Exception as e:
-        print(f"Error processing s3://{bucket}/{key}: {e}")
-        print(traceback.format_exc())
-        return False
 
+# Yields (sqs_message_id, s3_record) pairs. Direct S3 notifications have no
+# message id; SQS messages carry an S3 notification (possibly several
+# records, or none for s3:TestEvent) as their JSON body.
+def _expand_records(records: List[dict]) -> Iterator[Tuple[Optional[str], Optional[dict]]]:
+    for rec in records:
+        if rec.get("eventSource") != "aws:sqs":
+            yield None, rec
+            continue
+        message_id = rec.get("messageId")
+        try:
+            inner = json.loads(rec.get("body") or "{}").get("Records", [])
+        except (ValueError, AttributeError):
+            print(f"SQS message {message_id} does not carry an S3 notification")
+            yield message_id, None
+            continue
+        for s3_rec in inner:
+            yield message_id, s3_rec
+
+
+def _run_record(item: Tuple[Optional[str], Optional[dict]]) -> Dict[str, Any]:
+    message_id, rec = item
+    if rec is None:
+        result = {"bucket": None, "key": None, "status": FAILED}
+    else:
+        result = _process_record(rec)
+    if message_id is not None:
+        result["message_id"] = message_id
+    return result
 
+
+# Records are independent, so with PROCESSOR_CONCURRENCY > 1 they run on a
+# bounded thread pool sharing the S3 client's connection pool; a failure in
+# one record never affects the others. For SQS triggers, messages with a
+# failed record are returned in batchItemFailures (ReportBatchItemFailures)
+# so only they are redelivered.
 def lambda_handler(event, context):
     print("Event:", json.dumps(event))
     records = event.get("Records", [])
     if not records:
         print("No Records found in event.")
-        return {"ok": True, "processed": 0}
+        return {"ok": True, "processed": 0, "failed": 0, "results": [], "batchItemFailures": []}
+
+    items = list(_expand_records(records))
+    workers = max(1, min(PROCESSOR_CONCURRENCY, len(items)))
+    if workers == 1:
+        results = [_run_record(item) for item in items]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_run_record, items))
+
+    failed_messages = []
+    for result in results:
+        message_id = result.get("message_id")
+        if result["status"] == FAILED and message_id is not None and message_id not in failed_messages:
+            failed_messages.append(message_id)
 
-    processed_count = sum(1 for rec in records if process_record(rec))
-    return {"ok": True, "processed": processed_count}
+    failed = sum(1 for r in results if r["status"] == FAILED)
+    return {
+        "ok": failed == 0,
+        "processed": sum(1 for r in results if r["status"] == PROCESSED),
+        "failed": failed,
+        "results": results,
+        "batchItemFailures": [{"itemIdentifier": m} for m in failed_messages],
+    }
@@ -1,19 +1,56 @@
-import json
 from typing import Any, Dict
+from botocore.exceptions import ClientError
 from s3_client import s3
+from codec import dumps
 
 
-def write_json(bucket: str, key: str, obj: Dict[str, Any]) -> None:
+def _error_code(e: ClientError) -> str:
+    return e.response.get("Error", {}).get("Code", "")
+
+
+# With if_none_match the write only succeeds when the key does not exist yet;
+# returns False when S3 reports it already does (412 PreconditionFailed).
+def write_json(bucket: str, key: str, obj: Dict[str, Any], if_none_match: bool = False) -> bool:
+    kwargs = {"IfNoneMatch": "*"} if if_none_match else {}
     try:
         s3.put_object(
             Bucket=bucket,
             Key=key,
-            Body=json.dumps(obj, ensure_ascii=False).encode("utf-8"),
+            Body=dumps(obj),
             ContentType="application/json",
+            **kwargs,
         )
+    except ClientError as e:
+        if if_none_match and _error_code(e) in ("PreconditionFailed", "412"):
+            return False
+        print(f"Error writing to s3://{bucket}/{key}: {e}")
+        raise
     except Exception as e:
         print(f"Error writing to s3://{bucket}/{key}: {e}")
         raise
+    return True
+
+
+def object_exists(bucket: str, key: str) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if _error_code(e) in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return True
+
+
+def tag_raw_processed(bucket: str, raw_key: str) -> None:
+    try:
+        s3.put_object_tagging(
+            Bucket=bucket,
+            Key=raw_key,
+            Tagging={"TagSet": [{"Key": "processed", "Value": "true"}]},
+        )
+    except Exception as e:
+        print(f"Error tagging s3://{bucket}/{raw_key}: {e}")
+        raise
 
 
 def move_raw_to_processed(bucket: str, raw_key: str, processed_key: str) -> None:
@@ -3,11 +3,17 @@ from unittest.mock import Mock, patch, MagicMock
 import json
 import sys
 import os
+import gzip
+import io
+import threading
 
 sys.path.insert(0, os.path.dirname(__file__))
 
-from processor import process_record, lambda_handler
+from botocore.exceptions import ClientError
+from processor import process_record, lambda_handler, _process_record
 from aggregator import aggregate_ndjson
+from utils import safe_json_loads, iter_body_lines
+from hll import HyperLogLog, add_register, decode_registers, encode_registers, hash64, merge_registers, split_hash, sparse_limit
 
 
 class TestProcessor(unittest.TestCase):
@@ -25,14 +31,121 @@ class TestProcessor(unittest.TestCase):
         self.assertEqual(result['totals']['total_ms_by_channel_fg']['Channel1'], 5000)
         self.assertEqual(result['totals']['total_ms_by_channel_bg']['Channel1'], 3000)
 
+    def test_safe_json_loads(self):
+        self.assertEqual(safe_json_loads('  {"a": 1, "b": "\u00e9"}\n'), {"a": 1, "b": "\u00e9"})
+        self.assertEqual(safe_json_loads(b'{"ok":true,"n":null}'), {"ok": True, "n": None})
+        self.assertIsNone(safe_json_loads("   "))
+        self.assertIsNone(safe_json_loads("{not json"))
+
+    def test_streaming_aggregate_matches_text(self):
+        lines = []
+        for i in range(2000):
+            lines.append(json.dumps({"event_type": "watch_tick", "event_ts": i, "tab_id": "t1", "video_id": f"v{i % 7}",
+                                     "channel_name": f"c{i % 3}", "watch_ms_delta": i % 50,
+                                     "watch_mode": ("foreground", "background")[i % 2]}))
+            if i % 97 == 0:
+                lines.extend(["", "{broken", '{"event_type":"video_start","event_ts":1,"tab_id":"t","video_id":"v\u00e9"}'])
+        text = "\n".join(lines) + "\n"
+        expected = aggregate_ndjson(text)
+
+        raw = text.encode("utf-8")
+        half = len(raw) // 2
+        gzipped = gzip.compress(raw[:half]) + gzip.compress(raw[half:])
+        for key, body in (("raw/x.json", raw), ("raw/x.gz", gzipped)):
+            streamed = aggregate_ndjson(iter_body_lines(key, io.BytesIO(body), chunk_bytes=512))
+            self.assertEqual(streamed, expected)
+
+        with self.assertRaises(ValueError):
+            list(iter_body_lines("raw/x.gz", io.BytesIO(gzipped[:-10]), chunk_bytes=512))
+
+    def test_aggregate_matches_legacy_on_edge_cases(self):
+        from bench_aggregator import legacy_aggregate_ndjson
+        lines = [
+            '{"event_type":"video_start","event_ts":1,"tab_id":"t","video_id":"v\\u00e9","channel_name":"c \\"q\\""}',
+            '  { "event_type" : "watch_tick", "event_ts": 2, "tab_id": "t", "video_id": "v1",'
+            ' "channel_name": "c1", "watch_ms_delta": 10, "meta": {"watch_mode": "background"} }  ',
+            '{"event_type":"watch_tick","event_ts":3,"tab_id":"t","video_id":"v1","channel_name":"c1","watch_ms_delta":7.5}',
+            '{"event_type":"watch_tick","event_ts":4,"tab_id":"t","video_id":"v1","watch_ms_delta":true}',
+            '{"event_type":"watch_tick","event_ts":null,"tab_id":"t","video_id":"v1","watch_ms_delta":5}',
+            '{"event_type":"watch_tick","event_ts":5,"tab_id":"t","video_id":"","channel_name":"c1","watch_ms_delta":5}',
+            '{"event_type":"watch_tick","event_ts":6,"tab_id":"t","video_id":"v2","watch_ms_delta":5,"watch_mode":"background"}',
+            "",
+            "{broken",
+        ]
+        text = "\n".join(lines) + "\n"
+        expected = legacy_aggregate_ndjson(text)
+        self.assertEqual(aggregate_ndjson(text, sketches=False), expected)
+        streamed = aggregate_ndjson(iter_body_lines("raw/x.json", io.BytesIO(text.encode("utf-8"))), sketches=False)
+        self.assertEqual(streamed, expected)
+        self.assertEqual(expected["metrics"]["invalid_events"], 3)
+
+        result = aggregate_ndjson(b'\xff{"event_type":"video_start","event_ts":1,"tab_id":"t"}\n[1, 2]\n"x"\n'.splitlines())
+        self.assertEqual(result["metrics"]["total_events"], 3)
+        self.assertEqual(result["metrics"]["invalid_events"], 3)
+
+    def test_aggregate_emits_unique_sketches(self):
+        lines = []
+        for i in range(6000):
+            lines.append(json.dumps({"event_type": "watch_tick", "event_ts": i, "tab_id": i % 3, "video_id": "v1",
+                                     "channel_name": "c1", "watch_ms_delta": 100, "client_session_id": f"cs{i % 2000}"}))
+        lines.append(json.dumps({"event_type": "video_start", "event_ts": 1, "tab_id": 1, "video_id": "v2",
+                                 "client_session_id": "cs1"}))
+        result = aggregate_ndjson("\n".join(lines))
+
+        sketches = result["sketches"]
+        p = sketches["precision"]
+        self.assertEqual(set(sketches["sessions_by_video"]), {"v1", "v2"})
+        self.assertEqual(set(sketches["tabs_by_channel"]), {"c1"})
+        sessions = HyperLogLog.from_b64(sketches["sessions_by_video"]["v1"], p).count()
+        tabs = HyperLogLog.from_b64(sketches["tabs_by_video"]["v1"], p).count()
+        self.assertAlmostEqual(sessions, 2000, delta=100)
+        self.assertAlmostEqual(tabs, 6000, delta=300)
+        self.assertEqual(HyperLogLog.from_b64(sketches["sessions_by_video"]["v2"], p).count(), 1)
+        self.assertNotIn("sketches", aggregate_ndjson("\n".join(lines), sketches=False))
+
+    def test_sparse_sketches_match_dense(self):
+        p = 12
+        dense = HyperLogLog(p)
+        sparse = {}
+        for i in range(sparse_limit(p)):
+            dense.add(f"s{i}")
+            sparse = add_register(sparse, *split_hash(hash64(f"s{i}"), p), p)
+        self.assertIsInstance(sparse, dict)
+        self.assertTrue(encode_registers(sparse).startswith("s:"))
+        self.assertEqual(HyperLogLog.from_b64(encode_registers(sparse), p).registers, dense.registers)
+        self.assertEqual(decode_registers(dense.to_b64()), sparse)
+
+        other = HyperLogLog(p)
+        for i in range(sparse_limit(p), 3000):
+            dense.add(f"s{i}")
+            other.add(f"s{i}")
+        merged = merge_registers(sparse, decode_registers(other.to_b64()), p)
+        self.assertIsInstance(merged, bytearray)
+        self.assertEqual(merged, dense.registers)
+        self.assertEqual(merge_registers(decode_registers(other.to_b64()), sparse, p), dense.registers)
+
+    def test_aggregate_top_k_videos(self):
+        lines = []
+        for i, (vid, n) in enumerate((("v1", 5), ("v2", 3), ("v3", 1), ("v4", 1))):
+            for j in range(n):
+                lines.append(json.dumps({"event_type": "watch_tick", "event_ts": j, "tab_id": 1, "video_id": vid,
+                                         "channel_name": "c1", "watch_ms_delta": 100,
+                                         "client_session_id": f"cs{i}"}))
+        result = aggregate_ndjson("\n".join(lines), video_top_k=2)
+
+        self.assertNotIn("total_ms_by_video", result["totals"])
+        self.assertEqual(result["totals"]["total_ms_by_channel"], {"c1": 1000})
+        watch_ms = result["video_topk"]["watch_ms"]
+        self.assertEqual(watch_ms, {"items": {"v1": [500, 500], "v2": [300, 300]}, "total": 1000, "floor": 100})
+        self.assertEqual(set(result["sketches"]["sessions_by_video"]), {"v1", "v2"})
+        self.assertEqual(set(result["sketches"]["sessions_by_channel"]), {"c1"})
+
     @patch('s3_operations.s3')
     @patch('processor.s3')
     def test_process_record(self, mock_processor_s3, mock_ops_s3):
         mock_s3 = mock_processor_s3
-        mock_s3.head_object.return_value = {"ETag": '"test-etag"'}
-        body_mock = MagicMock()
-        body_mock.read.return_value = b'{"event_type":"video_start","event_ts":1000,"tab_id":"t1","video_id":"v1","channel_name":"ch1","video_session_id":"s1"}'
-        mock_s3.get_object.return_value = {"Body": body_mock}
+        body = io.BytesIO(b'{"event_type":"video_start","event_ts":1000,"tab_id":"t1","video_id":"v1","channel_name":"ch1","video_session_id":"s1"}')
+        mock_s3.get_object.return_value = {"Body": body, "ETag": '"test-etag"'}
         mock_ops_s3.put_object.return_value = {}
         mock_ops_s3.copy_object.return_value = {}
         mock_ops_s3.delete_object.return_value = {}
@@ -46,6 +159,40 @@ class TestProcessor(unittest.TestCase):
         
         result = process_record(rec)
         self.assertTrue(result)
+        mock_s3.head_object.assert_not_called()
+        put = mock_ops_s3.put_object.call_args.kwargs
+        self.assertEqual(put["IfNoneMatch"], "*")
+        self.assertEqual(json.loads(put["Body"])["source"]["etag"], "test-etag")
+        mock_ops_s3.copy_object.assert_called_once()
+        mock_ops_s3.delete_object.assert_called_once()
+
+    @patch('s3_operations.s3')
+    @patch('processor.s3')
+    def test_process_record_is_idempotent_on_retry(self, mock_processor_s3, mock_ops_s3):
+        rec = {"eventTime": "2026-01-19T10:00:00.250Z",
+               "s3": {"bucket": {"name": "b"}, "object": {"key": "raw/2026/01/19/f.json", "eTag": "abc"}}}
+        mock_processor_s3.get_object.side_effect = lambda **kw: {"Body": io.BytesIO(b"{}\n"), "ETag": '"abc"'}
+        mock_ops_s3.put_object.side_effect = ClientError(
+            {"Error": {"Code": "PreconditionFailed"}, "ResponseMetadata": {"HTTPStatusCode": 412}}, "PutObject")
+
+        result = _process_record(rec)
+        self.assertEqual((result["status"], result["partial"]), ("processed", "exists"))
+        mock_ops_s3.copy_object.assert_called_once()
+        written_key = mock_ops_s3.put_object.call_args.kwargs["Key"]
+        self.assertTrue(written_key.startswith("results/daily/2026/01/19/partials/20260119T100000250Z-"))
+
+        mock_processor_s3.get_object.reset_mock()
+        mock_ops_s3.head_object.return_value = {}
+        with patch('processor.SKIP_IF_PARTIAL_EXISTS', True), patch('processor.RAW_DISPOSITION', 'tag'):
+            result = _process_record(rec)
+        self.assertEqual((result["status"], result["partial"]), ("processed", "exists"))
+        mock_processor_s3.get_object.assert_not_called()
+        self.assertEqual(mock_ops_s3.head_object.call_args.kwargs["Key"], written_key)
+        mock_ops_s3.put_object_tagging.assert_called_once()
+        self.assertEqual(mock_ops_s3.copy_object.call_count, 1)
+
+        mock_processor_s3.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        self.assertEqual(_process_record(rec)["status"], "skipped")
 
     def test_process_record_invalid_key(self):
         rec = {
@@ -58,9 +205,9 @@ class TestProcessor(unittest.TestCase):
         result = process_record(rec)
         self.assertFalse(result)
 
-    @patch('processor.process_record')
+    @patch('processor._process_record')
     def test_lambda_handler(self, mock_process):
-        mock_process.return_value = True
+        mock_process.return_value = {"bucket": "b1", "key": "k", "status": "processed"}
         
         event = {
             "Records": [
@@ -73,6 +220,49 @@ class TestProcessor(unittest.TestCase):
         self.assertEqual(result['processed'], 2)
         self.assertEqual(mock_process.call_count, 2)
 
+    @patch('processor._process_record')
+    def test_lambda_handler_runs_records_concurrently(self, mock_process):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def process(rec):
+            key = rec["s3"]["object"]["key"]
+            barrier.wait()
+            return {"bucket": "b1", "key": key, "status": "failed" if key.endswith("bad.json") else "processed"}
+
+        mock_process.side_effect = process
+        event = {"Records": [
+            {"s3": {"bucket": {"name": "b1"}, "object": {"key": f"raw/2026/01/19/{name}.json"}}}
+            for name in ("f1", "bad", "f3")
+        ]}
+        with patch('processor.PROCESSOR_CONCURRENCY', 3):
+            result = lambda_handler(event, None)
+
+        self.assertEqual((result['processed'], result['failed'], result['ok']), (2, 1, False))
+        self.assertEqual([r['key'] for r in result['results']],
+                         ["raw/2026/01/19/f1.json", "raw/2026/01/19/bad.json", "raw/2026/01/19/f3.json"])
+        self.assertEqual(result['batchItemFailures'], [])
+
+    @patch('processor._process_record')
+    def test_lambda_handler_reports_sqs_batch_item_failures(self, mock_process):
+        def process(rec):
+            key = rec["s3"]["object"]["key"]
+            return {"bucket": "b1", "key": key, "status": "failed" if "bad" in key else "processed"}
+
+        def sqs_message(message_id, *keys):
+            body = {"Records": [{"s3": {"bucket": {"name": "b1"}, "object": {"key": k}}} for k in keys]}
+            return {"eventSource": "aws:sqs", "messageId": message_id, "body": json.dumps(body)}
+
+        mock_process.side_effect = process
+        event = {"Records": [
+            sqs_message("m1", "raw/a.json", "raw/b.json"),
+            sqs_message("m2", "raw/bad.json", "raw/c.json"),
+            {"eventSource": "aws:sqs", "messageId": "m3", "body": "not json"},
+        ]}
+        result = lambda_handler(event, None)
+
+        self.assertEqual(result['processed'], 3)
+        self.assertEqual(result['batchItemFailures'], [{"itemIdentifier": "m2"}, {"itemIdentifier": "m3"}])
+
 
 if __name__ == '__main__':
     unittest.main()
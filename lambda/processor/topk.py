@@ -0,0 +1,41 @@
+import heapq
+from typing import Dict
+
+# Bounded top-K summary of per-video counters: {"items": {key: [lower,
+# upper]}, "total": total, "floor": floor}. Each tracked key's true count
+# lies in [lower, upper]; a key that is not tracked has a true count of at
+# most floor. Merging two summaries and keeping the K keys with the largest
+# lower bounds preserves these guarantees, so partials and the compactor's
+# running summary stay at K keys however long the tail of videos is.
+# total - sum(lower) is the "other" bucket: watch time not attributed with
+# certainty to a tracked key.
+
+
+def summarize(counts: Dict[str, int], k: int) -> dict:
+    ranked = heapq.nlargest(k + 1, counts.items(), key=lambda kv: kv[1])
+    return {
+        "items": {key: [value, value] for key, value in ranked[:k]},
+        "total": sum(counts.values()),
+        "floor": ranked[k][1] if len(ranked) > k else 0,
+    }
+
+
+def merge(a: dict, b: dict, k: int) -> dict:
+    a_items, b_items = a["items"], b["items"]
+    a_missing, b_missing = (0, a["floor"]), (0, b["floor"])
+    items = {}
+    for key in a_items.keys() | b_items.keys():
+        a_lower, a_upper = a_items.get(key, a_missing)
+        b_lower, b_upper = b_items.get(key, b_missing)
+        items[key] = [a_lower + b_lower, a_upper + b_upper]
+
+    floor = a["floor"] + b["floor"]
+    if len(items) > k:
+        ranked = sorted(items.items(), key=lambda kv: (kv[1][0], kv[1][1]), reverse=True)
+        floor = max(floor, max(upper for _, (_, upper) in ranked[k:]))
+        items = dict(ranked[:k])
+    return {"items": items, "total": a["total"] + b["total"], "floor": floor}
+
+
+def other(summary: dict) -> int:
+    return summary["total"] - sum(lower for lower, _ in summary["items"].values())
@@ -1,20 +1,26 @@
-import json
-import gzip
 import hashlib
+import zlib
 from datetime import datetime, timezone
-from typing import Any, Dict, Tuple, Optional
+from typing import Any, BinaryIO, Dict, Iterator, Tuple, Optional, Union
 from urllib.parse import unquote_plus
-from config import RAW_PREFIX
+from config import RAW_PREFIX, S3_READ_CHUNK_BYTES
+from codec import loads
 
 
-def safe_json_loads(line: str) -> Optional[Dict[str, Any]]:
+def safe_json_loads(line: Union[str, bytes]) -> Optional[Dict[str, Any]]:
     line = line.strip()
     if not line:
         return None
     try:
-        return json.loads(line)
+        return loads(line)
     except Exception:
-        return None
+        pass
+    if isinstance(line, bytes):
+        try:
+            return loads(line.decode("utf-8", errors="replace"))
+        except Exception:
+            pass
+    return None
 
 
 def day_partition_from_key_or_fallback(key: str) -> Tuple[str, str, str]:
@@ -35,8 +41,58 @@ def hash_key(key: str, etag: str = "") -> str:
     return h.hexdigest()[:16]
 
 
-def decode_body(key: str, body_bytes: bytes) -> str:
-    if key.endswith(".gz"):
-        return gzip.decompress(body_bytes).decode("utf-8", errors="replace")
-    return body_bytes.decode("utf-8", errors="replace")
+# Partial keys start with the raw object's S3 event time so the compactor can
+# list a day's partials from a watermark instead of from the start.
+def partial_stamp(event_time: Optional[str] = None) -> str:
+    ts = None
+    if event_time:
+        try:
+            ts = datetime.fromisoformat(event_time.replace("Z", "+00:00")).astimezone(timezone.utc)
+        except ValueError:
+            pass
+    ts = ts or datetime.now(timezone.utc)
+    return ts.strftime("%Y%m%dT%H%M%S") + f"{ts.microsecond // 1000:03d}Z"
+
+
+def _new_inflater():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _iter_chunks(body: BinaryIO, gzipped: bool, chunk_bytes: int) -> Iterator[bytes]:
+    inflater = _new_inflater() if gzipped else None
+    fed = False
+    while True:
+        data = body.read(chunk_bytes)
+        if not data:
+            break
+        if inflater is None:
+            yield data
+            continue
+        while data:
+            out = inflater.decompress(data, chunk_bytes)
+            fed = True
+            if out:
+                yield out
+            if inflater.eof:
+                # Concatenated gzip members continue in unused_data.
+                data = inflater.unused_data
+                inflater = _new_inflater()
+                fed = False
+            else:
+                data = inflater.unconsumed_tail
+    if fed:
+        raise ValueError("truncated gzip stream")
+
+
+# Streams an S3 object body as raw NDJSON lines (bytes, without the "\n"),
+# decompressing .gz keys on the fly. Memory stays at roughly one chunk plus
+# one line however large the object is.
+def iter_body_lines(key: str, body: BinaryIO, chunk_bytes: int = S3_READ_CHUNK_BYTES) -> Iterator[bytes]:
+    pending = b""
+    for chunk in _iter_chunks(body, key.endswith(".gz"), chunk_bytes):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
 